@@ -0,0 +1,202 @@
+"""
+Tenant-fair admission of imaging jobs.
+
+Jobs are queued per tenant, the `OwnerTenant` (owner, tenant_uuid) of the
+node, and handed to the imaging workers by start-time fair queueing: each
+job is tagged with the virtual time its tenant's share reaches it, and the
+eligible job with the lowest tag goes first. A tenant that submits 300
+nodes thus gets its weighted share of the workers while a tenant with one
+node is served after at most one job of every other tenant.
+
+A tenant can additionally be limited to a number of jobs running host
+workflows at once, and to an artifact bandwidth: a job is only admitted
+once the tenant's byte budget, refilled at that rate, covers its payload.
+
+Policies come from the JSON file named by GRIFFON_TENANT_POLICIES, keyed
+by "owner/tenant_uuid" or tenant_uuid, e.g.
+    {"ada14b27-c147-4aca-9b9f-7762f1f48426":
+        {"weight": 2, "max_active": 32, "bandwidth_mb_s": 200}}
+Tenants without a policy get the defaults below.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TENANT_POLICIES_FILE = os.getenv("GRIFFON_TENANT_POLICIES", "")
+DEFAULT_MAX_ACTIVE = int(os.getenv("GRIFFON_TENANT_MAX_ACTIVE", "16"))
+# Seconds of bandwidth a tenant can save up while it is idle
+BANDWIDTH_BURST_S = 10
+
+TenantKey = Tuple[str, str]
+
+
+def tenant_of(metadata) -> TenantKey:
+    extension = (metadata or {}).get("extension") or {}
+    return extension.get("owner", ""), extension.get("tenant_uuid", "")
+
+
+def tenant_label(tenant: TenantKey) -> str:
+    return "/".join(tenant)
+
+
+class TenantPolicy(object):
+    __slots__ = ("weight", "max_active", "bandwidth")
+
+    def __init__(self, weight=1.0, max_active=DEFAULT_MAX_ACTIVE, bandwidth_mb_s=0):
+        self.weight = float(weight)
+        self.max_active = int(max_active)
+        # Bytes per second, 0 for unlimited
+        self.bandwidth = float(bandwidth_mb_s) * 1024 * 1024
+
+
+def load_policies(path) -> Dict[str, TenantPolicy]:
+    with open(path) as f:
+        return {key: TenantPolicy(**value) for key, value in json.load(f).items()}
+
+
+class _Tenant(object):
+    __slots__ = ("key", "policy", "queue", "active", "last_finish", "tokens",
+                 "refilled_at")
+
+    def __init__(self, key, policy):
+        self.key = key
+        self.policy = policy
+        # (start tag, job)
+        self.queue = deque()
+        self.active = 0
+        self.last_finish = 0.0
+        self.tokens = policy.bandwidth * BANDWIDTH_BURST_S
+        self.refilled_at = time.monotonic()
+
+    def refill(self, now):
+        if not self.policy.bandwidth:
+            return
+        capacity = self.policy.bandwidth * BANDWIDTH_BURST_S
+        self.tokens = min(capacity, self.tokens +
+                          (now - self.refilled_at) * self.policy.bandwidth)
+        self.refilled_at = now
+
+    def wait_for_budget(self, cost) -> float:
+        """
+        Seconds until the tenant's byte budget admits a job of cost bytes,
+        0 if it does now. A job larger than the burst waits for a full
+        budget and leaves it in debt.
+        """
+        if not self.policy.bandwidth or not cost:
+            return 0
+        needed = min(cost, self.policy.bandwidth * BANDWIDTH_BURST_S)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.policy.bandwidth
+
+
+class FairAdmission(object):
+    """
+    Per-tenant queues of jobs with a `metadata` and a `payload_bytes`
+    attribute, served by start-time fair queueing.
+    """
+
+    def __init__(self, policies: Optional[Dict[str, TenantPolicy]] = None,
+                 default: Optional[TenantPolicy] = None):
+        if policies is None:
+            policies = load_policies(TENANT_POLICIES_FILE) if TENANT_POLICIES_FILE else {}
+        self.policies = policies
+        self.default = default or TenantPolicy()
+        self._tenants: Dict[TenantKey, _Tenant] = {}
+        self._vtime = 0.0
+        self._size = 0
+        self._changed = asyncio.Event()
+
+    def _tenant(self, key: TenantKey) -> _Tenant:
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            policy = (self.policies.get(tenant_label(key)) or
+                      self.policies.get(key[1]) or self.default)
+            tenant = self._tenants[key] = _Tenant(key, policy)
+        return tenant
+
+    def put(self, job):
+        tenant = self._tenant(tenant_of(job.metadata))
+        start = max(self._vtime, tenant.last_finish)
+        tenant.last_finish = start + 1.0 / tenant.policy.weight
+        tenant.queue.append((start, job))
+        self._size += 1
+        self._changed.set()
+
+    def _pick(self):
+        """
+        Returns (tenant of the next job or None, seconds until a job
+        blocked on bandwidth could go).
+        """
+        now = time.monotonic()
+        best, retry = None, None
+        for tenant in self._tenants.values():
+            if not tenant.queue or tenant.active >= tenant.policy.max_active:
+                continue
+            tenant.refill(now)
+            wait = tenant.wait_for_budget(tenant.queue[0][1].payload_bytes)
+            if wait:
+                retry = wait if retry is None else min(retry, wait)
+                continue
+            if best is None or tenant.queue[0][0] < best.queue[0][0]:
+                best = tenant
+        return best, retry
+
+    async def get(self):
+        """
+        Waits for the next job to admit and counts it as active for its
+        tenant until release().
+        """
+        while True:
+            tenant, retry = self._pick()
+            if tenant is not None:
+                break
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), retry)
+            except asyncio.TimeoutError:
+                pass
+        start, job = tenant.queue.popleft()
+        self._vtime = start
+        self._size -= 1
+        tenant.active += 1
+        if tenant.policy.bandwidth:
+            tenant.tokens -= job.payload_bytes
+        return job
+
+    def remove(self, job) -> bool:
+        """
+        Takes a job that was not admitted yet out of its queue.
+        """
+        tenant = self._tenants.get(tenant_of(job.metadata))
+        if tenant is None:
+            return False
+        for entry in tenant.queue:
+            if entry[1] is job:
+                tenant.queue.remove(entry)
+                self._size -= 1
+                return True
+        return False
+
+    def release(self, job):
+        tenant = self._tenants.get(tenant_of(job.metadata))
+        if tenant is not None and tenant.active:
+            tenant.active -= 1
+            self._changed.set()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def depths(self) -> Dict[str, int]:
+        return {tenant_label(key): len(tenant.queue)
+                for key, tenant in self._tenants.items() if tenant.queue}
+
+    def active(self) -> Dict[str, int]:
+        return {tenant_label(key): tenant.active
+                for key, tenant in self._tenants.items() if tenant.active}
@@ -0,0 +1,400 @@
+"""
+Asynchronous imaging jobs.
+
+image_node only validates and enqueues a request and returns its session
+id, so a caller does not hold a connection open for the tens of minutes
+an imaging run takes. A fixed set of workers runs the host workflows
+(stage phoenix, reboot into phoenix) in threads; from there phoenix
+pushes its progress to the log endpoint. Callers follow a job with the
+image_node_status procedure, which long-polls until the job changes.
+
+Submitted jobs are first preflight checked in batches, so a node that is
+bound to fail (unreachable, /boot full, partitions missing...) fails its
+job right away instead of taking a worker. Jobs that pass are admitted to
+the workers fairly between tenants, see admission.py.
+
+A job can be cancelled until phoenix takes over: a queued job is dropped,
+a running host workflow is stopped through its cancellation token and
+gives back its worker within seconds. A job phoenix took over fails once
+phoenix has not reported for GRIFFON_IMAGING_STALL_S, or when cancelled
+with force, so a hung phoenix does not hold the node forever.
+
+Jobs do not survive a provider restart: the caller's context they report
+status with is gone. The host workflows checkpoint their steps in the job
+store though, and the next image_node of a node whose job was interrupted
+continues its session, so the workflow resumes after its last checkpoint.
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from admission import FairAdmission
+
+logger = logging.getLogger(__name__)
+
+IMAGING_CONCURRENCY = int(os.getenv("GRIFFON_IMAGING_CONCURRENCY", "64"))
+# Submissions within this window are preflight checked together
+PREFLIGHT_WINDOW_S = 0.5
+PREFLIGHT_BATCH = 256
+# Finished jobs stay queryable this long
+FINISHED_JOB_TTL_S = 3600
+# A job phoenix took over fails after this long without a progress report
+IMAGING_STALL_S = int(os.getenv("GRIFFON_IMAGING_STALL_S", "7200"))
+STALL_CHECK_S = 60
+MAX_WAIT_S = 60
+
+QUEUED = "queued"
+RUNNING = "running"
+IMAGING = "imaging"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+
+class WorkflowError(Exception):
+    pass
+
+
+class _WorkflowOptions(object):
+    def __init__(self, node_ip, config):
+        self.node_ip = node_ip
+        self.config = config
+
+
+def new_cancel_token():
+    from cancellation import CancelToken
+
+    return CancelToken()
+
+
+def run_host_workflow(node_ip, config, on_step, token):
+    """
+    Stages phoenix on the node and reboots it into phoenix, the same way
+    the stage_phoenix and reboot_to_phoenix scripts do. Runs in a worker
+    thread; on_step(status) reports the node status of each stage. Stops
+    with WorkflowError once token is cancelled.
+    """
+    from cancellation import Cancelled, bound
+    from reboot_to_phoenix import RebootToPhoenix
+    from stage_phoenix import StagePhoenix
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f, bound(token):
+        json.dump(config, f)
+        f.flush()
+        options = _WorkflowOptions(node_ip, f.name)
+        try:
+            on_step("staging")
+            if not StagePhoenix(options).stage_phoenix():
+                raise WorkflowError("Staging phoenix failed")
+            token.check()
+            on_step("reboot_to_phoenix")
+            if not RebootToPhoenix(options).reboot_to_phoenix():
+                raise WorkflowError("Rebooting into phoenix failed")
+        except Cancelled as e:
+            raise WorkflowError(f"Cancelled: {e}")
+
+
+def run_preflight(nodes: Dict[str, dict]) -> Dict[str, Tuple[str, int]]:
+    """
+    Preflight checks {node_ip: config} concurrently. Returns the problems
+    of each node, empty if it can be imaged, and its payload size.
+    """
+    from preflight import preflight
+
+    return {ip: (report.summary(), report.payload_bytes)
+            for ip, report in preflight(nodes).items()}
+
+
+class ImagingJob(object):
+    __slots__ = ("session_id", "node_ip", "metadata", "ctx", "config",
+                 "state", "status", "message", "version", "created_at",
+                 "updated_at", "active_at", "payload_bytes", "token",
+                 "_changed")
+
+    def __init__(self, node_ip, metadata, ctx, config, session_id=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.node_ip = node_ip
+        self.metadata = metadata
+        self.ctx = ctx
+        # The session goes into the phoenix command line, so phoenix
+        # callbacks of another run of the node can be told apart
+        self.config = dict(config, session=self.session_id)
+        self.state = QUEUED
+        self.status = "initial"
+        self.message = ""
+        self.version = 0
+        self.created_at = self.updated_at = time.time()
+        # Last change or progress report, heartbeats included
+        self.active_at = self.created_at
+        # Artifact bytes the host workflow downloads, charged to the
+        # tenant's bandwidth budget
+        self.payload_bytes = 0
+        self.token = new_cancel_token()
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED
+
+    def _update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.version += 1
+        self.updated_at = self.active_at = time.time()
+        # Wake current waiters; later waiters wait for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "node_ip": self.node_ip,
+            "state": self.state,
+            "status": self.status,
+            "message": self.message,
+            "version": self.version,
+        }
+
+
+# advance(job, status, failed, message) applies a workflow stage to the
+# node's progress
+AdvanceFn = Callable[[ImagingJob, str, bool, str], Awaitable[None]]
+
+
+class ImagingJobs(object):
+    """
+    Queue of imaging jobs with bounded concurrency.
+
+    A node has at most one unfinished job; requesting it again returns
+    the running job, so callers can retry image_node safely.
+    """
+
+    def __init__(self, advance: AdvanceFn, run_workflow=run_host_workflow,
+                 preflight=run_preflight, concurrency=IMAGING_CONCURRENCY,
+                 admission: Optional[FairAdmission] = None):
+        self._advance = advance
+        self._run_workflow = run_workflow
+        self._preflight = preflight
+        self.concurrency = concurrency
+        self._jobs: Dict[str, ImagingJob] = {}
+        self._active: Dict[str, ImagingJob] = {}
+        # node ip -> session of its job interrupted by a provider restart
+        self._interrupted: Dict[str, str] = {}
+        self.admission = admission or FairAdmission()
+        self._unchecked: asyncio.Queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix="imaging")
+        self._workers = []
+
+    def start(self):
+        self._workers = [asyncio.ensure_future(self._worker())
+                         for _ in range(self.concurrency)]
+        self._workers.append(asyncio.ensure_future(self._preflight_worker()))
+        self._workers.append(asyncio.ensure_future(self._stall_worker()))
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+    def queued(self) -> int:
+        return self._unchecked.qsize() + self.admission.qsize()
+
+    def counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return counts
+
+    def submit(self, node_ip, metadata, ctx, config, session_id=None) -> ImagingJob:
+        """
+        Enqueues imaging of a node. Returns immediately.
+        """
+        self._expire()
+        job = self._active.get(node_ip)
+        if job is not None and self._stalled(job):
+            # The stall worker has not got to it yet
+            self.progress(node_ip, job.status, True, self._stall_message())
+            job = None
+        if job is not None:
+            return job
+        session_id = session_id or self._interrupted.pop(node_ip, None)
+        job = ImagingJob(node_ip, metadata, ctx, config, session_id)
+        self._jobs[job.session_id] = job
+        self._active[node_ip] = job
+        if self._preflight is None:
+            self.admission.put(job)
+        else:
+            self._unchecked.put_nowait(job)
+        logger.debug(f"Queued imaging of {node_ip} as {job.session_id}")
+        return job
+
+    def load_interrupted(self, store):
+        """
+        Remembers the sessions of the jobs in store a provider restart
+        interrupted, for submit to continue them.
+        """
+        for stored in store.running_jobs():
+            session = stored["config"].get("session")
+            if session:
+                self._interrupted[stored["node_ip"]] = session
+
+    def get(self, session_id) -> Optional[ImagingJob]:
+        return self._jobs.get(session_id)
+
+    def get_active(self, node_ip) -> Optional[ImagingJob]:
+        return self._active.get(node_ip)
+
+    async def cancel(self, job: ImagingJob, reason="cancelled by request",
+                     force=False) -> ImagingJob:
+        """
+        Cancels a job that phoenix has not taken over yet. A running host
+        workflow fails the job once it has stopped. With force a job
+        phoenix took over is failed too, releasing the node for a new job;
+        phoenix itself cannot be stopped.
+        """
+        if job.finished:
+            return job
+        if job.state == IMAGING:
+            if not force:
+                raise Exception(f"Node {job.node_ip} is being imaged by phoenix, "
+                                f"cancel with force to abandon it")
+            logger.info(f"Abandoning imaging job {job.session_id}: {reason}")
+            await self._fail(job, f"Abandoned: {reason}")
+            return job
+        logger.info(f"Cancelling imaging job {job.session_id}: {reason}")
+        job.token.cancel(reason)
+        if job.state == QUEUED and self.admission.remove(job):
+            await self._fail(job, f"Cancelled: {reason}")
+        # Jobs still in preflight are failed by the preflight worker
+        return job
+
+    async def wait(self, job: ImagingJob, version=-1, timeout=0) -> ImagingJob:
+        """
+        Returns once the job is past `version`, is finished, or after
+        `timeout` seconds.
+        """
+        timeout = min(timeout, MAX_WAIT_S)
+        if job.version > version or job.finished or timeout <= 0:
+            return job
+        try:
+            await asyncio.wait_for(job._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job
+
+    def progress(self, node_ip, status, failed, message=""):
+        """
+        Applies a node status transition published by the progress
+        tracker to the node's job.
+        """
+        job = self._active.get(node_ip)
+        if job is None:
+            return
+        state = job.state
+        if failed:
+            state = FAILED
+        elif status == "done":
+            state = DONE
+        job._update(status=status, state=state, message=message or job.message)
+        if job.finished:
+            self._active.pop(node_ip, None)
+
+    def touch(self, node_ip):
+        """
+        Notes a progress report of the node's job that changed nothing,
+        so a phoenix that keeps reporting the same status is not stalled.
+        """
+        job = self._active.get(node_ip)
+        if job is not None:
+            job.active_at = time.time()
+
+    async def _preflight_worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._unchecked.get()]
+            await asyncio.sleep(PREFLIGHT_WINDOW_S)
+            while len(batch) < PREFLIGHT_BATCH and not self._unchecked.empty():
+                batch.append(self._unchecked.get_nowait())
+            nodes = {job.node_ip: job.config for job in batch
+                     if not job.token.cancelled}
+            try:
+                reports = await loop.run_in_executor(None, self._preflight, nodes)
+            except Exception as e:
+                # A broken preflight must not stop imaging
+                logger.error(f"Preflight of {len(batch)} nodes failed: {e}")
+                reports = {}
+            for job in batch:
+                problems, job.payload_bytes = reports.get(job.node_ip, ("", 0))
+                if job.token.cancelled:
+                    await self._fail(job, f"Cancelled: {job.token.reason}")
+                elif problems:
+                    await self._fail(job, f"Preflight: {problems}")
+                else:
+                    self.admission.put(job)
+
+    def _stalled(self, job) -> bool:
+        return (job.state == IMAGING and
+                time.time() - job.active_at > IMAGING_STALL_S)
+
+    @staticmethod
+    def _stall_message():
+        return f"No progress from phoenix for {IMAGING_STALL_S}s"
+
+    async def _stall_worker(self):
+        while True:
+            await asyncio.sleep(STALL_CHECK_S)
+            for job in list(self._active.values()):
+                if self._stalled(job):
+                    logger.warning(f"Imaging job {job.session_id} of {job.node_ip} "
+                                   f"stalled in phoenix")
+                    await self._fail(job, self._stall_message())
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self.admission.get()
+            try:
+                await self._run(loop, job)
+            except Exception as e:
+                logger.error(f"Imaging job {job.session_id} failed: {e}")
+            finally:
+                self.admission.release(job)
+
+    async def _run(self, loop, job):
+        job._update(state=RUNNING)
+
+        def on_step(status):
+            asyncio.run_coroutine_threadsafe(
+                self._advance(job, status, False, ""), loop).result()
+
+        try:
+            await loop.run_in_executor(self._executor, self._run_workflow,
+                                       job.node_ip, job.config, on_step,
+                                       job.token)
+        except Exception as e:
+            await self._fail(job, str(e))
+            return
+        if not job.finished:
+            # The rest of the run is pushed by phoenix
+            job._update(state=IMAGING)
+
+    async def _fail(self, job, message):
+        job.message = message
+        await self._advance(job, job.status, True, message)
+        # In case the tracker did not publish the failure
+        if not job.finished:
+            self.progress(job.node_ip, job.status, True, message)
+
+    def _expire(self):
+        cutoff = time.time() - FINISHED_JOB_TTL_S
+        for session_id, job in list(self._jobs.items()):
+            if job.finished and job.updated_at < cutoff:
+                del self._jobs[session_id]
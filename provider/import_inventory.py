@@ -0,0 +1,197 @@
+"""
+Bulk import of a rack inventory as node entities.
+
+Reads node configs (as in config/node_172.26.1.5.json) from a JSON file
+holding one config, a list of them or {"nodes": [...]}, or from a CSV
+file with a column per config field. Nodes are keyed by their IP: nodes
+that already have an entity are left alone unless the inventory sets
+their state, the rest are created. Requests to papiea are pipelined with
+bounded concurrency, and failures are retried (a create only while the
+node still has no entity) and reported at the end instead of stopping
+the import.
+
+Example:
+    python import_inventory.py rack7.csv --owner nutanix \\
+        --tenant ada14b27-c147-4aca-9b9f-7762f1f48426 --key <s2s key>
+"""
+import argparse
+import asyncio
+import csv
+import ipaddress
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from papiea.client import EntityCRUD
+from papiea.core import Spec
+
+from settings import PAPIEA_URL, PROVIDER_PREFIX, PROVIDER_VERSION
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 32
+MAX_ATTEMPTS = 3
+PROGRESS_INTERVAL_S = 2
+IP_FIELDS = ("ip", "hypervisor_ip", "node_ip")
+
+
+def read_inventory(path) -> List[dict]:
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            return [{k: v for k, v in row.items() if v not in (None, "")}
+                    for row in csv.DictReader(f)]
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("nodes", [data])
+    return data
+
+
+def plan_nodes(rows) -> Tuple[Dict[str, dict], List[str]]:
+    """
+    Returns the inventory's nodes by IP and the problems found. A node
+    listed twice keeps its last entry.
+    """
+    nodes: Dict[str, dict] = {}
+    errors = []
+    for i, row in enumerate(rows, 1):
+        ip = next((row[f] for f in IP_FIELDS if row.get(f)), None)
+        try:
+            ip = str(ipaddress.IPv4Address(ip))
+        except ValueError:
+            errors.append(f"entry {i}: no valid node IP in {IP_FIELDS}")
+            continue
+        if ip in nodes:
+            errors.append(f"entry {i}: duplicate of node {ip}, last entry kept")
+        nodes[ip] = row
+    return nodes, errors
+
+
+class ImportReport(object):
+    def __init__(self, total):
+        self.total = total
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.failed: Dict[str, str] = {}
+        self.start = time.monotonic()
+
+    @property
+    def done(self):
+        return self.created + self.updated + self.unchanged + len(self.failed)
+
+    def progress(self) -> str:
+        elapsed = time.monotonic() - self.start
+        return (f"{self.done}/{self.total} nodes in {elapsed:.1f}s: "
+                f"{self.created} created, {self.updated} updated, "
+                f"{self.unchanged} unchanged, {len(self.failed)} failed")
+
+
+async def _with_retries(request, applied=None):
+    """
+    Runs request, retrying failures with backoff. For a request that is
+    not idempotent, applied() tells before each retry whether a failed
+    attempt took effect anyway, e.g. only its reply was lost, and ends
+    the retries if so.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            if attempt > 1 and applied is not None and await applied():
+                return None
+            return await request()
+        except Exception:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+
+async def _node_exists(entity_client, ip) -> bool:
+    found = await entity_client.filter({"spec": {"ip": ip}})
+    return bool(found.results)
+
+
+async def import_nodes(entity_client, nodes: Dict[str, dict], owner, tenant,
+                       concurrency=DEFAULT_CONCURRENCY, dry_run=False) -> ImportReport:
+    """
+    Creates or updates an entity per node, `concurrency` requests at a
+    time.
+    """
+    existing = {}
+    for entity in await entity_client.get_all():
+        existing[getattr(entity.spec, "ip", None)] = entity
+    report = ImportReport(len(nodes))
+    sema = asyncio.Semaphore(concurrency)
+
+    async def import_node(ip, row):
+        entity = existing.get(ip)
+        state = row.get("state")
+        try:
+            async with sema:
+                if entity is None:
+                    if not dry_run:
+                        await _with_retries(
+                            lambda: entity_client.create(
+                                Spec(ip=ip, state=state or "free"),
+                                metadata_extension={
+                                    "owner": row.get("owner", owner),
+                                    "tenant_uuid": row.get("tenant_uuid", tenant),
+                                }),
+                            applied=lambda: _node_exists(entity_client, ip))
+                    report.created += 1
+                elif state and entity.spec.state != state:
+                    if not dry_run:
+                        entity.spec.state = state
+                        await _with_retries(lambda: entity_client.update(
+                            entity.metadata, entity.spec))
+                    report.updated += 1
+                else:
+                    report.unchanged += 1
+        except Exception as e:
+            report.failed[ip] = str(e) or type(e).__name__
+
+    async def print_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL_S)
+            print(report.progress(), flush=True)
+
+    progress = asyncio.ensure_future(print_progress())
+    try:
+        await asyncio.gather(*(import_node(ip, row) for ip, row in nodes.items()))
+    finally:
+        progress.cancel()
+    return report
+
+
+async def run(args):
+    nodes, errors = plan_nodes(read_inventory(args.inventory))
+    async with EntityCRUD(PAPIEA_URL, PROVIDER_PREFIX, PROVIDER_VERSION,
+                          "node", args.key) as entity_client:
+        report = await import_nodes(entity_client, nodes, args.owner,
+                                    args.tenant, args.concurrency, args.dry_run)
+    print(report.progress())
+    for error in errors:
+        print(f"skipped {error}")
+    for ip, error in sorted(report.failed.items()):
+        print(f"failed {ip}: {error}")
+    return 1 if report.failed or errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a rack inventory as node entities")
+    parser.add_argument("inventory", help="CSV or JSON file of node configs")
+    parser.add_argument("--owner", required=True, help="Owner of created nodes")
+    parser.add_argument("--tenant", required=True, help="Tenant uuid of created nodes")
+    parser.add_argument("--key", default=os.getenv("GRIFFON_S2S_KEY", ""),
+                        help="papiea s2s key to create the entities with")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Requests to papiea in flight at once")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report what would be done without changing anything")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
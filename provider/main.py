@@ -1,15 +1,41 @@
 import asyncio
+import hashlib
+import http.client
 import json
 import logging
 import os
+import signal
+import socket
+import sys
+import time
+from urllib.parse import urlparse
 
-from yaml import Loader as YamlLoader
 from yaml import load as load_yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+from aiohttp import web
 from papiea.client import EntityCRUD
 from papiea.core import Action, Entity, Key, ProceduralExecutionStrategy, S2S_Key, Spec
 from papiea.python_sdk import ProviderSdk
 
+from imaging_jobs import ImagingJobs
+from node_index import NodeIndex
+from permission_cache import PermissionCache
+from progress import ProgressEvent, ProgressTracker, make_log_app, status_order_from_kind
+from request_validation import Validator, parse_image_node
+from settings import PAPIEA_URL, PROVIDER_PREFIX, PROVIDER_VERSION
+from status_writer import StatusWriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from metrics import CONTENT_TYPE, REGISTRY  # noqa: E402
+import swarm  # noqa: E402
+from job_store import JobStore, redact  # noqa: E402
+import tracing  # noqa: E402
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.DEBUG,
@@ -18,38 +44,94 @@ logging.basicConfig(
 )
 
 
-PAPIEA_URL = os.getenv("PAPIEA_URL", "http://127.0.0.1:3333")
 PAPIEA_ADMIN_S2S_KEY = os.getenv("PAPIEA_ADMIN_S2S_KEY", "")
 PROVIDER_HOST = os.getenv("PROVIDER_HOST", "")
 PROVIDER_PORT = int(os.getenv("PROVIDER_PORT", "9000"))
-PROVIDER_PREFIX = "griffon"
-PROVIDER_VERSION = "0.1.0"
 PROVIDER_ADMIN_S2S_KEY = "Sa8xaic9"
+GRIFFON_LOG_PORT = int(os.getenv("GRIFFON_LOG_PORT", "8000"))
+# Fast start skips setup already done by a previous start and the demo
+# request, for quick restarts during rollouts
+FAST_START = os.getenv("GRIFFON_FAST_START", "0") == "1"
+CACHE_DIR = os.getenv("GRIFFON_CACHE_DIR", ".griffon_cache")
+PAPIEA_WAIT_TIMEOUT_S = 300
+
+progress_tracker = None
+status_writer = None
+permission_cache = None
+node_index = NodeIndex()
+image_node_validator = None
+imaging_jobs = None
+
+
+def papiea_ready(url, timeout=1.0):
+    """
+    True once papiea accepts connections and answers HTTP requests; a
+    listening port alone can precede the server being able to serve.
+    """
+    urlparts = urlparse(url)
+    conn = http.client.HTTPConnection(urlparts.hostname, urlparts.port or 80,
+                                      timeout=timeout)
+    try:
+        conn.request("GET", "/")
+        conn.getresponse().read()
+        return True
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+
 
+def wait_for_papiea(url, timeout=PAPIEA_WAIT_TIMEOUT_S):
+    """
+    Polls papiea with exponential backoff, from a few milliseconds so an
+    already running papiea costs one round trip, up to 2s between probes.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while not papiea_ready(url):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"papiea at {url} not ready after {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
 
-def wait_port_is_open(url):
-    import socket
-    import time
-    from urllib.parse import urlparse
 
-    urlparts = urlparse(url).netloc.split(":")
-    host = urlparts[0]
-    port = int(urlparts[1])
-    while True:
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex((host, port))
-            sock.close()
-            if result == 0:
-                return
-        except socket.gaierror:
-            pass
-        time.sleep(1)
+def _cache_path(name):
+    return os.path.join(CACHE_DIR, name)
 
 
 def load_yaml_from_file(filename):
-    with open(filename) as f:
-        return load_yaml(f, Loader=YamlLoader)
+    """
+    Parses a YAML file, reusing the parse of a previous start while the
+    file content is unchanged.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    cached = _cache_path(f"{hashlib.sha256(data).hexdigest()}.json")
+    try:
+        with open(cached) as f:
+            return json.load(f)
+    except Exception:
+        # Missing, or unreadable in any way: parse the file again
+        pass
+    parsed = load_yaml(data, Loader=YamlLoader)
+    try:
+        text = json.dumps(parsed)
+        if json.loads(text) != parsed:
+            # e.g. dates or non-string keys, which JSON would change
+            return parsed
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, cached)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug(f"Not caching {filename}: {e}")
+    return parsed
+
+
+def _key_marker(key_name):
+    digest = hashlib.sha256(f"{PAPIEA_URL} {key_name}".encode()).hexdigest()
+    return _cache_path(f"key-{digest[:16]}")
 
 
 async def create_provider_admin_s2s_key(sdk: ProviderSdk, new_key: Key):
@@ -62,16 +144,33 @@ async def create_provider_admin_s2s_key(sdk: ProviderSdk, new_key: Key):
         user_info={"is_provider_admin": True},
     )
 
+    # The key outlives provider restarts; remove the marker if papiea
+    # lost its keys
+    marker = _key_marker(the_key.name)
+    if FAST_START and os.path.exists(marker):
+        logger.debug(f"Key {the_key.name} set up by a previous start")
+        return
+
     keys = await admin_security_api.list_keys()
     for key in keys:
         if key.name == the_key.name:
             logger.debug(f"Key {the_key.name} already exists")
+            _write_marker(marker)
             return
 
     new_s2s_key = await admin_security_api.create_key(the_key)
     provider_admin_security_api = sdk.new_security_api(new_key)
     user_info = await provider_admin_security_api.user_info()
     logger.debug(f"User info {user_info}")
+    _write_marker(marker)
+
+
+def _write_marker(path):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        open(path, "w").close()
+    except OSError as e:
+        logger.debug(f"Not writing {path}: {e}")
 
 
 async def create_user_s2s_key(sdk: ProviderSdk):
@@ -89,26 +188,194 @@ async def create_user_s2s_key(sdk: ProviderSdk):
     return new_s2s_key.key
 
 
+async def publish_progress(node):
+    """
+    Queues a tracked node's status transition for papiea. Terminal
+    transitions also move the node spec state to ready/failed.
+    """
+    status_writer.write_status(node.ctx, node.metadata, {"status": node.status})
+    if node.failed or node.status == "done":
+        status_writer.write_spec(node.ctx, node.metadata,
+                                 {"state": "failed" if node.failed else "ready"})
+    imaging_jobs.progress(node.node_ip, node.status, node.failed)
+
+
+async def advance_imaging(job, status, failed, message):
+    """
+    Applies a stage of an imaging job's host workflow to the node's
+    progress.
+    """
+    await progress_tracker.handle(ProgressEvent(job.node_ip, None, status,
+                                                message, failed))
+
+
+def register_metrics():
+    """
+    Exposes provider state through the metrics registry shared with the
+    host workflows.
+    """
+    REGISTRY.gauge(
+        "griffon_jobs_in_flight", "Nodes being imaged by status", ["status"]
+    ).set_function(lambda: {(status,): count for status, count
+                            in progress_tracker.counts().items()})
+    REGISTRY.gauge(
+        "griffon_cache_hit_ratio", "Hit ratio of provider caches", ["cache"]
+    ).set_function(lambda: {("permission",): permission_cache.hit_ratio()})
+    REGISTRY.gauge(
+        "griffon_imaging_jobs", "Imaging jobs by state", ["state"]
+    ).set_function(lambda: {(state,): count for state, count
+                            in imaging_jobs.counts().items()})
+    REGISTRY.gauge(
+        "griffon_imaging_jobs_queued", "Imaging jobs waiting for a worker"
+    ).set_function(lambda: imaging_jobs.queued())
+    REGISTRY.gauge(
+        "griffon_tenant_queue_depth", "Imaging jobs waiting for admission by tenant",
+        ["tenant"]
+    ).set_function(lambda: {(tenant,): depth for tenant, depth
+                            in imaging_jobs.admission.depths().items()})
+    REGISTRY.gauge(
+        "griffon_tenant_active_jobs", "Imaging jobs running host workflows by tenant",
+        ["tenant"]
+    ).set_function(lambda: {(tenant,): count for tenant, count
+                            in imaging_jobs.admission.active().items()})
+    REGISTRY.gauge(
+        "griffon_status_writes_pending", "Entity writes waiting to be flushed"
+    ).set_function(lambda: status_writer.pending())
+    REGISTRY.gauge(
+        "griffon_status_writes_coalesced", "Entity writes merged into a pending write"
+    ).set_function(lambda: status_writer.coalesced)
+
+
+async def metrics_handler(request):
+    return web.Response(body=REGISTRY.exposition().encode(),
+                        headers={"Content-Type": CONTENT_TYPE})
+
+
+async def allocate_nodes(ctx, request):
+    """
+    Reserves free nodes of a tenant from the allocation index. The nodes
+    stay reserved until they are imaged or the reservation expires.
+    """
+    reservation = node_index.reserve(request["count"], request["tenant_uuid"],
+                                     request.get("subnet"))
+    if reservation is None:
+        raise Exception(f"Not enough free nodes for tenant {request['tenant_uuid']}")
+    nodes = node_index.nodes(reservation)
+    for node in nodes:
+        if not await permission_cache.check(ctx, node.metadata, Action.Update):
+            node_index.release(reservation.id)
+            raise Exception("Permission denied")
+    return {
+        "reservation_id": reservation.id,
+        "nodes": [{"uuid": node.uuid, "ip": node.ip} for node in nodes],
+    }
+
+
 async def image_node(ctx, entity, config):
-    logger.debug(f"image_node() input config:\n%s" % config)
     """
-    WIP: Add implementation to image node and track node state machine
+    Queues imaging of the node and returns its session id right away.
+    Progress is reported by the image_node_status procedure.
     """
-    entity.spec.state = "imaged"
-    allowed = await ctx.check_permission([(Action.Update, entity.metadata)])
+    # Reject bad requests before anything is changed on the node
+    config = parse_image_node(image_node_validator, config).to_dict()
+    allowed = await permission_cache.check(ctx, entity.metadata, Action.Update)
     logger.debug(f"Allowed {allowed}")
     if not allowed:
         raise Exception("Permission denied")
-    async with ctx.entity_client_for_user(entity.metadata) as entity_client:
-        await entity_client.update(entity.metadata, entity.spec)
-    return entity.spec.state
+    logger.debug("image_node() input config:\n%s", redact(config))
+    job = imaging_jobs.get_active(entity.spec.ip)
+    if job is None:
+        entity.spec.state = "imaging"
+        node_index.upsert(entity.metadata, entity.spec)
+        status_writer.write_spec(ctx, entity.metadata, {"state": entity.spec.state})
+        job = imaging_jobs.submit(entity.spec.ip, entity.metadata, ctx, config)
+        # The host workflow stages and reboots the node, further
+        # transitions are pushed by phoenix through the log endpoint,
+        # tagged with the job's session
+        progress_tracker.track(entity.spec.ip, entity.metadata, ctx,
+                               session=job.session_id)
+    return {
+        "session_id": job.session_id,
+        "message": job.state,
+        "details": f"Imaging {job.node_ip}",
+    }
+
+
+async def image_node_status(ctx, request):
+    """
+    Reports an imaging job. With wait_s, long-polls until the job changes
+    from the given version or finishes.
+    """
+    job = imaging_jobs.get(request["session_id"])
+    if job is None:
+        raise Exception(f"Unknown imaging session {request['session_id']}")
+    if not await permission_cache.check(ctx, job.metadata, Action.Read):
+        raise Exception("Permission denied")
+    await imaging_jobs.wait(job, request.get("version", -1), request.get("wait_s", 0))
+    return job.to_dict()
+
+
+async def cancel_image_node(ctx, request):
+    """
+    Cancels an imaging job that phoenix has not taken over yet, stopping
+    its host workflow. With force, abandons a job phoenix took over.
+    """
+    job = imaging_jobs.get(request["session_id"])
+    if job is None:
+        raise Exception(f"Unknown imaging session {request['session_id']}")
+    if not await permission_cache.check(ctx, job.metadata, Action.Update):
+        raise Exception("Permission denied")
+    await imaging_jobs.cancel(job, request.get("reason") or "cancelled by request",
+                              force=request.get("force", False))
+    return job.to_dict()
+
+
+async def run_demo(sdk: ProviderSdk):
+    """
+    Creates a sample node and images it with the sample request.
+    """
+    try:
+        user_s2s_key = await create_user_s2s_key(sdk)
+        async with EntityCRUD(
+            PAPIEA_URL, PROVIDER_PREFIX, PROVIDER_VERSION, "node", user_s2s_key
+        ) as entity_client:
+            entity = await entity_client.create(
+                Spec(ip="172.26.1.5", state="free"),
+                metadata_extension={
+                    "owner": "nutanix",
+                    "tenant_uuid": "ada14b27-c147-4aca-9b9f-7762f1f48426",
+                },
+            )
+            logger.debug(f"Created entity {entity}")
+            request = ""
+            with open('./config/node_172.26.1.5.json', 'r') as f:
+              request = json.load(f)
+            logger.debug(f"Image_node config: %s" % request)
+            res = await entity_client.invoke_procedure("image_node",
+                                                       entity.metadata,
+                                                       request)
+            logger.debug(f"Procedure returns {res}")
+            entity = await entity_client.get(entity.metadata)
+            logger.debug(f"Updated entity {res}")
+    except Exception as e:
+        logger.error(f"Demo request failed: {e}")
+
 
 async def main():
+    global progress_tracker, status_writer, permission_cache, image_node_validator
+    global imaging_jobs
+
     # Load kinds
     node_kind = load_yaml_from_file("./kinds/node.yml")
     meta_ext = load_yaml_from_file("./griffon_metadata_extension.yml")
     proceedure_image_node_in = load_yaml_from_file("./kinds/image_node.yml")
     procedure_image_node_out = load_yaml_from_file("./kinds/image_node_out.yml")
+    procedure_allocate_nodes_in = load_yaml_from_file("./kinds/allocate_nodes.yml")
+    procedure_allocate_nodes_out = load_yaml_from_file("./kinds/allocate_nodes_out.yml")
+    procedure_image_node_status_in = load_yaml_from_file("./kinds/image_node_status.yml")
+    procedure_image_node_status_out = load_yaml_from_file("./kinds/image_node_status_out.yml")
+    procedure_cancel_image_node_in = load_yaml_from_file("./kinds/cancel_image_node.yml")
+    image_node_validator = Validator(proceedure_image_node_in)
 
     # Set auth
     oauth_config = load_yaml_from_file("./policy/griffon_auth.yaml")
@@ -129,6 +396,11 @@ async def main():
             casbin_initial_policy=casbin_initial_policy,
         )
         sdk.metadata_extension(meta_ext)
+        # Cached decisions are only valid for the policy they were made
+        # against; SIGHUP signals a policy change
+        permission_cache = PermissionCache()
+        asyncio.get_event_loop().add_signal_handler(signal.SIGHUP,
+                                                    permission_cache.invalidate)
         await create_provider_admin_s2s_key(sdk, PROVIDER_ADMIN_S2S_KEY)
 
         node = sdk.new_kind(node_kind)
@@ -140,6 +412,30 @@ async def main():
             procedure_image_node_out,
             image_node,
         )
+        # Register image_node_status procedure
+        node.kind_procedure(
+            "image_node_status",
+            ProceduralExecutionStrategy.HaltIntentful,
+            procedure_image_node_status_in,
+            procedure_image_node_status_out,
+            image_node_status,
+        )
+        # Register cancel_image_node procedure
+        node.kind_procedure(
+            "cancel_image_node",
+            ProceduralExecutionStrategy.HaltIntentful,
+            procedure_cancel_image_node_in,
+            procedure_image_node_status_out,
+            cancel_image_node,
+        )
+        # Register allocate_nodes procedure
+        node.kind_procedure(
+            "allocate_nodes",
+            ProceduralExecutionStrategy.HaltIntentful,
+            procedure_allocate_nodes_in,
+            procedure_allocate_nodes_out,
+            allocate_nodes,
+        )
         """
         # Register reboot_to_target procedure
         node.entity_procedure(
@@ -153,36 +449,62 @@ async def main():
         await sdk.register()
         server = sdk.server
 
-        user_s2s_key = await create_user_s2s_key(sdk)
-        async with EntityCRUD(
-            PAPIEA_URL, PROVIDER_PREFIX, PROVIDER_VERSION, "node", user_s2s_key
-        ) as entity_client:
-            entity = await entity_client.create(
-                Spec(ip="172.26.1.5", state="free"),
-                metadata_extension={
-                    "owner": "nutanix",
-                    "tenant_uuid": "ada14b27-c147-4aca-9b9f-7762f1f48426",
-                },
-            )
-            logger.debug(f"Created entity {entity}")
-            request = ""
-            with open('./config/node_172.26.1.5.json', 'r') as f:
-              request = json.load(f)
-            logger.debug(f"Image_node config: %s" % request)
-            res = await entity_client.invoke_procedure("image_node",
-                                                       entity.metadata,
-                                                       request)
-            logger.debug(f"Procedure returns {res}")
-            entity = await entity_client.get(entity.metadata)
-            logger.debug(f"Updated entity {res}")
+        status_writer = StatusWriter()
+        status_writer.spec_listeners.append(node_index.update)
+        status_writer.start()
+
+        # Index node entities for allocation and keep it in sync
+        index_client = EntityCRUD(PAPIEA_URL, PROVIDER_PREFIX, PROVIDER_VERSION,
+                                  "node", PROVIDER_ADMIN_S2S_KEY)
+        await index_client.__aenter__()
+        await node_index.load(index_client)
+        resync_task = asyncio.ensure_future(node_index.resync_forever(index_client))
+
+        # Serve the log endpoint phoenix reports imaging progress to,
+        # and the metrics endpoint next to it
+        progress_tracker = ProgressTracker(status_order_from_kind(node_kind),
+                                           publish_progress)
+        imaging_jobs = ImagingJobs(advance_imaging)
+        progress_tracker.activity_listeners.append(imaging_jobs.touch)
+        # Imaging a node again resumes the workflow a restart interrupted
+        imaging_jobs.load_interrupted(JobStore())
+        imaging_jobs.start()
+        register_metrics()
+        log_app = make_log_app(progress_tracker)
+        log_app.router.add_get("/metrics", metrics_handler)
+        log_runner = web.AppRunner(log_app)
+        await log_runner.setup()
+        await web.TCPSite(log_runner, PROVIDER_HOST or None, GRIFFON_LOG_PORT).start()
+        # Chunk tracker and seed of rack-local payload distribution
+        if swarm.SWARM_PORT:
+            swarm.start(PROVIDER_HOST)
+
+        # The demo request runs next to serving, not before it
+        demo_task = None
+        if not FAST_START:
+            demo_task = asyncio.ensure_future(run_demo(sdk))
 
-        while True:
-            # Serve provider procedures forever
-            await asyncio.sleep(300)
+        # Serve provider procedures until stopped. SIGUSR1 writes out the
+        # trace of the jobs so far, SIGTERM/SIGINT shut down cleanly so the
+        # trace is written at exit
+        loop = asyncio.get_event_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(
+            signal.SIGUSR1, lambda: loop.run_in_executor(None, tracing.flush))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
 
+        resync_task.cancel()
+        if demo_task is not None:
+            demo_task.cancel()
+        await imaging_jobs.close()
+        await index_client.__aexit__(None, None, None)
+        await log_runner.cleanup()
+        await status_writer.close()
         await server.close()
 
 
 if __name__ == "__main__":
-    wait_port_is_open(PAPIEA_URL)
+    wait_for_papiea(PAPIEA_URL)
     asyncio.run(main())
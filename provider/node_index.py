@@ -0,0 +1,231 @@
+"""
+Free-node allocation index.
+
+Keeps node entities bucketed by (state, tenant, subnet) so picking nodes
+for a request touches only the matching buckets instead of listing every
+node entity from papiea. The index is loaded once, then kept current from
+the provider's own spec writes. Nodes created, deleted or changed by
+anyone else only show up at the next full resync, every
+RESYNC_INTERVAL_S (5 minutes): until then a new node is not offered, a
+deleted one can still be reserved and a node changed elsewhere stays in
+its old bucket.
+
+Reservations take nodes out of the free buckets until they are committed
+(the node moves on to imaging) or expire, so concurrent requests never
+receive the same node.
+"""
+import asyncio
+import ipaddress
+import itertools
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUBNET_PREFIX = int(os.getenv("GRIFFON_SUBNET_PREFIX", "24"))
+RESERVATION_TTL_S = 300
+RESYNC_INTERVAL_S = 300
+
+BucketKey = Tuple[str, str, str]
+
+
+def subnet_of(ip: str, prefix: int = SUBNET_PREFIX) -> str:
+    try:
+        return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+    except ValueError:
+        return ""
+
+
+def _tenant_of(metadata) -> str:
+    extension = metadata.get("extension") or {}
+    return extension.get("tenant_uuid", "")
+
+
+class IndexedNode(object):
+    __slots__ = ("uuid", "ip", "state", "tenant", "subnet", "metadata",
+                 "reservation")
+
+    def __init__(self, uuid, ip, state, tenant, metadata):
+        self.uuid = uuid
+        self.ip = ip
+        self.state = state
+        self.tenant = tenant
+        self.subnet = subnet_of(ip)
+        self.metadata = metadata
+        self.reservation = None
+
+    @property
+    def key(self) -> BucketKey:
+        return self.state, self.tenant, self.subnet
+
+
+class Reservation(object):
+    __slots__ = ("id", "nodes", "expires_at")
+
+    def __init__(self, id, nodes, expires_at):
+        self.id = id
+        self.nodes = nodes
+        self.expires_at = expires_at
+
+
+class NodeIndex(object):
+    """
+    In-memory index of node entities.
+
+    Buckets are insertion ordered dicts of uuid, so nodes are handed out
+    oldest first and moving a node between buckets is O(1). A second map
+    from (state, tenant) to the subnets holding such nodes serves requests
+    that do not care about the subnet.
+    """
+
+    def __init__(self, reservation_ttl=RESERVATION_TTL_S):
+        self.reservation_ttl = reservation_ttl
+        self._nodes: Dict[str, IndexedNode] = {}
+        self._buckets: Dict[BucketKey, Dict[str, None]] = {}
+        self._subnets: Dict[Tuple[str, str], Set[str]] = {}
+        self._reservations: Dict[str, Reservation] = {}
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _add_to_bucket(self, node):
+        if node.reservation is not None:
+            return
+        self._buckets.setdefault(node.key, {})[node.uuid] = None
+        self._subnets.setdefault((node.state, node.tenant), set()).add(node.subnet)
+
+    def _remove_from_bucket(self, node):
+        bucket = self._buckets.get(node.key)
+        if bucket is None or bucket.pop(node.uuid, False) is False:
+            return
+        if not bucket:
+            del self._buckets[node.key]
+            subnets = self._subnets[(node.state, node.tenant)]
+            subnets.discard(node.subnet)
+            if not subnets:
+                del self._subnets[(node.state, node.tenant)]
+
+    def upsert(self, metadata, spec):
+        """
+        Adds a node entity or applies its current spec.
+        """
+        uuid = metadata["uuid"]
+        node = self._nodes.get(uuid)
+        if node is None:
+            node = IndexedNode(uuid, spec.get("ip", ""), spec.get("state", ""),
+                               _tenant_of(metadata), metadata)
+            self._nodes[uuid] = node
+            self._add_to_bucket(node)
+            return
+        self.update(metadata, spec)
+
+    def update(self, metadata, changes):
+        """
+        Applies spec field changes of an indexed node; unknown nodes are
+        ignored until they are upserted.
+        """
+        node = self._nodes.get(metadata["uuid"])
+        if node is None:
+            return
+        ip = changes.get("ip", node.ip)
+        state = changes.get("state", node.state)
+        if (ip, state) == (node.ip, node.state):
+            return
+        self._remove_from_bucket(node)
+        if node.reservation is not None and state != "free":
+            # The reservation was used
+            self._reservations[node.reservation].nodes.discard(node.uuid)
+            node.reservation = None
+        node.ip, node.state, node.subnet = ip, state, subnet_of(ip)
+        self._add_to_bucket(node)
+
+    def remove(self, uuid):
+        node = self._nodes.pop(uuid, None)
+        if node is not None:
+            self._remove_from_bucket(node)
+            if node.reservation is not None:
+                self._reservations[node.reservation].nodes.discard(uuid)
+
+    def count(self, state, tenant, subnet=None) -> int:
+        if subnet is not None:
+            return len(self._buckets.get((state, tenant, subnet), ()))
+        return sum(len(self._buckets[(state, tenant, s)])
+                   for s in self._subnets.get((state, tenant), ()))
+
+    def _candidates(self, tenant, subnet) -> Iterable[Dict[str, None]]:
+        if subnet is not None:
+            bucket = self._buckets.get(("free", tenant, subnet))
+            return [bucket] if bucket else []
+        # Fullest subnet first, to keep a request's nodes together
+        return sorted((self._buckets[("free", tenant, s)]
+                       for s in self._subnets.get(("free", tenant), ())),
+                      key=len, reverse=True)
+
+    def reserve(self, count, tenant, subnet=None) -> Optional[Reservation]:
+        """
+        Atomically takes `count` free nodes of the tenant, optionally in one
+        subnet, out of the free pool. Returns None if there are not enough.
+        """
+        self.expire()
+        if count <= 0 or self.count("free", tenant, subnet) < count:
+            return None
+        picked: List[IndexedNode] = []
+        for bucket in self._candidates(tenant, subnet):
+            for uuid in itertools.islice(bucket, count - len(picked)):
+                picked.append(self._nodes[uuid])
+            if len(picked) == count:
+                break
+        reservation = Reservation(str(next(self._ids)), set(),
+                                  time.monotonic() + self.reservation_ttl)
+        for node in picked:
+            self._remove_from_bucket(node)
+            node.reservation = reservation.id
+            reservation.nodes.add(node.uuid)
+        self._reservations[reservation.id] = reservation
+        return reservation
+
+    def nodes(self, reservation: Reservation) -> List[IndexedNode]:
+        return [self._nodes[uuid] for uuid in reservation.nodes]
+
+    def release(self, reservation_id):
+        """
+        Returns the nodes of a reservation that were not used to the pool.
+        """
+        reservation = self._reservations.pop(reservation_id, None)
+        if reservation is None:
+            return
+        for uuid in reservation.nodes:
+            node = self._nodes.get(uuid)
+            if node is not None:
+                node.reservation = None
+                self._add_to_bucket(node)
+
+    def expire(self):
+        now = time.monotonic()
+        for reservation in list(self._reservations.values()):
+            if reservation.expires_at <= now or not reservation.nodes:
+                self.release(reservation.id)
+
+    async def load(self, entity_client):
+        """
+        Rebuilds the index from every node entity.
+        """
+        entities = await entity_client.get_all()
+        seen = set()
+        for entity in entities:
+            seen.add(entity.metadata["uuid"])
+            self.upsert(entity.metadata, entity.spec)
+        for uuid in set(self._nodes) - seen:
+            self.remove(uuid)
+        logger.debug(f"Indexed {len(self._nodes)} nodes")
+
+    async def resync_forever(self, entity_client, interval=RESYNC_INTERVAL_S):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load(entity_client)
+            except Exception as e:
+                logger.error(f"Node index resync failed: {e}")
@@ -0,0 +1,133 @@
+"""
+Provider-side cache of papiea permission decisions.
+
+`ctx.check_permission` is a round trip into papiea's casbin evaluation.
+The griffon model (`policy/griffon_model.txt`) only looks at the caller,
+the entity owner/tenant from the `OwnerTenant` metadata extension, the
+entity kind and the action, so a decision made for one node applies to
+every node of the same tenant. Decisions are cached under exactly that
+key for a short TTL.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from papiea.core import Action
+
+logger = logging.getLogger(__name__)
+
+PERMISSION_TTL_S = 30
+MAX_CACHED_DECISIONS = 10000
+
+CacheKey = Tuple[str, str, str, str, str]
+
+
+def _subject_of(ctx) -> str:
+    token = ctx.get_invoking_token() or ""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _action_name(action) -> str:
+    return getattr(action, "value", None) or str(action)
+
+
+class PermissionCache(object):
+    """
+    TTL cache of (subject, owner, tenant, kind, action) -> allowed, bounded
+    by evicting the least recently used decision.
+
+    Concurrent misses for the same key share a single papiea check.
+    `invalidate()` must be called whenever the casbin policy changes.
+    """
+
+    def __init__(self, ttl=PERMISSION_TTL_S, max_entries=MAX_CACHED_DECISIONS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._decisions = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(ctx, action, metadata) -> CacheKey:
+        extension = metadata.get("extension") or {}
+        return (_subject_of(ctx), extension.get("owner", ""),
+                extension.get("tenant_uuid", ""), metadata.get("kind", ""),
+                _action_name(action))
+
+    def _lookup(self, key) -> Optional[bool]:
+        decision = self._decisions.get(key)
+        if decision is None:
+            return None
+        allowed, expires_at = decision
+        if expires_at <= time.monotonic():
+            del self._decisions[key]
+            return None
+        # Least recently used decisions are evicted first
+        self._decisions.move_to_end(key)
+        return allowed
+
+    def _store(self, key, allowed):
+        self._decisions[key] = (allowed, time.monotonic() + self.ttl)
+        self._decisions.move_to_end(key)
+        while len(self._decisions) > self.max_entries:
+            self._decisions.popitem(last=False)
+            self.evictions += 1
+
+    async def check(self, ctx, metadata, action=Action.Update) -> bool:
+        """
+        Returns whether the caller of `ctx` may perform `action` on the
+        entity, consulting papiea only on a cache miss.
+        """
+        key = self.key_for(ctx, action, metadata)
+        allowed = self._lookup(key)
+        if allowed is not None:
+            self.hits += 1
+            return allowed
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            # Shares the papiea check already in flight for this key
+            self.hits += 1
+            return bool(await asyncio.shield(pending))
+
+        self.misses += 1
+
+        generation = self._generation
+        pending = asyncio.ensure_future(
+            ctx.check_permission([(action, metadata)]))
+        self._inflight[key] = pending
+        try:
+            allowed = bool(await asyncio.shield(pending))
+        finally:
+            self._inflight.pop(key, None)
+        # Drop decisions made against a policy invalidated meanwhile
+        if generation == self._generation:
+            self._store(key, allowed)
+        return allowed
+
+    def invalidate(self):
+        """
+        Forgets every cached decision. Hook for casbin policy changes.
+        """
+        self._generation += 1
+        self._decisions.clear()
+        logger.info("Permission cache invalidated")
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._decisions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hit_ratio(),
+        }
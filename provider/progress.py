@@ -0,0 +1,230 @@
+"""
+Push-based imaging progress tracking.
+
+Phoenix and the installer running on a node post their progress to the
+griffon log endpoint (FOUND_IP/FOUND_PORT on the phoenix kernel command
+line). Every callback is parsed into a transition of the node `status`
+enum from `kinds/node.yml` and published to papiea, so in-flight nodes
+are tracked from the events they push rather than by polling them over
+SSH.
+"""
+import json
+import logging
+import re
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LOG_ROUTE = "/griffon/log"
+MAX_CALLBACK_BYTES = 64 * 1024
+
+# Ordered (pattern, status) table, checked top to bottom. Later imaging
+# phases come first so a message mentioning several phases maps to the
+# furthest one.
+STATUS_PATTERNS = [
+    (re.compile(r"imaging (process )?(completed|complete|done|successful)|"
+                r"installation (completed|complete|successful)", re.I), "done"),
+    (re.compile(r"(installing|install) (the )?(cvm|svm|controller vm|nos)|"
+                r"cvm install", re.I), "cvm_install"),
+    (re.compile(r"first ?boot", re.I), "hyp_firstboot"),
+    (re.compile(r"(installing|install) (the )?(hypervisor|ahv|esx|kvm)|"
+                r"hypervisor install", re.I), "hyp_install"),
+    (re.compile(r"download\w* (the )?(hypervisor|iso|ahv)", re.I), "download_hyp"),
+    (re.compile(r"download\w* (the )?(nos|installer|nutanix_installer)", re.I),
+     "download_nos"),
+]
+FAILURE_PATTERN = re.compile(r"\bfatal\b|imaging failed|installation failed", re.I)
+
+# Status reported by any callback that does not match a known phase; a
+# node that can post to the log endpoint is running phoenix.
+DEFAULT_STATUS = "phoenix_up"
+
+
+def status_order_from_kind(node_kind: dict) -> List[str]:
+    """
+    Returns the ordered node status enum declared in the node kind.
+    """
+    return list(node_kind["node"]["properties"]["status"]["enum"])
+
+
+class ProgressEvent(object):
+    __slots__ = ("node_ip", "session", "status", "message", "failed")
+
+    def __init__(self, node_ip, session, status, message, failed=False):
+        self.node_ip = node_ip
+        self.session = session
+        self.status = status
+        self.message = message
+        self.failed = failed
+
+    def __repr__(self):
+        return "ProgressEvent(%s, %s, %s, failed=%s)" % (
+            self.node_ip, self.session, self.status, self.failed)
+
+
+def classify_message(message: str) -> Optional[str]:
+    """
+    Maps a free-form phoenix/installer message onto a node status.
+    """
+    for pattern, status in STATUS_PATTERNS:
+        if pattern.search(message):
+            return status
+    return None
+
+
+def parse_callback(body: bytes, content_type: str = "",
+                   remote_ip: str = "") -> Optional[ProgressEvent]:
+    """
+    Parses a log endpoint callback into a progress event.
+
+    Callbacks are JSON or form encoded and carry the node id (`node_id`,
+    `node_ip` or `hypervisor_ip`), the imaging `session`, the message
+    (`msg` or `message`) and optionally an explicit `status`. The sender
+    address is used when the callback does not name the node.
+    """
+    if not body:
+        return None
+    text = body[:MAX_CALLBACK_BYTES].decode("utf-8", "replace")
+    fields = None
+    if "json" in content_type or text.lstrip().startswith("{"):
+        try:
+            fields = json.loads(text)
+        except ValueError:
+            fields = None
+    if fields is None:
+        if "=" in text:
+            fields = {k: v[-1] for k, v in parse_qs(text).items()}
+        else:
+            fields = {"msg": text}
+    if not isinstance(fields, dict):
+        return None
+
+    node_ip = (fields.get("node_id") or fields.get("node_ip") or
+               fields.get("hypervisor_ip") or remote_ip)
+    if not node_ip:
+        return None
+    message = str(fields.get("msg") or fields.get("message") or "")
+    status = fields.get("status") or classify_message(message) or DEFAULT_STATUS
+    failed = bool(FAILURE_PATTERN.search(message))
+    return ProgressEvent(node_ip, fields.get("session"), status, message, failed)
+
+
+class TrackedNode(object):
+    __slots__ = ("node_ip", "metadata", "ctx", "session", "status", "failed",
+                 "updated_at")
+
+    def __init__(self, node_ip, metadata, ctx, session, status):
+        self.node_ip = node_ip
+        self.metadata = metadata
+        self.ctx = ctx
+        self.session = session
+        self.status = status
+        self.failed = False
+        self.updated_at = time.monotonic()
+
+
+PublishFn = Callable[[TrackedNode], Awaitable[None]]
+
+
+class ProgressTracker(object):
+    """
+    Folds pushed progress events into per-node status transitions.
+
+    Transitions only move forward through the status enum, so duplicate,
+    replayed or out-of-order callbacks are dropped without a papiea
+    round trip. Callbacks tagged with a session other than the one the
+    node is being imaged with are ignored.
+    """
+
+    def __init__(self, statuses: List[str], publish: PublishFn):
+        self._rank = {status: i for i, status in enumerate(statuses)}
+        self._publish = publish
+        self._nodes: Dict[str, TrackedNode] = {}
+        # Called with the node ip of every accepted event, including
+        # heartbeats that do not change the status
+        self.activity_listeners: List[Callable[[str], None]] = []
+
+    def track(self, node_ip, metadata, ctx, session=None, status="initial"):
+        node = TrackedNode(node_ip, metadata, ctx, session, status)
+        self._nodes[node_ip] = node
+        return node
+
+    def untrack(self, node_ip):
+        return self._nodes.pop(node_ip, None)
+
+    def get(self, node_ip) -> Optional[TrackedNode]:
+        return self._nodes.get(node_ip)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Number of in-flight nodes per status.
+        """
+        counts: Dict[str, int] = {}
+        for node in list(self._nodes.values()):
+            counts[node.status] = counts.get(node.status, 0) + 1
+        return counts
+
+    async def advance(self, node_ip, status) -> bool:
+        """
+        Moves a tracked node to `status` if that is a forward transition.
+        """
+        return await self.handle(ProgressEvent(node_ip, None, status, ""))
+
+    async def handle(self, event: ProgressEvent) -> bool:
+        """
+        Applies an event. Returns True if the node status changed.
+        """
+        node = self._nodes.get(event.node_ip)
+        if node is None:
+            logger.debug(f"Progress for untracked node {event.node_ip} ignored")
+            return False
+        if event.session and node.session and event.session != node.session:
+            logger.debug(f"Stale session {event.session} for {event.node_ip}")
+            return False
+        if node.failed:
+            return False
+        for listener in self.activity_listeners:
+            listener(node.node_ip)
+
+        changed = False
+        if event.failed:
+            node.failed = True
+            changed = True
+            logger.info(f"Imaging of {node.node_ip} failed: {event.message}")
+        rank = self._rank.get(event.status)
+        if rank is not None and rank > self._rank.get(node.status, -1):
+            node.status = event.status
+            changed = True
+        if not changed:
+            return False
+
+        node.updated_at = time.monotonic()
+        logger.debug(f"Node {node.node_ip} status -> {node.status}")
+        if node.failed or node.status == "done":
+            self.untrack(node.node_ip)
+        await self._publish(node)
+        return True
+
+
+def make_log_app(tracker: ProgressTracker) -> web.Application:
+    """
+    Builds the aiohttp application serving the log endpoint.
+    """
+    async def log_handler(request):
+        body = await request.read() or request.query_string.encode()
+        event = parse_callback(body, request.content_type, request.remote or "")
+        if event is not None:
+            await tracker.handle(event)
+        return web.Response(text="Received logs successfully")
+
+    app = web.Application(client_max_size=MAX_CALLBACK_BYTES)
+    app.router.add_route("POST", LOG_ROUTE, log_handler)
+    app.router.add_route("GET", LOG_ROUTE, log_handler)
+    return app
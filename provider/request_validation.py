@@ -0,0 +1,266 @@
+"""
+Procedure request validation.
+
+Procedure input kinds are compiled once at startup into nested check
+functions, so a malformed request is rejected at the procedure boundary
+in microseconds instead of failing in the host workflow after minutes of
+staging and a reboot. Validated image_node requests are normalized into
+an ImageNodeConfig, which gives the workflow every key it reads under the
+name it reads it by.
+"""
+import ipaddress
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+# check(value, path, errors) appends a message per problem found
+Check = Callable[[Any, str, List[str]], None]
+
+_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "object": dict,
+    "array": list,
+}
+
+
+class InvalidRequest(Exception):
+    def __init__(self, errors: List[str]):
+        super().__init__("Invalid request: " + "; ".join(errors))
+        self.errors = errors
+
+
+def _ipv4(value, path, errors):
+    try:
+        ipaddress.IPv4Address(value)
+    except ValueError:
+        errors.append(f"{path}: {value!r} is not an IPv4 address")
+
+
+def _netmask(value, path, errors):
+    # A dotted-quad with contiguous leading one bits; prefix lengths
+    # ("24") and host masks ("0.0.0.255") are rejected
+    try:
+        host_bits = ~int(ipaddress.IPv4Address(value)) & 0xFFFFFFFF
+    except ValueError:
+        host_bits = 1 << 32
+    if host_bits & (host_bits + 1):
+        errors.append(f"{path}: {value!r} is not an IPv4 netmask")
+
+
+def _uri(value, path, errors):
+    url = urlparse(value)
+    if url.scheme not in ("http", "https", "ftp", "nfs") or not url.netloc:
+        errors.append(f"{path}: {value!r} is not a http(s), ftp or nfs url")
+
+
+FORMATS: Dict[str, Check] = {
+    "ipv4": _ipv4,
+    "netmask": _netmask,
+    "uri": _uri,
+}
+
+
+def _compile_type(type_name):
+    expected = _TYPES[type_name]
+    # bool is an int subclass, but true is not a valid count
+    numeric = type_name in ("integer", "number")
+
+    def check(value, path, errors):
+        if not isinstance(value, expected) or (numeric and isinstance(value, bool)):
+            errors.append(f"{path}: expected {type_name}, got {type(value).__name__}")
+            return False
+        return True
+
+    return check
+
+
+def compile_schema(schema) -> Check:
+    """
+    Compiles an OpenAPI schema, as used by the kind files, into a check
+    function. Supports type, format, enum, required, properties and
+    items, and the `name: type` property shorthand.
+    """
+    if isinstance(schema, str):
+        schema = {"type": schema}
+    type_check = _compile_type(schema["type"]) if "type" in schema else None
+    checks: List[Check] = []
+    if "enum" in schema:
+        allowed = frozenset(schema["enum"])
+
+        def check_enum(value, path, errors):
+            if value not in allowed:
+                errors.append(f"{path}: {value!r} is not one of {sorted(allowed)}")
+
+        checks.append(check_enum)
+    if schema.get("format") in FORMATS:
+        checks.append(FORMATS[schema["format"]])
+    if "properties" in schema or "required" in schema:
+        properties = [(name, compile_schema(sub))
+                      for name, sub in (schema.get("properties") or {}).items()]
+        required = tuple(schema.get("required", ()))
+
+        def check_object(value, path, errors):
+            for name in required:
+                if name not in value:
+                    errors.append(f"{path}.{name}: required")
+            for name, check in properties:
+                if name in value:
+                    check(value[name], f"{path}.{name}", errors)
+
+        checks.append(check_object)
+    if "items" in schema:
+        item_check = compile_schema(schema["items"])
+
+        def check_items(value, path, errors):
+            for i, item in enumerate(value):
+                item_check(item, f"{path}[{i}]", errors)
+
+        checks.append(check_items)
+
+    def check(value, path, errors):
+        if type_check is not None and not type_check(value, path, errors):
+            return
+        for sub_check in checks:
+            sub_check(value, path, errors)
+
+    return check
+
+
+class Validator(object):
+    """
+    Validator of one procedure's input, compiled from its kind file.
+    """
+
+    def __init__(self, kind: Dict[str, Any]):
+        (self.name, schema), = kind.items()
+        self._check = compile_schema(schema)
+
+    def errors(self, value) -> List[str]:
+        errors: List[str] = []
+        self._check(value, self.name, errors)
+        return errors
+
+    def validate(self, value):
+        errors = self.errors(value)
+        if errors:
+            raise InvalidRequest(errors)
+        return value
+
+
+class Payload(object):
+    __slots__ = ("url", "md5sum")
+
+    def __init__(self, url: str, md5sum: Optional[str] = None):
+        self.url = url
+        self.md5sum = md5sum
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["url"], d.get("md5sum")) if d else None
+
+    def to_dict(self):
+        d = {"url": self.url}
+        if self.md5sum:
+            d["md5sum"] = self.md5sum
+        return d
+
+
+class ImageNodeConfig(object):
+    """
+    Normalized image_node request.
+    """
+    __slots__ = ("hypervisor", "hypervisor_ip", "hypervisor_netmask",
+                 "hypervisor_hostname", "cvm_ip", "cvm_netmask",
+                 "default_gateway", "arizona_url", "phoenix_mode",
+                 "phoenix_kernel", "phoenix_initrd", "phoenix_livefs",
+                 "nutanix_partition", "holo_partition", "hypervisor_iso",
+                 "nos_package", "extra")
+
+    def __init__(self, request: Dict[str, Any]):
+        request = dict(request)
+        phoenix = request.pop("phoenix")
+        partitions = request.pop("partition_table")
+        self.hypervisor = request.pop("hypervisor", "kvm")
+        self.hypervisor_ip = request.pop("hypervisor_ip")
+        self.hypervisor_netmask = request.pop("hypervisor_netmask")
+        self.hypervisor_hostname = request.pop("hypervisor_hostname")
+        self.cvm_ip = request.pop("cvm_ip")
+        self.cvm_netmask = request.pop("cvm_netmask")
+        self.default_gateway = request.pop("default_gateway")
+        self.arizona_url = request.pop("arizona_url")
+        self.phoenix_mode = phoenix["mode"].lower()
+        self.phoenix_kernel = Payload.from_dict(phoenix["kernel"])
+        self.phoenix_initrd = Payload.from_dict(phoenix["initrd"])
+        self.phoenix_livefs = Payload.from_dict(phoenix["livefs"])
+        self.nutanix_partition = partitions["nutanix"]["id"]
+        self.holo_partition = partitions["holo"]["id"]
+        self.hypervisor_iso = Payload.from_dict(request.pop("hypervisor_iso", None))
+        self.nos_package = Payload.from_dict(request.pop("nos_package", None))
+        # Optional fields the workflow passes through as given
+        self.extra = request
+
+    def check(self) -> List[str]:
+        """
+        Checks between fields the schema cannot express.
+        """
+        errors = []
+        network = ipaddress.IPv4Network(
+            f"{self.hypervisor_ip}/{self.hypervisor_netmask}", strict=False)
+        if ipaddress.IPv4Address(self.default_gateway) not in network:
+            errors.append(f"image_node.default_gateway: {self.default_gateway} "
+                          f"is not in the hypervisor network {network}")
+        if self.cvm_ip == self.hypervisor_ip:
+            errors.append("image_node.cvm_ip: same as hypervisor_ip")
+        if self.nutanix_partition == self.holo_partition:
+            errors.append("image_node.partition_table: nutanix and holo "
+                          "partitions are the same")
+        return errors
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Workflow config, with the host_* names the boot templates use.
+        """
+        d = dict(self.extra)
+        d.update({
+            "hypervisor": self.hypervisor,
+            "hypervisor_ip": self.hypervisor_ip,
+            "hypervisor_netmask": self.hypervisor_netmask,
+            "hypervisor_hostname": self.hypervisor_hostname,
+            "cvm_ip": self.cvm_ip,
+            "cvm_netmask": self.cvm_netmask,
+            "default_gateway": self.default_gateway,
+            "host_ip": self.hypervisor_ip,
+            "host_subnet_mask": self.hypervisor_netmask,
+            "default_gw": self.default_gateway,
+            "arizona_url": self.arizona_url,
+            "phoenix": {
+                "mode": self.phoenix_mode,
+                "kernel": self.phoenix_kernel.to_dict(),
+                "initrd": self.phoenix_initrd.to_dict(),
+                "livefs": self.phoenix_livefs.to_dict(),
+            },
+            "partition_table": {
+                "nutanix": {"id": self.nutanix_partition},
+                "holo": {"id": self.holo_partition},
+            },
+        })
+        for name in ("hypervisor_iso", "nos_package"):
+            payload = getattr(self, name)
+            if payload is not None:
+                d[name] = payload.to_dict()
+        return d
+
+
+def parse_image_node(validator: Validator, request) -> ImageNodeConfig:
+    """
+    Validates an image_node request and returns it normalized. Raises
+    InvalidRequest listing every problem found.
+    """
+    validator.validate(request)
+    config = ImageNodeConfig(request)
+    errors = config.check()
+    if errors:
+        raise InvalidRequest(errors)
+    return config
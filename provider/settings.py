@@ -0,0 +1,11 @@
+"""
+Provider settings shared by the provider and its command line tools.
+
+Kept free of side effects: importing main.py configures logging and the
+provider's global state, which the tools must not pick up.
+"""
+import os
+
+PAPIEA_URL = os.getenv("PAPIEA_URL", "http://127.0.0.1:3333")
+PROVIDER_PREFIX = "griffon"
+PROVIDER_VERSION = "0.1.0"
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# End-to-end imaging benchmark against local stand-ins.
+#
+# A child process serves the stand-ins: simulated SSH nodes (see
+# node_simulator.py) and an HTTP artifact server. This process drives the
+# workflow entry points against them, so the CPU time measured here is the
+# provider side only. Reports p50/p95/p99 latency per entry point and per
+# checkpointed step, SSH connections opened, bytes moved and CPU per node,
+# and compares the results with a stored JSON baseline.
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+  raise SystemExit("The benchmark requires python 3.7+")
+
+PROVIDER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(PROVIDER_DIR, "bench_baseline.json")
+PAYLOAD_SIZE = 4 * 1024 * 1024
+REGRESSION_THRESHOLD = 0.20
+PERCENTILES = (50, 95, 99)
+
+
+class _CountingHandler(SimpleHTTPRequestHandler):
+  bytes_sent = 0
+  lock = threading.Lock()
+
+  def copyfile(self, source, outputfile):
+    data = source.read()
+    outputfile.write(data)
+    with _CountingHandler.lock:
+      _CountingHandler.bytes_sent += len(data)
+
+  def log_message(self, *args):
+    pass
+
+
+def _serve_standins(conn, options):
+  """
+  Child process: runs the node farms and the artifact server until asked
+  for their statistics.
+  """
+  from node_simulator import NodeFarm
+  logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+  artifacts = tempfile.mkdtemp(prefix="griffon-bench-")
+  for name in ("kernel", "initrd"):
+    with open(os.path.join(artifacts, name), "wb") as f:
+      f.write(os.urandom(options["payload_size"]))
+  with open(os.path.join(artifacts, "arizona.conf"), "w") as f:
+    json.dump({"host_ip": options["base_ip"], "host_subnet_mask": "255.0.0.0",
+               "default_gw": "127.0.0.1"}, f)
+  httpd = ThreadingHTTPServer(
+    ("127.0.0.1", 0), functools.partial(_CountingHandler, directory=artifacts))
+  thread = threading.Thread(target=httpd.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  node_kwargs = dict(boot_delay=options["boot_delay"],
+                     boot_jitter=options["boot_jitter"],
+                     command_latency=options["command_latency"])
+  farms = [NodeFarm(options["nodes"], base_ip=options["base_ip"],
+                    port=options["port"], os_type="centos", **node_kwargs),
+           NodeFarm(options["nodes"], base_ip=options["ahv_base_ip"],
+                    port=options["port"], os_type="ahv", **node_kwargs)]
+  for farm in farms:
+    farm.start()
+  conn.send({"http_port": httpd.server_address[1],
+             "centos": farms[0].ips(), "ahv": farms[1].ips()})
+  conn.recv()
+  nodes = [n for farm in farms for n in farm.nodes.values()]
+  conn.send({
+    "connections": sum(farm.connections for farm in farms),
+    "scp_bytes": sum(n.bytes_received for n in nodes),
+    "http_bytes": _CountingHandler.bytes_sent,
+    "commands": sum(n.commands for n in nodes),
+    "reboots": sum(n.reboots for n in nodes),
+  })
+  httpd.shutdown()
+  for farm in farms:
+    farm.stop()
+
+
+class _Options(object):
+  def __init__(self, node_ip):
+    self.node_ip = node_ip
+    self.config = None
+
+
+def percentile(values, pct):
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  rank = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+  return ordered[min(rank, len(ordered) - 1)]
+
+
+class Recorder(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.samples = {}
+    self.failures = {}
+
+  def add(self, step, seconds, ok=True):
+    with self.lock:
+      self.samples.setdefault(step, []).append(seconds)
+      if not ok:
+        self.failures[step] = self.failures.get(step, 0) + 1
+
+  @contextlib.contextmanager
+  def timed(self, step):
+    start = time.time()
+    result = {"ok": True}
+    try:
+      yield result
+    except Exception:
+      result["ok"] = False
+      raise
+    finally:
+      self.add(step, time.time() - start, result["ok"])
+
+  def summary(self):
+    steps = {}
+    for step, values in sorted(self.samples.items()):
+      steps[step] = dict(("p%d" % p, round(percentile(values, p), 4))
+                         for p in PERCENTILES)
+      steps[step]["count"] = len(values)
+      steps[step]["failures"] = self.failures.get(step, 0)
+    return steps
+
+
+def _timing_job(recorder):
+  """
+  A job that records the time between its checkpoints as step latency.
+  """
+  from job_store import Job
+
+  class TimingJob(Job):
+    def __init__(self):
+      super(TimingJob, self).__init__()
+      self.last = time.time()
+
+    def checkpoint(self, step, **outputs):
+      now = time.time()
+      recorder.add("step:%s" % step.split(":")[-1], now - self.last)
+      self.last = now
+      super(TimingJob, self).checkpoint(step, **outputs)
+
+  return TimingJob()
+
+
+def _image_node(ip, config, recorder):
+  from remote_host import RemoteHost
+  from griffon_log import log_context
+  from tracing import job_span
+  with job_span("image_node", node_ip=ip), log_context(node_ip=ip):
+    with recorder.timed("detect_os") as r:
+      r["ok"] = bool(RemoteHost._detect_remote_os_type(ip))
+    host = RemoteHost.get_instance(_Options(ip))
+    host.job = _timing_job(recorder)
+    with recorder.timed("stage_phoenix") as r:
+      r["ok"], _ = host.stage_phoenix(config)
+    host.job.last = time.time()
+    with recorder.timed("reboot_to_target") as r:
+      r["ok"], _ = host.reboot_to_target("phoenix", config)
+    recorder.add("step:boot_wait", time.time() - host.job.last)
+
+
+def _sanitize_node(ip, config, recorder):
+  from remote_host import RemoteHost
+  from griffon_log import log_context
+  from tracing import job_span
+  options = _Options(ip)
+  with job_span("sanitize_node", node_ip=ip), log_context(node_ip=ip):
+    host = RemoteHost.get_instance(options)
+    host.job = _timing_job(recorder)
+    with recorder.timed("sanitize_node") as r:
+      r["ok"], _ = host.sanitize_node(options, config)
+
+
+def run(args):
+  os.environ["GRIFFON_SSH_PORT"] = str(args.port)
+  # Boot deadlines and polling would otherwise depend on earlier runs
+  os.environ["GRIFFON_STEP_HISTORY_DB"] = os.path.join(
+    tempfile.mkdtemp(prefix="griffon-bench-history-"), "history.db")
+  os.chdir(PROVIDER_DIR)
+  sys.path.insert(0, os.path.join(PROVIDER_DIR, "src"))
+  import griffon_log
+  import linux_host
+  import remote_host
+  import tracing
+  tracing.TRACER.enabled = bool(args.trace)
+  remote_host.SSH_PORT = args.port
+  remote_host.CHECK_INTERVAL_S = args.check_interval
+  linux_host.STAGING_DIR = tempfile.mkdtemp(prefix="griffon-bench-staging-")
+  griffon_log.setup(log_dir=tempfile.mkdtemp(prefix="griffon-bench-logs-"))
+  logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+  parent, child = multiprocessing.Pipe()
+  standins = multiprocessing.Process(target=_serve_standins, args=(child, {
+    "nodes": args.nodes, "port": args.port, "base_ip": "127.2.0.1",
+    "ahv_base_ip": "127.3.0.1", "boot_delay": args.boot_delay,
+    "boot_jitter": args.boot_jitter, "command_latency": args.command_latency,
+    "payload_size": args.payload_size}))
+  standins.daemon = True
+  standins.start()
+  info = parent.recv()
+  url = "http://127.0.0.1:%d" % info["http_port"]
+  config = {
+    "phoenix": {"kernel": {"url": url + "/kernel"},
+                "initrd": {"url": url + "/initrd"},
+                "livefs": {"url": url + "/livefs"},
+                "mode": "INSTALLER"},
+    "arizona_url": url + "/arizona.conf",
+    "partition_table": {"nutanix": {"id": 4}, "holo": {"id": 3}},
+  }
+
+  recorder = Recorder()
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.time()
+  quiet = io.StringIO()
+  with contextlib.redirect_stdout(quiet), \
+      ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+    jobs = [pool.submit(_image_node, ip, config, recorder)
+            for ip in info["centos"]]
+    jobs += [pool.submit(_sanitize_node, ip, config, recorder)
+             for ip in info["ahv"]]
+    errors = [str(job.exception()) for job in jobs if job.exception()]
+    griffon_log.shutdown()
+  wall = time.time() - start
+  end_usage = resource.getrusage(resource.RUSAGE_SELF)
+  cpu = (end_usage.ru_utime - usage.ru_utime) + \
+        (end_usage.ru_stime - usage.ru_stime)
+
+  parent.send("stats")
+  stats = parent.recv()
+  standins.join()
+
+  nodes = 2 * args.nodes
+  return {
+    "commit": _git_commit(),
+    "nodes": nodes,
+    "concurrency": args.concurrency,
+    "wall_s": round(wall, 3),
+    "nodes_per_min": round(60.0 * nodes / wall, 2) if wall else 0,
+    "cpu_s_per_node": round(cpu / nodes, 4),
+    "connections": stats["connections"],
+    "connections_per_node": round(float(stats["connections"]) / nodes, 2),
+    "commands": stats["commands"],
+    "reboots": stats["reboots"],
+    "http_bytes": stats["http_bytes"],
+    "scp_bytes": stats["scp_bytes"],
+    "bytes_per_node": (stats["http_bytes"] + stats["scp_bytes"]) // nodes,
+    "errors": errors,
+    "steps": recorder.summary(),
+  }
+
+
+def _git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                   cwd=PROVIDER_DIR).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return ""
+
+
+def compare(result, baseline, threshold=REGRESSION_THRESHOLD):
+  """
+  Returns regressions of the per-step p95 latency and the per-node
+  resource figures against the baseline.
+  """
+  regressions = []
+  for step, figures in result["steps"].items():
+    old = baseline.get("steps", {}).get(step)
+    if old and old["p95"] > 0 and figures["p95"] > old["p95"] * (1 + threshold):
+      regressions.append("%s p95 %.3fs -> %.3fs" % (step, old["p95"],
+                                                    figures["p95"]))
+  for key in ("cpu_s_per_node", "connections_per_node", "bytes_per_node"):
+    old = baseline.get(key)
+    if old and result[key] > old * (1 + threshold):
+      regressions.append("%s %s -> %s" % (key, old, result[key]))
+  return regressions
+
+
+def report(result):
+  print("Benchmark @%s: %d nodes, concurrency %d, %.1fs wall, "
+        "%.1f nodes/min" % (result["commit"], result["nodes"],
+                            result["concurrency"], result["wall_s"],
+                            result["nodes_per_min"]))
+  print("%-28s %8s %8s %8s %6s %6s" % ("step", "p50", "p95", "p99", "n",
+                                       "fail"))
+  for step, figures in result["steps"].items():
+    print("%-28s %8.3f %8.3f %8.3f %6d %6d" % (
+      step, figures["p50"], figures["p95"], figures["p99"],
+      figures["count"], figures["failures"]))
+  print("per node: %.4fs cpu, %.2f ssh connections, %d bytes moved" % (
+    result["cpu_s_per_node"], result["connections_per_node"],
+    result["bytes_per_node"]))
+  for error in result["errors"]:
+    print("error: %s" % error)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="End-to-end imaging "
+                                               "benchmark")
+  parser.add_argument("-n", "--nodes", type=int, default=20,
+                      help="Simulated nodes per workflow")
+  parser.add_argument("-c", "--concurrency", type=int, default=32)
+  parser.add_argument("--port", type=int, default=2222)
+  parser.add_argument("--boot-delay", type=float, default=1.0)
+  parser.add_argument("--boot-jitter", type=float, default=0.5)
+  parser.add_argument("--command-latency", type=float, default=0.0)
+  parser.add_argument("--check-interval", type=float, default=0.5,
+                      help="Boot wait poll interval")
+  parser.add_argument("--payload-size", type=int, default=PAYLOAD_SIZE)
+  parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+  parser.add_argument("--save-baseline", action="store_true",
+                      help="Store this run as the new baseline")
+  parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+  parser.add_argument("--json", help="Also write the results to this file")
+  parser.add_argument("--trace", help="Write spans to this file (.json: "
+                                      "Chrome trace, .otlp: OTLP/JSON)")
+  args = parser.parse_args()
+
+  result = run(args)
+  report(result)
+  if args.trace:
+    import tracing
+    tracing.TRACER.export(args.trace)
+    print("Trace written to %s" % args.trace)
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(result, f, indent=2, sort_keys=True)
+  if args.save_baseline:
+    with open(args.baseline, "w") as f:
+      json.dump(result, f, indent=2, sort_keys=True)
+    print("Baseline saved to %s" % args.baseline)
+    return
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(result, baseline, args.threshold)
+    for regression in regressions:
+      print("REGRESSION vs %s: %s" % (baseline.get("commit"), regression))
+    if regressions:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Cooperative cancellation of host workflows.
+#
+# A CancelToken is bound to the thread running a workflow. Wait loops
+# sleep on it, downloads check it between chunks, and ssh commands and
+# copies close their connection when it is cancelled, so a cancelled
+# workflow unwinds within seconds with a Cancelled exception and gives
+# back its worker, ssh slot and connections.
+#
+# Cancelled derives from BaseException, like asyncio.CancelledError, so
+# the `except Exception` handlers that turn errors into (ok, err) results
+# let it through.
+#
+#   token = CancelToken()
+#   with bound(token):
+#     run_workflow()        # raises Cancelled once token.cancel() is called
+
+import contextlib
+import threading
+
+
+class Cancelled(BaseException):
+  pass
+
+
+class CancelToken(object):
+  """
+  Cancellation flag with callbacks. A child token is cancelled with its
+  parent.
+  """
+  def __init__(self, parent=None):
+    self.reason = ""
+    self._event = threading.Event()
+    self._lock = threading.Lock()
+    self._callbacks = {}
+    self._next_id = 0
+    self._detach = lambda: None
+    if parent is not None:
+      self._detach = parent.on_cancel(lambda: self.cancel(parent.reason))
+
+  def detach(self):
+    """
+    Stops following the parent, for short-lived children of a long-lived
+    token.
+    """
+    self._detach()
+
+  @property
+  def cancelled(self):
+    return self._event.is_set()
+
+  def check(self):
+    """
+    Raises Cancelled if the token was cancelled.
+    """
+    if self._event.is_set():
+      raise Cancelled(self.reason or "cancelled")
+
+  def cancel(self, reason=""):
+    with self._lock:
+      if self._event.is_set():
+        return
+      self.reason = reason
+      self._event.set()
+      callbacks, self._callbacks = list(self._callbacks.values()), {}
+    for callback in callbacks:
+      try:
+        callback()
+      except Exception:
+        pass
+
+  def on_cancel(self, callback):
+    """
+    Calls callback once the token is cancelled, right away if it already
+    is. Returns a function that unregisters it.
+    """
+    with self._lock:
+      if not self._event.is_set():
+        callback_id = self._next_id
+        self._next_id += 1
+        self._callbacks[callback_id] = callback
+        return lambda: self._remove(callback_id)
+    callback()
+    return lambda: None
+
+  def _remove(self, callback_id):
+    with self._lock:
+      self._callbacks.pop(callback_id, None)
+
+  def sleep(self, seconds):
+    """
+    time.sleep that raises Cancelled as soon as the token is cancelled.
+    """
+    if self._event.wait(seconds):
+      self.check()
+
+  @contextlib.contextmanager
+  def interrupting(self, interrupt):
+    """
+    Calls interrupt() if the token is cancelled while the block runs,
+    e.g. to close the connection a blocking call waits on. Raises
+    Cancelled when the block ends on a cancelled token.
+    """
+    remove = self.on_cancel(interrupt)
+    try:
+      yield
+    finally:
+      remove()
+      self.check()
+
+
+class _Never(CancelToken):
+  def cancel(self, reason=""):
+    raise ValueError("NEVER cannot be cancelled")
+
+  def on_cancel(self, callback):
+    return lambda: None
+
+
+# Token of threads that run outside of any cancellable workflow
+NEVER = _Never()
+_local = threading.local()
+
+
+def current():
+  """
+  The token bound to this thread.
+  """
+  return getattr(_local, "token", NEVER)
+
+
+@contextlib.contextmanager
+def bound(token):
+  """
+  Binds token to this thread for the block.
+  """
+  previous = current()
+  _local.token = token
+  try:
+    yield token
+  finally:
+    _local.token = previous
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Runs a command or probe across many nodes in parallel.
+#
+# Example:
+#   python fanout.py --nodes 10.1.1.10-10.1.1.250 -- test -f /usr/bin/layout_finder.py
+#   python fanout.py --nodes nodes.txt -p 128 -t 20 -- blkid
+
+import argparse
+import itertools
+import socket
+import struct
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from griffon_log import log_context
+from remote_host import RemoteHost
+from steps import quote
+
+# Connects beyond SSH_SEMA's value queue on it, so there is little point
+# in running more nodes at once by default
+DEFAULT_PARALLELISM = 32
+DEFAULT_TIMEOUT_S = 30
+
+
+class NodeResult(object):
+  __slots__ = ("ip", "out", "err", "exit_status", "duration")
+
+  def __init__(self, ip, out, err, exit_status, duration):
+    self.ip = ip
+    self.out = out
+    self.err = err
+    self.exit_status = exit_status
+    self.duration = duration
+
+  @property
+  def ok(self):
+    return self.exit_status == 0
+
+  def __repr__(self):
+    return "NodeResult(%s, exit=%s, %.2fs)" % (self.ip, self.exit_status,
+                                               self.duration)
+
+
+def _run(ip, command, timeout, user):
+  if callable(command):
+    command = command(ip)
+  start = time.time()
+  with log_context(node_ip=ip):
+    out, err, ret = RemoteHost._ssh(ip, command, throw_on_error=False,
+                                    log_on_error=False, user=user,
+                                    timeout=timeout)
+  return NodeResult(ip, out, err, ret, time.time() - start)
+
+
+def run_on_nodes(ips, command, parallelism=DEFAULT_PARALLELISM,
+                 timeout=DEFAULT_TIMEOUT_S, user="root"):
+  """
+  Runs command on every node, at most `parallelism` at a time, and yields
+  a NodeResult per node as soon as it completes.
+
+  command: Command list, or a callable returning the command list for a
+           node ip for per-node commands.
+  timeout: Per node limit on connecting and on running the command. A
+           node that does not answer in time yields exit_status -1.
+  """
+  ips = iter(ips)
+  with ThreadPoolExecutor(max_workers=parallelism) as pool:
+    running = set(pool.submit(_run, ip, command, timeout, user)
+                  for ip in itertools.islice(ips, parallelism))
+    while running:
+      done, running = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        for ip in itertools.islice(ips, 1):
+          running.add(pool.submit(_run, ip, command, timeout, user))
+        yield future.result()
+
+
+def probe(ips, check, **kwargs):
+  """
+  Evaluates a shell condition on every node. Returns {ip: True/False},
+  None for nodes that could not be reached.
+  """
+  states = {}
+  for result in run_on_nodes(ips, ["sh", "-c", quote(check)], **kwargs):
+    if result.exit_status == -1:
+      states[result.ip] = None
+    else:
+      states[result.ip] = result.ok
+  return states
+
+
+def aggregate(results):
+  """
+  Groups results with the same exit status and output. Returns a list of
+  ((exit_status, out, err), [ips]), largest group first.
+  """
+  groups = {}
+  for result in results:
+    key = (result.exit_status, result.out.strip(), result.err.strip())
+    groups.setdefault(key, []).append(result.ip)
+  return sorted(groups.items(), key=lambda item: (-len(item[1]), item[0]))
+
+
+def expand_nodes(spec):
+  """
+  Node ips from a file (one per line), a comma separated list or
+  first-last ranges.
+  """
+  try:
+    with open(spec) as f:
+      items = f.read().split()
+  except IOError:
+    items = spec.split(",")
+  ips = []
+  for item in items:
+    if "-" in item:
+      first, last = [struct.unpack("!I", socket.inet_aton(ip))[0]
+                     for ip in item.split("-", 1)]
+      ips.extend(socket.inet_ntoa(struct.pack("!I", n))
+                 for n in range(first, last + 1))
+    elif item:
+      ips.append(item)
+  return ips
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run a command on many nodes")
+  parser.add_argument("--nodes", required=True,
+                      help="File of node ips, comma separated ips or "
+                           "first-last ranges")
+  parser.add_argument("-p", "--parallelism", type=int,
+                      default=DEFAULT_PARALLELISM)
+  parser.add_argument("-t", "--timeout", type=int, default=DEFAULT_TIMEOUT_S,
+                      help="Per node timeout in seconds")
+  parser.add_argument("--user", default="root")
+  parser.add_argument("-v", "--verbose", action="store_true",
+                      help="Print each node's result as it completes")
+  parser.add_argument("command", nargs=argparse.REMAINDER)
+  args = parser.parse_args()
+  command = args.command[1:] if args.command[:1] == ["--"] else args.command
+  if not command:
+    parser.error("no command given")
+
+  ips = expand_nodes(args.nodes)
+  results = []
+  start = time.time()
+  for result in run_on_nodes(ips, command, args.parallelism, args.timeout,
+                             args.user):
+    results.append(result)
+    if args.verbose:
+      print("[%s] exit %s in %.2fs" % (result.ip, result.exit_status,
+                                       result.duration))
+  for (exit_status, out, err), group in aggregate(results):
+    print("==== %d node(s), exit %s: %s" % (len(group), exit_status,
+                                            " ".join(sorted(group))))
+    if out:
+      print(out)
+    if err:
+      print("stderr: %s" % err)
+  print("%d nodes in %.1fs" % (len(results), time.time() - start))
+  sys.exit(0 if all(result.ok for result in results) else 1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Queue-based logging for the host workflows.
+#
+# Worker threads only put records on a queue; a single listener thread
+# formats them and writes the console and per-node log files, so workers
+# never block on stdout or disk. Records carry the node_ip, session and
+# step of the job context they were logged in, messages are formatted
+# lazily from their arguments, and repeats of a noisy message are rate
+# limited per node on the console. The per-node files get every record.
+
+import atexit
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from metrics import REGISTRY
+
+LOG_DIR = os.environ.get("GRIFFON_LOG_DIR", "logs")
+LOG_LEVEL = os.environ.get("GRIFFON_LOG_LEVEL", "INFO").upper()
+CONSOLE_FORMAT = "%(message)s"
+FILE_FORMAT = ("%(asctime)s %(levelname)s [%(session)s %(step)s] "
+               "%(message)s")
+CONTEXT_FIELDS = ("node_ip", "session", "step")
+QUEUE_SIZE = 100000
+MAX_OPEN_FILES = 256
+# Per node and message on the console: burst allowed, then one per interval
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_INTERVAL_S = 30
+RATE_LIMIT_KEYS = 10000
+
+DROPPED = REGISTRY.counter(
+  "griffon_log_dropped", "Log records dropped on a full queue")
+SUPPRESSED = REGISTRY.counter(
+  "griffon_log_suppressed", "Log records dropped by rate limiting")
+
+_context = threading.local()
+
+
+class log_context(object):
+  """
+  Context manager adding node_ip/session/step to records logged by the
+  current thread. Nested contexts override the fields they set.
+  """
+  def __init__(self, **fields):
+    self.fields = fields
+
+  def __enter__(self):
+    current = getattr(_context, "fields", {})
+    self.saved = current
+    merged = dict(current)
+    merged.update((k, v) for k, v in self.fields.items() if v is not None)
+    _context.fields = merged
+    return self
+
+  def __exit__(self, *args):
+    _context.fields = self.saved
+    return False
+
+
+def current_context():
+  return getattr(_context, "fields", {})
+
+
+class ContextFilter(logging.Filter):
+  """
+  Stamps records with the logging thread's job context. Runs in the
+  logging thread, before the record is queued.
+  """
+  def filter(self, record):
+    fields = current_context()
+    for name in CONTEXT_FIELDS:
+      if not hasattr(record, name):
+        setattr(record, name, fields.get(name, "-"))
+    return True
+
+
+class RateLimitFilter(logging.Filter):
+  """
+  Drops repeats of the same message from the same node beyond a burst,
+  letting one through per interval with the suppressed count. Runs in the
+  listener, on the console handler only.
+  """
+  def __init__(self, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL_S):
+    super(RateLimitFilter, self).__init__()
+    self.burst = burst
+    self.interval = interval
+    self._seen = {}
+    self._lock = threading.Lock()
+
+  def filter(self, record):
+    if record.levelno >= logging.WARNING:
+      return True
+    key = (record.node_ip, record.getMessage())
+    now = time.time()
+    with self._lock:
+      if key not in self._seen and len(self._seen) >= RATE_LIMIT_KEYS:
+        self._seen.clear()
+      window, count, suppressed = self._seen.get(key, (now, 0, 0))
+      if now - window >= self.interval:
+        window, count = now, 0
+      count += 1
+      if count > self.burst:
+        self._seen[key] = (window, count, suppressed + 1)
+        SUPPRESSED.inc()
+        return False
+      self._seen[key] = (window, count, 0)
+    record.suppressed = suppressed
+    return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+  """
+  Queues records unformatted, so the message is only built by the
+  listener, and drops them rather than block when the queue is full.
+  """
+  def prepare(self, record):
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      DROPPED.inc()
+
+
+class _ConsoleHandler(logging.StreamHandler):
+  """
+  Writes to whatever sys.stdout is when the record is emitted.
+  """
+  def __init__(self):
+    super(_ConsoleHandler, self).__init__(sys.stdout)
+
+  @property
+  def stream(self):
+    return sys.stdout
+
+  @stream.setter
+  def stream(self, value):
+    pass
+
+
+class NodeFileHandler(logging.Handler):
+  """
+  Appends records to <log_dir>/<node_ip>.log, keeping the most recently
+  used files open.
+  """
+  def __init__(self, log_dir, max_open=MAX_OPEN_FILES):
+    super(NodeFileHandler, self).__init__()
+    self.log_dir = log_dir
+    self.max_open = max_open
+    self._files = OrderedDict()
+
+  def _handler(self, node_ip):
+    handler = self._files.pop(node_ip, None)
+    if handler is None:
+      if not os.path.isdir(self.log_dir):
+        os.makedirs(self.log_dir)
+      handler = logging.FileHandler(
+        os.path.join(self.log_dir, "%s.log" % node_ip))
+      handler.setFormatter(self.formatter)
+      if len(self._files) >= self.max_open:
+        self._files.popitem(last=False)[1].close()
+    self._files[node_ip] = handler
+    return handler
+
+  def emit(self, record):
+    if record.node_ip == "-":
+      return
+    try:
+      self._handler(record.node_ip).emit(record)
+    except Exception:
+      self.handleError(record)
+
+  def close(self):
+    for handler in self._files.values():
+      handler.close()
+    self._files.clear()
+    super(NodeFileHandler, self).close()
+
+
+class _Formatter(logging.Formatter):
+  def __init__(self, fmt, node_prefix=False, show_suppressed=False):
+    super(_Formatter, self).__init__(fmt)
+    self.node_prefix = node_prefix
+    self.show_suppressed = show_suppressed
+
+  def format(self, record):
+    text = super(_Formatter, self).format(record)
+    if self.show_suppressed and getattr(record, "suppressed", 0):
+      text += " (%d similar messages suppressed)" % record.suppressed
+    if self.node_prefix and record.node_ip != "-":
+      text = "[%s] %s" % (record.node_ip, text)
+    return text
+
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+def _start(level, log_dir, console):
+  global _listener
+  if _listener is None:
+    atexit.register(shutdown)
+  else:
+    _stop()
+  handlers = []
+  if console:
+    handler = _ConsoleHandler()
+    handler.setFormatter(_Formatter(CONSOLE_FORMAT, node_prefix=True,
+                                    show_suppressed=True))
+    handler.addFilter(RateLimitFilter())
+    handlers.append(handler)
+  if log_dir:
+    handler = NodeFileHandler(log_dir)
+    handler.setFormatter(_Formatter(FILE_FORMAT))
+    handlers.append(handler)
+  records = queue.Queue(QUEUE_SIZE)
+  queue_handler = _QueueHandler(records)
+  queue_handler.addFilter(ContextFilter())
+
+  logger = logging.getLogger("griffon")
+  logger.handlers = [queue_handler]
+  logger.setLevel(level)
+  logger.propagate = False
+  _listener = logging.handlers.QueueListener(records, *handlers)
+  _listener.start()
+
+
+def _stop():
+  _listener.stop()
+  for handler in _listener.handlers:
+    handler.close()
+
+
+def setup(level=LOG_LEVEL, log_dir=LOG_DIR, console=True):
+  """
+  Routes the "griffon" logger through the queue. Called on first use with
+  the GRIFFON_LOG_* defaults; call it explicitly to override them.
+  """
+  with _setup_lock:
+    _start(level, log_dir, console)
+  return logging.getLogger("griffon")
+
+
+def shutdown():
+  """
+  Writes out queued records and stops the listener.
+  """
+  global _listener
+  with _setup_lock:
+    if _listener is not None:
+      _stop()
+      _listener = None
+
+
+def get_logger():
+  if _listener is None:
+    with _setup_lock:
+      if _listener is None:
+        _start(LOG_LEVEL, LOG_DIR, True)
+  return logging.getLogger("griffon")
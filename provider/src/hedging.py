@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Hedged requests for SSH connects and artifact downloads.
+#
+# Most connects and downloads finish close to their usual time, but a few
+# stall until they time out and set the imaging time of the whole batch.
+# A Hedger runs an operation and, once it has been running for longer
+# than the operation's observed p95, starts a second attempt next to it.
+# Whichever succeeds first is used and the other one is cancelled.
+#
+# Hedges draw from a budget that grows by GRIFFON_HEDGE_BUDGET (default
+# 0.1) per request, so hedging adds at most that fraction of extra load
+# even when everything is slow.
+
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import cancellation
+import tracing
+from cancellation import CancelToken, Cancelled
+from metrics import REGISTRY
+from step_history import percentile
+
+HEDGE_BUDGET = float(os.environ.get("GRIFFON_HEDGE_BUDGET", "0.1"))
+# Hedges that can be saved up while requests are fast
+MAX_HEDGE_TOKENS = 10
+HEDGE_PERCENTILE = 95
+# Latencies kept per operation key
+MAX_SAMPLES = 500
+# Samples needed before an operation is hedged
+MIN_SAMPLES = 20
+
+HEDGES = REGISTRY.counter(
+  "griffon_hedged_requests", "Slow requests by winning attempt, or no_budget",
+  ["op", "result"])
+
+
+class Attempt(CancelToken):
+  """
+  One attempt of a hedged operation, cancelled when the other attempt
+  won or when the caller's token is cancelled. Operations check it, or
+  register callbacks that interrupt blocking calls, to stop early.
+  """
+  def __init__(self, index, parent=None):
+    super(Attempt, self).__init__(parent)
+    self.index = index
+
+
+class HedgeBudget(object):
+  """
+  Token bucket of hedges: every request adds fraction of a token, every
+  hedge takes a whole one.
+  """
+  def __init__(self, fraction=HEDGE_BUDGET, max_tokens=MAX_HEDGE_TOKENS):
+    self.fraction = fraction
+    self.max_tokens = max_tokens
+    self._tokens = 0.0
+    self._lock = threading.Lock()
+
+  def request(self):
+    with self._lock:
+      self._tokens = min(self.max_tokens, self._tokens + self.fraction)
+
+  def try_hedge(self):
+    with self._lock:
+      if self._tokens < 1:
+        return False
+      self._tokens -= 1
+      return True
+
+
+class Hedger(object):
+  def __init__(self, op, budget=None, min_samples=MIN_SAMPLES):
+    self.op = op
+    self.budget = budget or HedgeBudget()
+    self.min_samples = min_samples
+    self._lock = threading.Lock()
+    self._samples = {}
+
+  def record(self, key, seconds):
+    with self._lock:
+      self._samples.setdefault(key, deque(maxlen=MAX_SAMPLES)).append(seconds)
+
+  def hedge_delay(self, key):
+    """
+    Seconds after which a request for key is hedged, None while there
+    are too few samples to tell slow from usual.
+    """
+    with self._lock:
+      samples = self._samples.get(key)
+      if not samples or len(samples) < self.min_samples:
+        return None
+      ordered = sorted(samples)
+    return percentile(ordered, HEDGE_PERCENTILE)
+
+  def run(self, key, operation, discard=None):
+    """
+    Returns operation(attempt), hedged with a second attempt if the first
+    one takes longer than usual. A result that comes in after the winner
+    is passed to discard. Raises the first attempt's error if all fail.
+    Attempts are cancelled with the calling thread's token. The first
+    attempt runs in the calling thread, a thread is only started for a
+    hedge.
+    """
+    self.budget.request()
+    delay = self.hedge_delay(key)
+    start = time.time()
+    outcomes = queue.Queue()
+    lock = threading.Lock()
+    winner = []
+    primary_done = []
+    parent = cancellation.current()
+    primary = Attempt(0, parent)
+    attempts = [primary]
+    # Spans of the hedge nest under the caller's, e.g. the job's
+    parent_span = tracing.TRACER.current()
+
+    def run_hedge(attempt):
+      try:
+        with cancellation.bound(attempt), \
+            tracing.TRACER.attached(parent_span):
+          result = operation(attempt)
+      except (Exception, Cancelled) as e:
+        outcomes.put((False, e))
+        return
+      finally:
+        attempt.detach()
+      with lock:
+        late = bool(winner)
+        if not late:
+          winner.append(attempt)
+      if late:
+        if discard:
+          discard(result)
+        return
+      primary.cancel()
+      outcomes.put((True, result))
+
+    def hedge():
+      with lock:
+        if primary_done:
+          return
+        if not self.budget.try_hedge():
+          HEDGES.labels(self.op, "no_budget").inc()
+          return
+        attempt = Attempt(len(attempts), parent)
+        attempts.append(attempt)
+      thread = threading.Thread(target=run_hedge, args=(attempt,),
+                                name="hedge-%s-%d" % (self.op, attempt.index))
+      thread.daemon = True
+      thread.start()
+
+    cancel_hedge = TIMERS.call_later(delay, hedge) if delay is not None else None
+    error = None
+    try:
+      with cancellation.bound(primary):
+        result = operation(primary)
+    except (Exception, Cancelled) as e:
+      error = e
+    finally:
+      primary.detach()
+      if cancel_hedge:
+        cancel_hedge()
+    with lock:
+      primary_done.append(True)
+      hedged = len(attempts) > 1
+      won = error is None and not winner
+      if won:
+        winner.append(primary)
+
+    if won:
+      for other in attempts[1:]:
+        other.cancel()
+      self.record(key, time.time() - start)
+      if hedged:
+        HEDGES.labels(self.op, "primary").inc()
+      return result
+    if error is None and discard:
+      discard(result)
+    if not hedged:
+      raise error
+    ok, value = outcomes.get()
+    if not ok:
+      raise error if error is not None else value
+    self.record(key, time.time() - start)
+    HEDGES.labels(self.op, "hedge").inc()
+    return value
+
+
+class _Timers(object):
+  """
+  Single thread calling functions after a delay, so the first attempts of
+  requests do not need a thread each to be hedged.
+  """
+  def __init__(self):
+    self._heap = []
+    self._seq = itertools.count()
+    self._cond = threading.Condition()
+    self._thread = None
+
+  def call_later(self, delay, fn):
+    """
+    Calls fn after delay seconds. Returns a function that cancels the call.
+    """
+    entry = [time.time() + delay, next(self._seq), fn]
+    with self._cond:
+      heapq.heappush(self._heap, entry)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, name="hedge-timers")
+        self._thread.daemon = True
+        self._thread.start()
+      self._cond.notify()
+
+    def cancel():
+      entry[2] = None
+    return cancel
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._heap or self._heap[0][0] > time.time():
+          self._cond.wait(self._heap[0][0] - time.time() if self._heap
+                          else None)
+        _, _, fn = heapq.heappop(self._heap)
+      if fn is not None:
+        try:
+          fn()
+        except Exception:
+          pass
+
+
+TIMERS = _Timers()
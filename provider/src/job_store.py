@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Durable store of imaging jobs and their step checkpoints.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+JOB_DB_PATH = os.environ.get("GRIFFON_JOB_DB", "griffon_jobs.db")
+SQLITE_BUSY_TIMEOUT_S = 30
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_SUPERSEDED = "superseded"
+
+# Config fields holding credentials, e.g. bmc.password, are never logged or
+# written to the job database
+SECRET_FIELDS = ("password", "secret", "token")
+REDACTED = "********"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  job_id TEXT PRIMARY KEY,
+  node_ip TEXT NOT NULL,
+  workflow TEXT NOT NULL,
+  config_hash TEXT NOT NULL,
+  config TEXT NOT NULL,
+  state TEXT NOT NULL,
+  error TEXT,
+  created_at REAL NOT NULL,
+  updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_node ON jobs (node_ip, workflow, state);
+CREATE TABLE IF NOT EXISTS checkpoints (
+  job_id TEXT NOT NULL,
+  step TEXT NOT NULL,
+  seq INTEGER NOT NULL,
+  outputs TEXT NOT NULL,
+  completed_at REAL NOT NULL,
+  PRIMARY KEY (job_id, step)
+);
+"""
+
+
+def config_hash(config):
+  return hashlib.sha256(
+    json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def redact(config):
+  """
+  Copy of a config with the values of credential fields masked.
+  """
+  if isinstance(config, dict):
+    return dict((k, REDACTED if any(f in k.lower() for f in SECRET_FIELDS)
+                 else redact(v)) for k, v in config.items())
+  if isinstance(config, list):
+    return [redact(v) for v in config]
+  return config
+
+
+def file_sha256(path, bufsize=1024 * 1024):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(bufsize), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+class JobStore(object):
+  """
+  SQLite (WAL mode) backed store of imaging jobs.
+
+  A job is one run of a workflow (stage_phoenix, reboot_to_<target>) on a
+  node. Each completed step is checkpointed together with its outputs,
+  so running the workflow again with the same config after a provider
+  restart resumes the job after its last finished step instead of
+  re-imaging the node from scratch.
+  Connections are per thread; one store is shared by all node workers.
+  """
+  def __init__(self, path=JOB_DB_PATH):
+    self.path = path
+    self._local = threading.local()
+    with self._conn() as conn:
+      conn.executescript(SCHEMA)
+
+  def _conn(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_S)
+      conn.execute("PRAGMA journal_mode=WAL")
+      # Commits survive a provider crash, fsync per commit is not needed
+      conn.execute("PRAGMA synchronous=NORMAL")
+      self._local.conn = conn
+    return conn
+
+  def open_job(self, node_ip, workflow, config):
+    """
+    Returns the unfinished job of `workflow` on the node if it was
+    started with the same config, otherwise starts a new one. Credentials
+    in the config are stored redacted.
+    """
+    config = redact(config)
+    chash = config_hash(config)
+    now = time.time()
+    with self._conn() as conn:
+      row = conn.execute(
+        "SELECT job_id, config_hash FROM jobs WHERE node_ip = ? AND "
+        "workflow = ? AND state = ? ORDER BY created_at DESC LIMIT 1",
+        (node_ip, workflow, JOB_RUNNING)).fetchone()
+      if row and row[1] == chash:
+        return Job(self, row[0])
+      if row:
+        conn.execute("UPDATE jobs SET state = ?, updated_at = ? "
+                     "WHERE job_id = ?", (JOB_SUPERSEDED, now, row[0]))
+      job_id = uuid.uuid4().hex
+      conn.execute(
+        "INSERT INTO jobs (job_id, node_ip, workflow, config_hash, config, "
+        "state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, node_ip, workflow, chash, json.dumps(config), JOB_RUNNING,
+         now, now))
+    return Job(self, job_id)
+
+  def running_jobs(self):
+    """
+    Jobs interrupted by a provider restart.
+    """
+    rows = self._conn().execute(
+      "SELECT job_id, node_ip, workflow, config FROM jobs WHERE state = ?",
+      (JOB_RUNNING,)).fetchall()
+    return [{"job_id": r[0], "node_ip": r[1], "workflow": r[2],
+             "config": json.loads(r[3])} for r in rows]
+
+  def checkpoint(self, job_id, step, outputs):
+    now = time.time()
+    with self._conn() as conn:
+      conn.execute(
+        "INSERT OR REPLACE INTO checkpoints (job_id, step, seq, outputs, "
+        "completed_at) VALUES (?, ?, (SELECT COUNT(*) FROM checkpoints "
+        "WHERE job_id = ?), ?, ?)",
+        (job_id, step, job_id, json.dumps(outputs), now))
+      conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?",
+                   (now, job_id))
+
+  def checkpoints(self, job_id):
+    rows = self._conn().execute(
+      "SELECT step, outputs FROM checkpoints WHERE job_id = ? ORDER BY seq",
+      (job_id,)).fetchall()
+    return OrderedDict((step, json.loads(outputs)) for step, outputs in rows)
+
+  def finish_job(self, job_id, state, error=None):
+    with self._conn() as conn:
+      conn.execute("UPDATE jobs SET state = ?, error = ?, updated_at = ? "
+                   "WHERE job_id = ?", (state, error, time.time(), job_id))
+
+
+class Job(object):
+  """
+  Handle to one job's checkpoints. A Job without a store records nothing,
+  so workflows run unchanged when they are not backed by the job store.
+  """
+  def __init__(self, store=None, job_id=None):
+    self.store = store
+    self.job_id = job_id
+    self._done = store.checkpoints(job_id) if store else OrderedDict()
+
+  def is_done(self, step):
+    return step in self._done
+
+  def outputs(self, step):
+    return self._done.get(step, {})
+
+  def checkpoint(self, step, **outputs):
+    self._done[step] = outputs
+    if self.store:
+      self.store.checkpoint(self.job_id, step, outputs)
+
+  def finish(self, ok, error=None):
+    if self.store:
+      self.store.finish_job(self.job_id, JOB_DONE if ok else JOB_FAILED,
+                            None if ok else str(error))
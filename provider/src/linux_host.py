@@ -8,25 +8,53 @@
 import json
 import os
 import shutil
-try:
-  import wget
-except ImportError:
-  print("Please install wget package")
-  raise SystemExit("Missing wget package")
-
+import time
 from collections import OrderedDict
 from datetime import datetime
+from job_store import file_sha256
+from metrics import REGISTRY
+import mirrors
+import power
+from power import PowerError
+import replay
 from remote_host import RemoteHost
-from remote_host import module_print
+from remote_host import module_print, record_transfer
+from steps import Phase, Step, quote
 from string import Template
+import swarm
+from tracing import span
+
+try:
+  StandardError
+except NameError:
+  StandardError = Exception
 
 STAGING_DIR = "staging"
 PHOENIX_STAGING_DIR = "/boot"
+# Port of the griffon log endpoint phoenix posts imaging progress to
+GRIFFON_LOG_PORT = int(os.environ.get("GRIFFON_LOG_PORT", "8000"))
 
 HOLO_KERNEL = "vmlinuz-3.10.0-1062.el7.x86_64"
 HOLO_INITRD = "initramfs-3.10.0-1062.el7.x86_64.img"
 AHV_KERNEL = "vmlinuz-4.19.84-2.el7.nutanix.20190916.123.x86_64"
 AHV_INITRD = "initramfs-4.19.84-2.el7.nutanix.20190916.123.x86_64.img"
+GRUB_CFG_UEFI = "/boot/efi/EFI/centos/grub.cfg"
+GRUB_CFG_BIOS = "/boot/grub2/grub.cfg"
+TARGET_OS_TYPES = {"holo": ("holo", "centos")}
+# Shell snippet setting $dev to the disk /boot is on, followed by "p" when
+# the disk name ends in a digit (nvme0n1, mmcblk0): $dev<N> is partition N
+BOOT_DISK_SH = (
+  "part=$(df -P /boot | awk 'NR==2 {print $1}'); "
+  "dev=/dev/$(lsblk -no pkname \"$part\" | head -n1); "
+  "case $dev in *[0-9]) dev=${dev}p;; esac")
+SANITIZE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "sanitize_disks.py")
+
+PAYLOAD_CACHE = REGISTRY.counter(
+  "griffon_payload_cache_requests", "Staged payload lookups", ["result"])
+REBOOT_SECONDS = REGISTRY.histogram(
+  "griffon_reboot_duration_seconds", "Reboot until the node is reachable",
+  ["target"], buckets=(10, 30, 60, 120, 180, 300, 600, 1200, 1800, 3600))
 
 class LinuxHost(RemoteHost):
   """
@@ -35,11 +63,12 @@ class LinuxHost(RemoteHost):
   def __init__(self, *args, **kwargs):
     super(LinuxHost, self).__init__(*args, **kwargs)
     self.os_type = "centos"
+    self.staging_dir = os.path.join(STAGING_DIR, self.options.node_ip)
 
   def get_files_to_copy(self):
     return OrderedDict([
-      ("%s/kernel" % STAGING_DIR, [PHOENIX_STAGING_DIR + "/kernel-phoenix"]),
-      ("%s/initrd" % STAGING_DIR, [PHOENIX_STAGING_DIR + "/initrd-phoenix"])
+      ("%s/kernel" % self.staging_dir, [PHOENIX_STAGING_DIR + "/kernel-phoenix"]),
+      ("%s/initrd" % self.staging_dir, [PHOENIX_STAGING_DIR + "/initrd-phoenix"])
     ])
 
   def get_boot_conf_tmpl(self):
@@ -61,18 +90,34 @@ class LinuxHost(RemoteHost):
   def get_boot_partition(self):
     out, err, ret = self.ssh(cmd=["df", "/boot"])
     module_print("Boot partition details:\n"
-                 "out %s, err %s, ret %s" %(out, err, ret))
+                 "out %s, err %s, ret %s", out, err, ret)
     lines = out.splitlines()
-    if lines <= 1:
+    if len(lines) <= 1:
       raise StandardError("Unable to find boot partition")
     return lines[1].split()[0]
 
+  def get_boot_disk_partition(self, number):
+    """
+    Returns partition `number` of the disk /boot is on, e.g. /dev/sda3 or
+    /dev/nvme0n1p3
+    """
+    boot_part = self.get_boot_partition()
+    out, err, ret = self.ssh(cmd=["lsblk", "-no", "pkname", boot_part])
+    lines = out.split()
+    if ret or not lines:
+      raise StandardError("Unable to find disk of boot partition %s: %s" %
+                          (boot_part, err))
+    disk = "/dev/" + lines[0]
+    if disk[-1].isdigit():
+      disk += "p"
+    return disk + str(number)
+
   def get_home_partition(self):
     out, err, ret = self.ssh(cmd=["df", "/home"])
     module_print("Home partition details:\n"
-                 "out %s, err %s, ret %s" %(out, err, ret))
+                 "out %s, err %s, ret %s", out, err, ret)
     lines = out.splitlines()
-    if lines <= 1:
+    if len(lines) <= 1:
       raise StandardError("Unable to find home partition")
     return lines[1].split()[0]
 
@@ -109,7 +154,7 @@ class LinuxHost(RemoteHost):
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error updating grub configuration: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     module_print("Regenerating grub config: Successful")
     return True, ""
@@ -122,7 +167,7 @@ class LinuxHost(RemoteHost):
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error enumerating existing grub menuconfig: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     return True, out
 
@@ -147,10 +192,10 @@ class LinuxHost(RemoteHost):
     """
     grubcfg = ""
     if self.in_uefi():
-      grubcfg = "/boot/efi/EFI/centos/grub.cfg"
+      grubcfg = GRUB_CFG_UEFI
       module_print("Detect remote host boot mode: UEFI")
     else:
-      grubcfg = "/boot/grub2/grub.cfg"
+      grubcfg = GRUB_CFG_BIOS
       module_print("Detect remote host boot mode: Legacy BIOS")
     return grubcfg
 
@@ -163,7 +208,7 @@ class LinuxHost(RemoteHost):
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error modifying defult grub entry: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     module_print("Update default grub entry: Successful")
     return True, out
@@ -178,34 +223,54 @@ class LinuxHost(RemoteHost):
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error retrieving grub cmdline: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
-    module_print("Existing grub cmdline:\n%s" % out)
+    module_print("Existing grub cmdline:\n%s", out)
 
     rmargs = ""
     for line in out.strip().splitlines():
       if "args=" in line.lower():
         rmargs = line.split('=', 1)[1].strip(' \"')
     if rmargs:
-      module_print("Removing existing grub cmdline arguments: %s" % rmargs)
+      module_print("Removing existing grub cmdline arguments: %s", rmargs)
       cmd = "grubby --remove-args=\"%s\" --update-kernel %s" % (rmargs, k)
       out, err, ret = self.ssh(cmd=cmd.split(' '))
       if ret:
-        module_print("Error removing existing cmdline arguments: %s" % rmargs)
+        module_print("Error removing existing cmdline arguments: %s", rmargs)
         return False, err
       module_print("Removing existing cmdline arguments: Successful")
 
-    module_print("Adding grub cmdline options %s for %s" % (args, kernel))
+    module_print("Adding grub cmdline options %s for %s", args, kernel)
     cmd = "grubby --args=\"%s\" --update-kernel %s" % (args, k)
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error updating grub cmdline: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     module_print("Adding grub cmdline options for %s: Successful\n"
-                 "cmd: %s, out: %s, err: %s, ret: %s" %(kernel, cmd, out, err, ret))
+                 "cmd: %s, out: %s, err: %s, ret: %s", kernel, cmd, out, err, ret)
     return True, ""
 
+  def livefs_url(self, config, griffon_ip):
+    """
+    LIVEFS_URL for phoenix: the swarm tracker's URL for the node's rack
+    when the provider runs the swarm and the request names the rack,
+    else the livefs on a mirror.
+    """
+    url = config["phoenix"]["livefs"]["url"]
+    service = swarm.service()
+    if service is not None and config.get("rack"):
+      return service.rack_url(griffon_ip, url, config["rack"])
+    return mirrors.registry().select(url)
+
+  def session(self, config):
+    """
+    Imaging session phoenix reports progress under: the provider's job
+    session, or a timestamp when the workflow runs from the command line
+    """
+    return (config.get("session") or
+            datetime.today().strftime('%Y%m%d-%H:%M:%S'))
+
   def generate_boot_cfg(self, config):
     """
     Generates grub for phoenix
@@ -222,20 +287,19 @@ class LinuxHost(RemoteHost):
     boot_script = "installer"
     type_img = "squashfs"
     griffon_ip = self.get_my_ip(host_ip)
-    livefs_url = config["phoenix"]["livefs"]
 
-    text = Template(self.get_boot_conf_tmpl()).substitute(
+    text = self.render(self.get_boot_conf_tmpl(),
         foundation_ip=griffon_ip,
-        foundation_port=8000,
+        foundation_port=GRIFFON_LOG_PORT,
         az_conf_url=arizona_url,
-        livefs_url=livefs_url["url"],
+        livefs_url=self.livefs_url(config, griffon_ip),
         node_id=host_ip,
         phoenix_ip=phoenix_ip,
         phoenix_netmask=phoenix_netmask,
         phoenix_gw=phoenix_gw,
         vlan_id=vlan_id,
         boot_script=boot_script,
-        session=datetime.today().strftime('%Y%m%d-%H:%M:%S'),
+        session=self.session(config),
         bond_mode="",
         bond_uplinks="",
         bond_lacp_rate="",
@@ -244,8 +308,8 @@ class LinuxHost(RemoteHost):
         prefix=prefix,
         boot_parameters=boot_parameters
     )
-    module_print("generate_boot_cfg:\n%s" % text)
-    boot_cfg = os.path.join(STAGING_DIR, "grub.cfg")
+    module_print("generate_boot_cfg:\n%s", text)
+    boot_cfg = os.path.join(self.staging_dir, "grub.cfg")
 
     with open(boot_cfg, "w") as boot_cfg_fp:
       boot_cfg_fp.write(text)
@@ -255,14 +319,12 @@ class LinuxHost(RemoteHost):
     Generates kernel command line parameters for phoenix
     """
     ahv_rootfs_part = config["partition_table"]["nutanix"]["id"]
-    boot_part = self.get_boot_partition()
-    boot_dev = boot_part[:-1]
-    ahv_part = boot_dev + str(ahv_rootfs_part)
+    ahv_part = self.get_boot_disk_partition(ahv_rootfs_part)
     cmd = "blkid %s" % ahv_part
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error checking Ahv partition UUID: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     lines = out.strip().splitlines()
     ahv_uuid = lines[0].split()[1].replace('"', '')
@@ -272,8 +334,8 @@ class LinuxHost(RemoteHost):
     boot_parameters = "NUTANIX_PART=%s" % ahv_rootfs_part
 
     module_print("\nDownloading arizona config....\n")
-    wget.download(config["arizona_url"], "%s/arizona.conf" % STAGING_DIR)
-    with open("%s/arizona.conf" % STAGING_DIR, "r") as f:
+    self.download(config["arizona_url"], "%s/arizona.conf" % self.staging_dir)
+    with open("%s/arizona.conf" % self.staging_dir, "r") as f:
       cfg = json.load(f)
     host_ip = cfg["host_ip"]
     phoenix_ip = cfg["host_ip"]
@@ -283,20 +345,19 @@ class LinuxHost(RemoteHost):
     boot_script = config["phoenix"]["mode"].lower()
     type_img = "squashfs"
     griffon_ip = self.get_my_ip(host_ip)
-    livefs_url = config["phoenix"]["livefs"]
 
-    text = Template(self.get_phoenix_cmdline_tmpl()).substitute(
+    text = self.render(self.get_phoenix_cmdline_tmpl(),
         phx_uuid=ahv_uuid,
         foundation_ip=griffon_ip,
-        foundation_port=8000,
+        foundation_port=GRIFFON_LOG_PORT,
         az_conf_url=arizona_url,
-        livefs_url=livefs_url["url"],
+        livefs_url=self.livefs_url(config, griffon_ip),
         phoenix_ip=phoenix_ip,
         phoenix_netmask=phoenix_netmask,
         phoenix_gw=phoenix_gw,
         vlan_id=vlan_id,
         boot_script=boot_script,
-        session=datetime.today().strftime('%Y%m%d-%H:%M:%S'),
+        session=self.session(config),
         bond_mode="",
         bond_uplinks="",
         bond_lacp_rate="",
@@ -304,7 +365,7 @@ class LinuxHost(RemoteHost):
         prefix=prefix,
         boot_parameters=boot_parameters
     )
-    module_print("\ngenerate_phoenix_cmdline:\n%s" % text.strip())
+    module_print("\ngenerate_phoenix_cmdline:\n%s", text.strip())
     return text.strip()
 
   def generate_holo_cmdline(self, config):
@@ -312,23 +373,21 @@ class LinuxHost(RemoteHost):
     Generates kernel command line parameters for holo
     """
     holo_rootfs_part = config["partition_table"]["holo"]["id"]
-    boot_part = self.get_boot_partition()
-    boot_dev = boot_part[:-1]
-    holo_part = boot_dev + str(holo_rootfs_part)
+    holo_part = self.get_boot_disk_partition(holo_rootfs_part)
     cmd = "blkid %s" % holo_part
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error checking Holo partition UUID: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     lines = out.strip().splitlines()
     holo_uuid = lines[0].split()[1].replace('"', '')
-    module_print("Holo UUID: %s" % holo_uuid)
+    module_print("Holo UUID: %s", holo_uuid)
       
-    text = Template(self.get_holo_cmdline_tmpl()).substitute(
+    text = self.render(self.get_holo_cmdline_tmpl(),
       holo_uuid=holo_uuid
     )
-    module_print("generate_holo_cmdline: %s" % text.strip()) 
+    module_print("generate_holo_cmdline: %s", text.strip())
     return text.strip()
 
   def generate_ahv_cmdline(self, config=None):
@@ -336,63 +395,59 @@ class LinuxHost(RemoteHost):
     Generates kernel command line parameters for ahv
     """
     ahv_rootfs_part = config["partition_table"]["nutanix"]["id"]
-    boot_part = self.get_boot_partition()
-    boot_dev = boot_part[:-1]
-    ahv_part = boot_dev + str(ahv_rootfs_part)
+    ahv_part = self.get_boot_disk_partition(ahv_rootfs_part)
     cmd = "blkid %s" % ahv_part
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error checking Ahv partition UUID: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     lines = out.strip().splitlines()
     ahv_uuid = lines[0].split()[1].replace('"', '')
-    module_print("Ahv UUID: %s" % ahv_uuid)
+    module_print("Ahv UUID: %s", ahv_uuid)
 
-    text = Template(self.get_ahv_cmdline_tmpl()).substitute(
+    text = self.render(self.get_ahv_cmdline_tmpl(),
       ahv_uuid=ahv_uuid
     )
-    module_print("generate_ahv_cmdline: %s" % text.strip())
+    module_print("generate_ahv_cmdline: %s", text.strip())
     return text.strip()
 
   def remove_from_fstab(self, partition):
     """
     Removes mountpoints on a given partition from fstab
     """
-    boot_part = self.get_boot_partition()
-    boot_dev = boot_part[:-1]
-    part = boot_dev + str(partition)
+    part = self.get_boot_disk_partition(partition)
     cmd = "blkid %s" % part
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error checking partition UUID: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
-    module_print("%s" % out)
+    module_print("%s", out)
     lines = out.strip().splitlines()
     target_uuid = lines[0].split()[1].replace('"', '')
-    module_print("Target UUID: %s" % target_uuid)
+    module_print("Target UUID: %s", target_uuid)
 
     cmd = "cat /etc/fstab"
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error enumerating fstab entries: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
-    module_print("Fstab entries:\n%s" % out)
+    module_print("Fstab entries:\n%s", out)
 
     cmd = "sed -i.bak '\@^%s@d' /etc/fstab" % target_uuid
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
       module_print("Error removing entry from fstab: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     module_print("Fstab successfully updated")
 
     cmd = "cat /etc/fstab"
     out, _, ret = self.ssh(cmd=cmd.split(' '))
     if not ret:
-      module_print("Fstab entries:\n%s" % out)
+      module_print("Fstab entries:\n%s", out)
     return True, ""
 
   def revert_grub(self, grubcfg):
@@ -404,48 +459,116 @@ class LinuxHost(RemoteHost):
     out, err, ret = self.ssh(cmd=cmd)
     if ret:
       module_print("Error reverting original grub configuration: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     return True, ""
 
-  def stage_phoenix(self, config):
+  def _staged_payload_ok(self, staged):
     """
-    Stages phoenix payloads
+    Checks the local staging area still holds the payload recorded by the
+    download checkpoint.
+    """
+    for name, digest in staged.items():
+      path = os.path.join(self.staging_dir, name)
+      if not os.path.exists(path) or file_sha256(path) != digest:
+        return False
+    return True
+
+  def download(self, url, path, fetch=None):
+    """
+    Downloads url to the local path, with fetch(url, path) if given
+    """
+    fetch = fetch or self.fetch
+    with span("download", node_ip=self.node_ip(), url=url) as s:
+      start = time.time()
+      replay.current().download(url, path, lambda: fetch(url, path))
+      size = os.path.getsize(path)
+      record_transfer("download", size, time.time() - start)
+      s.set(bytes=size)
+
+  def fetch(self, url, path):
+    """
+    Fetches url from its mirrors, or from url itself without mirrors. A
+    fetch slower than usual for url is hedged with a second one
+    """
+    mirrors.fetch(url, path)
+
+  def fetch_payload(self, artifact):
+    """
+    fetch for a phoenix payload artifact of the config: with the swarm
+    running, copied from the seed's cache, which fetches it once and
+    checks it against the artifact's md5sum.
+    """
+    service = swarm.service()
+    if service is None:
+      return self.fetch
+    return lambda url, path: service.seed.copy(url, path,
+                                               artifact.get("md5sum"))
+
+  def render(self, tmpl, **values):
+    """
+    Substitutes values into the template text
+    """
+    with span("template.render", node_ip=self.node_ip()) as s:
+      text = Template(tmpl).substitute(**values)
+      s.set(bytes=len(text))
+      return text
+
+  def download_payload(self, config):
+    """
+    Downloads phoenix payload to the node's staging area
     """
     try:
-      shutil.rmtree(STAGING_DIR)
-      if not os.path.exists(STAGING_DIR):
-        os.mkdir(STAGING_DIR)
+      if os.path.exists(self.staging_dir):
+        shutil.rmtree(self.staging_dir)
+      os.makedirs(self.staging_dir)
     except OSError:
-      module_print("Error: Creating directory %s" % STAGING_DIR)
+      module_print("Error: Creating directory %s", self.staging_dir)
 
-    # Download phoenix payload to staging area
-    module_print("\nDownloading phoenix kernel....\n")
-    wget.download(config["phoenix"]["kernel"]["url"], "%s/kernel" % STAGING_DIR)
-    module_print("\nDownloading phoenix initrd....\n")
-    wget.download(config["phoenix"]["initrd"]["url"], "%s/initrd" % STAGING_DIR)
+    for name in ("kernel", "initrd"):
+      module_print("\nDownloading phoenix %s....\n", name)
+      artifact = config["phoenix"][name]
+      self.download(artifact["url"], "%s/%s" % (self.staging_dir, name),
+                    self.fetch_payload(artifact))
     module_print("\nSuccessfully downloaded files\n")
+    self.job.checkpoint("download_payload", **{
+      name: file_sha256(os.path.join(self.staging_dir, name))
+      for name in ("kernel", "initrd")})
+
+  def copy_payload(self, config):
+    """
+    Copies phoenix payload to the host, downloading it first unless the
+    staging area still holds it.
+    """
+    staged = self.job.outputs("download_payload")
+    if not staged or not self._staged_payload_ok(staged):
+      PAYLOAD_CACHE.labels("miss").inc()
+      self.download_payload(config)
+    else:
+      PAYLOAD_CACHE.labels("hit").inc()
 
-    # Stage phoenix payload on remote host
     module_print("Staging files on host")
     files = self.get_files_to_copy()
     for src, dsts in files.items():
       for dst in dsts:
-        out, err, ret = self.scp(target=dst, files=[src]) 
+        out, err, ret = self.scp(target=dst, files=[src])
         if ret:
           return False, err
     module_print("Staging files on host: Successful")
+    return True, self.job.outputs("download_payload")
 
+  def chmod_phoenix_kernel(self):
     module_print("Setting execute permissions on phoenix kernel")
     cmd = "chmod +x /boot/kernel-phoenix"
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
-      self.revert_grub(grubcfg)
       module_print("Error setting execute permissions on phoenix kernel: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     module_print("Setting execute permissions on phoenix kernel: Successful")
+    return True, None
 
+  def rename_holo_kernel(self):
     module_print("Renaming base kernel and initramfs")
     cmd = "mv /boot/%s "\
           "/boot/kernel-holo && mv /boot/%s "\
@@ -453,17 +576,20 @@ class LinuxHost(RemoteHost):
           HOLO_KERNEL, HOLO_INITRD)
     out, err, ret = self.ssh(cmd=cmd.split(' '))
     if ret:
-      self.revert_grub(grubcfg)
       module_print("Error renaming base kernel and initrd: "
-                   "cmd: %s, out: %s, err: %s, ret: %s" %(cmd, out, err, ret))
+                   "cmd: %s, out: %s, err: %s, ret: %s", cmd, out, err, ret)
       return False, err
     module_print("Renaming base kernel and initramfs: Successful")
+    return True, {"kernel": "/boot/kernel-holo", "initrd": "/boot/initrd-holo"}
 
+  def backup_grub(self):
     grubcfg = self.get_grub_cfg()
     module_print("Backing up grub configuration file")
     cmd = ["cp", "%s" % grubcfg, "%s.backup" % grubcfg]
     self.ssh(cmd=cmd)
+    return True, {"grubcfg": grubcfg}
 
+  def remove_nutanix_fstab(self, config):
     module_print("Unmount the nutanix partition and remove "
                  "entry from fstab")
     ahv_rootfs_part = config["partition_table"]["nutanix"]["id"]
@@ -472,79 +598,205 @@ class LinuxHost(RemoteHost):
       module_print("Could not remove nutanix partition mountpoint "
                    "from fstab")
       return False, err
+    return True, {"partition": ahv_rootfs_part}
+
+  def payload_check(self, config):
+    """
+    Shell check that the phoenix payload on the host matches the staged
+    hashes, or the md5sums given in the config. None if neither is known.
+    """
+    staged = self.job.outputs("download_payload")
+    if staged:
+      tool, digests = "sha256sum", staged
+    else:
+      tool = "md5sum"
+      digests = dict((name, config["phoenix"][name].get("md5sum"))
+                     for name in ("kernel", "initrd"))
+      if not all(digests.values()):
+        return None
+    return " && ".join(
+      "[ \"$(%s /boot/%s-phoenix | cut -d' ' -f1)\" = %s ]" % (
+        tool, name, digests[name]) for name in ("kernel", "initrd"))
+
+  def stage_phoenix(self, config):
+    """
+    Stages phoenix payloads. Steps checkpointed by the job or already in
+    effect on the host are not repeated.
+    """
+    partition_uuid = "%s; uuid=$(blkid -s UUID -o value $dev%s)" % (
+      BOOT_DISK_SH, config["partition_table"]["nutanix"]["id"])
+    phase = Phase(self, "stage_phoenix", [
+      Step("copy_payload", self.payload_check(config),
+           lambda: self.copy_payload(config)),
+      Step("chmod_phoenix_kernel", "test -x /boot/kernel-phoenix",
+           self.chmod_phoenix_kernel, depends_on=("copy_payload",)),
+      Step("rename_holo_kernel",
+           "test -x /boot/kernel-holo -a -f /boot/initrd-holo "
+           "-a ! -e /boot/%s" % HOLO_KERNEL,
+           self.rename_holo_kernel),
+      Step("backup_grub",
+           "if [ -d /sys/firmware/efi ]; then "
+           "test -f /boot/efi/EFI/centos/grub.cfg.backup; "
+           "else test -f /boot/grub2/grub.cfg.backup; fi",
+           self.backup_grub),
+      Step("remove_nutanix_fstab",
+           "{ %s; [ -n \"$uuid\" ] && ! grep -q \"^UUID=$uuid\" /etc/fstab; }"
+           % partition_uuid,
+           lambda: self.remove_nutanix_fstab(config)),
+    ])
+    ret, err = phase.run()
+    if not ret:
+      return False, err
     return True, "Stage Phoenix: Successful"
-    
-  def reboot_to_target(self, target, config):
+
+  def grub_default_check(self, menukey):
     """
-    Reboots host and waits for it to boot into target OS
+    Shell condition: the last grub.cfg menuentry matching menukey is the
+    grub default
     """
-    if not isinstance(target, basestring) or \
-      target.lower() not in ["holo", "phoenix", "ahv"]:
-        module_print("Invalid target os %s specified" % target)
-        return False, "Invalid target os %s specified" % target
+    return ("cfg=%s; [ -d /sys/firmware/efi ] && cfg=%s; "
+            "m=$(awk -F\\' '$1==\"menuentry \" {print $2}' $cfg | "
+            "grep -iF %s | tail -n1); "
+            "[ -n \"$m\" ] && grep -qxF \"GRUB_DEFAULT=\\\"$m\\\"\" "
+            "/etc/default/grub" % (GRUB_CFG_BIOS, GRUB_CFG_UEFI, menukey))
+
+  def grub_cmdline_check(self, target, config):
+    """
+    Shell condition: the target kernel has the command line its template
+    gives, None for phoenix, whose command line is new for every session
+    """
+    partition = {"holo": "holo", "ahv": "nutanix"}.get(target)
+    if partition is None:
+      return None
+    kernel = {"holo": "kernel-holo", "ahv": AHV_KERNEL}[target]
+    tmpl = {"holo": self.get_holo_cmdline_tmpl,
+            "ahv": self.get_ahv_cmdline_tmpl}[target]()
+    # Same partition and blkid token as generate_holo/ahv_cmdline
+    cmdline = Template(tmpl).substitute(
+      **{"%s_uuid" % target: "$u"}).strip()
+    return ("%s; u=$(blkid $dev%s | awk '{print $2}' | tr -d '\"'); "
+            "grubby --info /boot/%s | grep -qxF \"args=\\\"%s\\\"\"" % (
+              BOOT_DISK_SH, config["partition_table"][partition]["id"],
+              kernel, cmdline))
 
-    taret = target.lower()
+  def configure_grub_for_target(self, target, config):
+    """
+    Makes target the default grub entry with its kernel command line. The
+    grub state is probed first: grub config regeneration, menuentries
+    and the command line are only worked out for steps still to be done.
+    """
     kernel = {"holo": "kernel-holo",
               "phoenix": "kernel-phoenix",
               "ahv": AHV_KERNEL}
     menukey = {"holo": "holo",
                "phoenix": "phoenix",
                "ahv": "nutanix"}
-    try:
+    cmdline_fn = {
+      "phoenix": self.generate_phoenix_cmdline,
+      "holo": self.generate_holo_cmdline,
+      "ahv": self.generate_ahv_cmdline
+    }
+
+    def set_default():
       grubcfg = self.get_grub_cfg()
       ret, out = self.regenerate_grub_config(grubcfg)
       if not ret:
         return False, out
 
-      module_print("Marking %s as default in grub config" % target)
+      module_print("Marking %s as default in grub config", target)
       ret, out = self.get_menuentries(grubcfg)
       if not ret:
         return False, out
+      menuentries = [line for line in out.strip().splitlines()
+                     if menukey[target] in line.lower()]
+      if not menuentries:
+        return False, "Unable to locate %s menuentry in grub" % target
+      menuentry = menuentries[-1]
+      module_print("Menuentry: %s", menuentry)
+
+      module_print("Update default grub entry")
+      ret, out = self.set_grub_default(menuentry)
+      if not ret:
+        return False, out
+      module_print("Update default grub entry: Successful")
 
-      for line in out.strip().splitlines():
-        if not menukey[target] in line.lower():
-          continue
-        else:
-          module_print("Update default grub entry")
-          menuentry = line
-          module_print("Menuentry: %s" % menuentry)
-          ret, out = self.set_grub_default(menuentry)
-          if not ret:
-            return False, out
-          module_print("Update default grub entry: Successful")
-
-          module_print("Updating grub config")
-          ret, out = self.regenerate_grub_config(grubcfg)
-          if not ret:
-            return False, out
-          module_print("Updating grub config: Successful")
-
-          cmdline_fn = {
-            "phoenix": self.generate_phoenix_cmdline,
-            "holo": self.generate_holo_cmdline,
-            "ahv": self.generate_ahv_cmdline
-          }
-          module_print("Update grub cmdline options for %s" % target)
-          cmdline = cmdline_fn[target](config)
-          ret, out = self.set_grub_cmdline(kernel=kernel[target],
-                                           args=cmdline)
-          if not ret:
-            return False, out
-
-      module_print("Rebooting the host")
-      out, err, ret = self.ssh(cmd=["reboot", "-f"])
-      err_msg = ("Reboot host returned : "
-                 "out: %s, err: %s, ret: %s" % (out, err, ret))
-      module_print(err_msg)
+      module_print("Updating grub config")
+      ret, out = self.regenerate_grub_config(grubcfg)
+      if not ret:
+        return False, out
+      module_print("Updating grub config: Successful")
+      return True, {"grubcfg": grubcfg, "menuentry": menuentry}
+
+    def set_cmdline():
+      cmdline = cmdline_fn[target](config)
+      if isinstance(cmdline, tuple):
+        # (False, err) from the cmdline generator
+        return cmdline
+      module_print("Update grub cmdline options for %s", target)
+      ret, out = self.set_grub_cmdline(kernel=kernel[target], args=cmdline)
+      if not ret:
+        return False, out
+      return True, {"cmdline": cmdline}
+
+    phase = Phase(self, "grub:%s" % target, [
+      Step("%s:set_grub_default" % target,
+           self.grub_default_check(menukey[target]),
+           set_default),
+      Step("%s:set_grub_cmdline" % target,
+           self.grub_cmdline_check(target, config),
+           set_cmdline),
+    ])
+    ret, out = phase.run()
+    if not ret:
+      return False, out
+    self.job.checkpoint("%s:configure_grub" % target)
+    return True, ""
 
-      module_print("Waiting for node to reboot into %s......" % target)
-      ret, os_type = self.wait_for_host()
-      if ret and os_type == target:
-        module_print("Node successfully booted into %s" % target)
+  def reboot_to_target(self, target, config):
+    """
+    Reboots host and waits for it to boot into target OS. A job that
+    already rebooted the host only waits for it to come up.
+    """
+    if not isinstance(target, str) or \
+      target.lower() not in ["holo", "phoenix", "ahv"]:
+        module_print("Invalid target os %s specified", target)
+        return False, "Invalid target os %s specified" % target
+
+    target = target.lower()
+    try:
+      self.power = power.from_config(config)
+    except (PowerError, TypeError) as e:
+      module_print("Ignoring bmc config: %s", e)
+    try:
+      if not self.job.is_done("%s:configure_grub" % target):
+        ret, out = self.configure_grub_for_target(target, config)
+        if not ret:
+          return False, out
+
+      if not self.job.is_done("%s:reboot" % target):
+        # Boot waits are timed by the history of this kind of node
+        fingerprint = self.fingerprint()
+        module_print("Rebooting the host")
+        out, err, ret = self.ssh(cmd=["reboot", "-f"])
+        err_msg = ("Reboot host returned : "
+                   "out: %s, err: %s, ret: %s" % (out, err, ret))
+        module_print(err_msg)
+        self.job.checkpoint("%s:reboot" % target, fingerprint=fingerprint)
+      else:
+        self._fingerprint = self.job.outputs("%s:reboot" % target).get(
+          "fingerprint")
+
+      module_print("Waiting for node to reboot into %s......", target)
+      with REBOOT_SECONDS.labels(target).time():
+        ret, os_type = self.wait_for_host(step="boot.%s" % target)
+      # Holo is the base CentOS install and is detected as such
+      if ret and os_type in TARGET_OS_TYPES.get(target, (target,)):
+        module_print("Node successfully booted into %s", target)
         return True, ""
       if ret:
-        module_print("Node did not boot into %s" % target)
+        module_print("Node did not boot into %s", target)
         return False, "Node booted into %s" % os_type
+      return False, "Timed out waiting for node to boot into %s" % target
     except Exception as e:
       err_msg = ("Exception while rebooting host into target %s: "
                  "'%s'" % (target, str(e)))
@@ -563,7 +815,7 @@ class LinuxHost(RemoteHost):
                    "Detected OS: %s" % os_type)
         module_print(err_msg)
         return False, err_msg
-      module_print("Node %s is running AHV" % options.node_ip)
+      module_print("Node %s is running AHV", options.node_ip)
       # Reboot into HOLO
       in_holo, msg = self.reboot_to_target(target="holo", config=config)
       if not in_holo:
@@ -574,14 +826,14 @@ class LinuxHost(RemoteHost):
         # Stage the sanitize script in HOLO
         module_print("Staging santization scripts on host")
         out, err, ret = self.scp(target="/sanitize_disks.py",
-                                 files=["./sanitize_disks.py"])
+                                 files=[SANITIZE_SCRIPT])
         if ret:
           err_msg = "Unable to stage sanitization script to node\n"\
                     "out: %s\nerr: %s\nret: %s" % (out, err, ret)
           module_print(err_msg)
           return False, err_msg
         module_print("Stages sanitization script to node: Successful\n"\
-                     "out: %s\nerr: %s\nret: %s" % (out, err, ret))
+                     "out: %s\nerr: %s\nret: %s", out, err, ret)
         # Set execute bit of script
         cmd = "chmod +x /sanitize_disks.py"
         out, err, ret = self.ssh(cmd=cmd.split(' '))
@@ -590,7 +842,7 @@ class LinuxHost(RemoteHost):
           module_print(err_msg)
           return False, err_msg
         module_print("Change execute permissions on host: Successful\n"\
-                     "out: %s\nerr: %s\nret: %s" % (out, err, ret))
+                     "out: %s\nerr: %s\nret: %s", out, err, ret)
         return True, "Dummy return from sanitize_node"
         # Execute sanitization script on host
         module_print("Executing santization scripts on host")
@@ -604,7 +856,7 @@ class LinuxHost(RemoteHost):
           module_print(err_msg)
           return False, err_msg
         module_print("Executing santization scripts on host: Successful\n"
-                     "out: %s\nerr: %s\nret: %s" % (out, err, ret))
+                     "out: %s\nerr: %s\nret: %s", out, err, ret)
         return True, ""
     except Exception as e:
       err_msg = ("Failed to sanitize node '%s'" % str(e))
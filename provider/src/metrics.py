@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# In-process metrics registry rendered in the Prometheus text format.
+#
+# Recording takes no lock: every thread updates its own cell of a metric
+# and scrapes sum the cells. A lock is only taken the first time a thread
+# touches a metric or a new label set, and while rendering. Cells of
+# threads that exited are folded into a base cell, so a metric keeps about
+# one cell per live thread however many short-lived threads record to it.
+
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300)
+BYTES_PER_S_BUCKETS = (1e5, 1e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9)
+# Cells a metric may collect before those of exited threads are folded
+FOLD_MIN_CELLS = 64
+
+
+class _Child(object):
+  """
+  One label set of a metric: a cell per recording thread.
+  """
+  def __init__(self, new_cell, buckets=None):
+    self._new_cell = new_cell
+    self._buckets = buckets
+    self._local = threading.local()
+    # Totals of the threads that exited
+    self._base = new_cell()
+    # (thread, cell)
+    self._cells = []
+    self._fold_at = FOLD_MIN_CELLS
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    self.cell()[0] += amount
+
+  def dec(self, amount=1):
+    self.cell()[0] -= amount
+
+  def observe(self, value):
+    cell = self.cell()
+    cell[bisect.bisect_left(self._buckets, value)] += 1
+    cell[-1] += value
+
+  def time(self):
+    """
+    Context manager observing the duration of the enclosed block.
+    """
+    return _Timer(self)
+
+  def cell(self):
+    cell = getattr(self._local, "cell", None)
+    if cell is None:
+      cell = self._local.cell = self._new_cell()
+      with self._lock:
+        self._cells.append((threading.current_thread(), cell))
+        if len(self._cells) >= self._fold_at:
+          self._fold()
+          self._fold_at = max(FOLD_MIN_CELLS, 2 * len(self._cells))
+    return cell
+
+  def _fold(self):
+    """
+    Adds the cells of exited threads to the base cell. Called with the
+    lock held; an exited thread no longer writes to its cell.
+    """
+    live = []
+    for thread, cell in self._cells:
+      if thread.is_alive():
+        live.append((thread, cell))
+      else:
+        for i, value in enumerate(cell):
+          self._base[i] += value
+    self._cells = live
+
+  def cells(self):
+    with self._lock:
+      self._fold()
+      return [list(self._base)] + [cell for _, cell in self._cells]
+
+
+class _Metric(object):
+  kind = None
+  buckets = None
+
+  def __init__(self, name, doc, labelnames=()):
+    self.name = name
+    self.doc = doc
+    self.labelnames = tuple(labelnames)
+    self._children = {}
+    self._lock = threading.Lock()
+    if not self.labelnames:
+      self._default = self.labels()
+
+  def _new_cell(self):
+    return [0]
+
+  def labels(self, *values):
+    values = tuple(str(value) for value in values)
+    child = self._children.get(values)
+    if child is None:
+      assert len(values) == len(self.labelnames), (
+        "%s expects labels %s" % (self.name, self.labelnames))
+      with self._lock:
+        child = self._children.setdefault(
+          values, _Child(self._new_cell, self.buckets))
+    return child
+
+  def _label_str(self, values, extra=()):
+    pairs = list(zip(self.labelnames, values)) + list(extra)
+    if not pairs:
+      return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+  def samples(self):
+    with self._lock:
+      children = list(self._children.items())
+    for values, child in sorted(children):
+      for sample in self._child_samples(values, child):
+        yield sample
+
+  def render(self):
+    lines = ["# HELP %s %s" % (self.name, self.doc),
+             "# TYPE %s %s" % (self.name, self.kind)]
+    for name, labels, value in self.samples():
+      lines.append("%s%s %s" % (name, labels, _format(value)))
+    return "\n".join(lines)
+
+
+class Counter(_Metric):
+  kind = "counter"
+
+  def inc(self, amount=1):
+    self._default.inc(amount)
+
+  def value(self, *values):
+    return sum(cell[0] for cell in self.labels(*values).cells())
+
+  def _child_samples(self, values, child):
+    yield (self.name + "_total", self._label_str(values),
+           sum(cell[0] for cell in child.cells()))
+
+
+class Gauge(_Metric):
+  """
+  inc/dec are summed across threads. set_function replaces the value with
+  a callback evaluated at scrape time, returning a number or, for labelled
+  gauges, a dict of label value tuple -> number.
+  """
+  kind = "gauge"
+
+  def __init__(self, name, doc, labelnames=()):
+    super(Gauge, self).__init__(name, doc, labelnames)
+    self._function = None
+
+  def inc(self, amount=1):
+    self._default.inc(amount)
+
+  def dec(self, amount=1):
+    self._default.dec(amount)
+
+  def set_function(self, function):
+    self._function = function
+
+  def _child_samples(self, values, child):
+    yield (self.name, self._label_str(values),
+           sum(cell[0] for cell in child.cells()))
+
+  def samples(self):
+    if self._function is None:
+      for sample in super(Gauge, self).samples():
+        yield sample
+      return
+    value = self._function()
+    if not isinstance(value, dict):
+      value = {(): value}
+    for values, number in sorted(value.items()):
+      yield self.name, self._label_str(values), number
+
+
+class Histogram(_Metric):
+  kind = "histogram"
+
+  def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(sorted(buckets))
+    super(Histogram, self).__init__(name, doc, labelnames)
+
+  def _new_cell(self):
+    # Bucket counts, then +Inf, sum
+    return [0] * (len(self.buckets) + 2)
+
+  def observe(self, value):
+    self._default.observe(value)
+
+  def time(self):
+    return self._default.time()
+
+  def _child_samples(self, values, child):
+    totals = [0] * (len(self.buckets) + 2)
+    for cell in child.cells():
+      for i, count in enumerate(cell):
+        totals[i] += count
+    cumulative = 0
+    for bound, count in zip(self.buckets + (float("inf"),), totals):
+      cumulative += count
+      yield (self.name + "_bucket",
+             self._label_str(values, [("le", _format(bound))]), cumulative)
+    yield self.name + "_sum", self._label_str(values), totals[-1]
+    yield self.name + "_count", self._label_str(values), cumulative
+
+
+class _Timer(object):
+  __slots__ = ("child", "start")
+
+  def __init__(self, child):
+    self.child = child
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.child.observe(time.time() - self.start)
+    return False
+
+
+def _escape(value):
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+  if value == float("inf"):
+    return "+Inf"
+  if isinstance(value, float) and value.is_integer():
+    return repr(int(value)) if abs(value) < 1e15 else repr(value)
+  return repr(value)
+
+
+class Registry(object):
+  def __init__(self):
+    self._metrics = {}
+    self._lock = threading.Lock()
+
+  def _register(self, cls, name, *args, **kwargs):
+    with self._lock:
+      metric = self._metrics.get(name)
+      if metric is None:
+        metric = self._metrics[name] = cls(name, *args, **kwargs)
+      assert isinstance(metric, cls), "%s already registered" % name
+      return metric
+
+  def counter(self, name, doc, labelnames=()):
+    return self._register(Counter, name, doc, labelnames)
+
+  def gauge(self, name, doc, labelnames=()):
+    return self._register(Gauge, name, doc, labelnames)
+
+  def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return self._register(Histogram, name, doc, labelnames, buckets=buckets)
+
+  def get(self, name):
+    return self._metrics.get(name)
+
+  def exposition(self):
+    with self._lock:
+      metrics = sorted(self._metrics.items())
+    return "\n".join(metric.render() for _, metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Multi-mirror artifact downloads.
+#
+# An artifact server can be backed by mirrors serving the same paths. The
+# registry maps each origin base URL to its mirror group, e.g. in the JSON
+# file named by GRIFFON_MIRRORS:
+#
+#   {"http://172.26.2.4:8000": ["http://172.26.2.4:8000",
+#                               "http://172.26.3.4:8000"]}
+#
+# Mirrors are ranked by round trip time (probed) and throughput (measured
+# on real downloads), and every download picks its mirror by weighted
+# random choice, so load spreads over all healthy mirrors in proportion
+# to what they deliver. A mirror that stalls or slows far below its usual
+# throughput partway through is marked down for a while and the download
+# resumes from the same offset on the next mirror.
+
+import json
+import os
+import random
+import socket
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+import cancellation
+from cancellation import Cancelled
+from hedging import Hedger
+from metrics import REGISTRY
+
+MIRRORS_FILE = os.environ.get("GRIFFON_MIRRORS", "")
+CHUNK_SIZE = 1024 * 1024
+# A read blocked this long means the mirror stalled
+STALL_TIMEOUT_S = 15
+# Throughput below this fraction of the mirror's average, once past the
+# grace period, fails the mirror over
+DEGRADED_FRACTION = 0.2
+DEGRADED_GRACE_S = 5
+MIRROR_DOWN_S = 60
+PROBE_INTERVAL_S = 60
+PROBE_TIMEOUT_S = 3
+# Smoothing of the rtt and throughput averages
+EWMA_ALPHA = 0.3
+# Size the expected fetch time of a mirror is ranked by
+RANKING_SIZE = 64 * 1024 * 1024
+
+MIRROR_REQUESTS = REGISTRY.counter(
+  "griffon_mirror_requests", "Artifact downloads by mirror and outcome",
+  ["mirror", "result"])
+MIRROR_FAILOVERS = REGISTRY.counter(
+  "griffon_mirror_failovers", "Downloads moved to another mirror midway")
+DOWNLOAD_HEDGER = Hedger("download")
+
+
+class MirrorDegraded(Exception):
+  pass
+
+
+def _ewma(current, sample):
+  return sample if current is None else (
+    EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * current)
+
+
+class Mirror(object):
+  __slots__ = ("base", "rtt", "throughput", "active", "down_until",
+               "probed_at")
+
+  def __init__(self, base):
+    self.base = base.rstrip("/")
+    self.rtt = None
+    self.throughput = None
+    self.active = 0
+    self.down_until = 0
+    self.probed_at = 0
+
+  @property
+  def healthy(self):
+    return time.time() >= self.down_until
+
+  def expected_seconds(self, default_throughput):
+    throughput = self.throughput or default_throughput
+    return (self.rtt or PROBE_TIMEOUT_S) + RANKING_SIZE / throughput
+
+  def __repr__(self):
+    return "Mirror(%s, rtt=%s, throughput=%s, active=%d)" % (
+      self.base, self.rtt, self.throughput, self.active)
+
+
+class MirrorRegistry(object):
+  def __init__(self, groups=None, rng=None):
+    self._groups = {}
+    self._lock = threading.Lock()
+    self._rng = rng or random.Random()
+    for origin, bases in (groups or {}).items():
+      self.add_group(origin, bases)
+
+  @classmethod
+  def from_file(cls, path):
+    with open(path) as f:
+      return cls(json.load(f))
+
+  def add_group(self, origin, bases):
+    mirrors = [Mirror(base) for base in bases]
+    with self._lock:
+      self._groups[origin.rstrip("/")] = mirrors
+
+  def group(self, url):
+    """
+    Returns (mirrors, path of url below its origin), or (None, None) if
+    url has no mirror group.
+    """
+    with self._lock:
+      groups = list(self._groups.items())
+    return self._match(groups, url)
+
+  @staticmethod
+  def _match(groups, url):
+    for origin, mirrors in groups:
+      if url.startswith(origin + "/"):
+        return mirrors, url[len(origin):]
+    return None, None
+
+  def sources(self, url):
+    """
+    Like group(), but a url without mirrors gets a group of its own
+    server, so its downloads are measured and resumed all the same.
+    """
+    parts = urlsplit(url)
+    origin = "%s://%s" % (parts.scheme, parts.netloc)
+    with self._lock:
+      mirrors, path = self._match(self._groups.items(), url)
+      if not mirrors:
+        # Checked and added in one step, so concurrent downloads from a
+        # new server share its Mirror and its measurements
+        mirrors = self._groups[origin] = [Mirror(origin)]
+        path = url[len(origin):]
+    return mirrors, path
+
+  def probe(self, mirror):
+    """
+    Measures the mirror's round trip time with a HEAD of its root. An
+    unreachable mirror is marked down.
+    """
+    start = time.time()
+    try:
+      urlopen(Request(mirror.base + "/", method="HEAD"),
+              timeout=PROBE_TIMEOUT_S).close()
+    except HTTPError:
+      # Any answer means the mirror serves requests
+      pass
+    except (URLError, OSError):
+      mirror.down_until = time.time() + MIRROR_DOWN_S
+      mirror.probed_at = time.time()
+      return
+    with self._lock:
+      mirror.rtt = _ewma(mirror.rtt, time.time() - start)
+      mirror.probed_at = time.time()
+
+  def _probe_stale(self, mirrors):
+    stale = [m for m in mirrors if time.time() - m.probed_at > PROBE_INTERVAL_S]
+    threads = [threading.Thread(target=self.probe, args=(m,)) for m in stale]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def ranked(self, mirrors):
+    """
+    Healthy mirrors in weighted random order, weighted by the inverse of
+    their expected fetch time shared with the downloads they are already
+    serving, followed by the mirrors that are down.
+    """
+    self._probe_stale(mirrors)
+    with self._lock:
+      known = [m.throughput for m in mirrors if m.throughput]
+      default = sorted(known)[len(known) // 2] if known else 10 * 1024 * 1024
+      pool = [(m, 1.0 / (m.expected_seconds(default) * (1 + m.active)))
+              for m in mirrors if m.healthy]
+      down = sorted((m for m in mirrors if not m.healthy),
+                    key=lambda m: m.down_until)
+    order = []
+    while pool:
+      pick = self._rng.uniform(0, sum(w for _, w in pool))
+      for i, (mirror, weight) in enumerate(pool):
+        pick -= weight
+        if pick <= 0 or i == len(pool) - 1:
+          order.append(pool.pop(i)[0])
+          break
+    return order + down
+
+  def select(self, url):
+    """
+    url on the mirror a download would start on, for artifacts fetched
+    by the node itself.
+    """
+    mirrors, path = self.group(url)
+    if not mirrors:
+      return url
+    return self.ranked(mirrors)[0].base + path
+
+  def download(self, url, path):
+    """
+    Downloads url to path from its mirrors, moving to the next mirror
+    when one fails, stalls or degrades. Stops with Cancelled once the
+    thread's cancellation token (or hedging attempt) is cancelled.
+    """
+    mirrors, rel = self.sources(url)
+    errors = []
+    with open(path, "wb") as f:
+      for mirror in self.ranked(mirrors):
+        offset = f.tell()
+        if offset:
+          MIRROR_FAILOVERS.inc()
+        try:
+          self._fetch(mirror, mirror.base + rel, f, offset)
+          MIRROR_REQUESTS.labels(mirror.base, "ok").inc()
+          return
+        except (MirrorDegraded, URLError, OSError) as e:
+          MIRROR_REQUESTS.labels(mirror.base, "failover").inc()
+          mirror.down_until = time.time() + MIRROR_DOWN_S
+          errors.append("%s: %s" % (mirror.base, e))
+    raise IOError("All mirrors failed for %s: %s" % (url, "; ".join(errors)))
+
+  def _fetch(self, mirror, url, f, offset):
+    headers = {"Range": "bytes=%d-" % offset} if offset else {}
+    with self._lock:
+      mirror.active += 1
+    start = time.time()
+    response = None
+    try:
+      response = urlopen(Request(url, headers=headers),
+                         timeout=STALL_TIMEOUT_S)
+      with self._lock:
+        mirror.rtt = _ewma(mirror.rtt, time.time() - start)
+      if offset and response.status != 206:
+        # No range support: start over
+        f.seek(0)
+        f.truncate()
+      start, received = time.time(), 0
+      token = cancellation.current()
+      with token.interrupting(response.close):
+        while True:
+          try:
+            chunk = response.read(CHUNK_SIZE)
+          except socket.timeout:
+            raise MirrorDegraded("stalled for %ss" % STALL_TIMEOUT_S)
+          token.check()
+          if not chunk:
+            break
+          f.write(chunk)
+          received += len(chunk)
+          elapsed = time.time() - start
+          if mirror.throughput and elapsed > DEGRADED_GRACE_S and \
+              received / elapsed < DEGRADED_FRACTION * mirror.throughput:
+            raise MirrorDegraded("%d B/s, usually %d B/s" % (
+              received / elapsed, mirror.throughput))
+      elapsed = time.time() - start
+      if elapsed > 0 and received:
+        with self._lock:
+          mirror.throughput = _ewma(mirror.throughput, received / elapsed)
+    finally:
+      if response is not None:
+        response.close()
+      with self._lock:
+        mirror.active -= 1
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def registry():
+  """
+  The process-wide registry, loaded from GRIFFON_MIRRORS on first use.
+  """
+  global _registry
+  if _registry is None:
+    with _registry_lock:
+      if _registry is None:
+        _registry = (MirrorRegistry.from_file(MIRRORS_FILE) if MIRRORS_FILE
+                     else MirrorRegistry())
+  return _registry
+
+
+def fetch(url, path):
+  """
+  Downloads url to path from its mirrors. A download slower than usual
+  for url is hedged with a second one.
+  """
+  def attempt_fetch(attempt):
+    part = "%s.part%d" % (path, attempt.index)
+    try:
+      registry().download(url, part)
+    except (Exception, Cancelled):
+      if os.path.exists(part):
+        os.remove(part)
+      raise
+    return part
+
+  part = DOWNLOAD_HEDGER.run(url, attempt_fetch, discard=os.remove)
+  os.rename(part, path)
@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Simulated node farm for exercising the imaging workflow without hardware.
+#
+# Every virtual node is an SSH server (paramiko server mode) listening on
+# its own loopback address (127.0.0.0/8 is routed to lo on Linux, no
+# aliases need to be configured). Nodes emulate the holo/centos, AHV and
+# phoenix fingerprints and the commands issued by RemoteHost/LinuxHost,
+# accept SCP uploads and reboot into the OS of their default grub entry.
+#
+# Point the workflow at the farm with GRIFFON_SSH_PORT=<port>.
+
+import argparse
+import hashlib
+import ipaddress
+import logging
+import random
+import re
+import resource
+import selectors
+import shlex
+import socket
+import threading
+import time
+import uuid
+
+try:
+  import paramiko
+except ImportError:
+  print("Please install paramiko package before running this utility")
+  raise SystemExit("Required package paramiko missing")
+
+from linux_host import AHV_KERNEL, AHV_INITRD, HOLO_KERNEL, HOLO_INITRD
+
+OS_TYPES = ["centos", "ahv", "phoenix"]
+
+UNAME = {
+  "centos": "Linux %s 3.10.0-1062.el7.x86_64 #1 SMP Wed Aug 7 18:08:02 "
+            "UTC 2019 x86_64 x86_64 x86_64 GNU/Linux",
+  "ahv": "Linux %s 4.19.84-2.el7.nutanix.20190916.123.x86_64 #1 SMP "
+         "x86_64 x86_64 x86_64 GNU/Linux",
+  "phoenix": "Linux %s 4.19.84-2.el7.nutanix.20190916.123.x86_64 #1 SMP "
+             "x86_64 x86_64 x86_64 GNU/Linux",
+}
+FINGERPRINT_FILES = {
+  "centos": ["/etc/centos-release"],
+  "ahv": ["/etc/nutanix-release"],
+  "phoenix": ["/usr/bin/layout_finder.py"],
+}
+CENTOS_RELEASE = "CentOS Linux release 7.7.1908 (Core)"
+DF_HEADER = "Filesystem     1K-blocks    Used Available Use% Mounted on"
+GRUB_CFG = {True: "/boot/efi/EFI/centos/grub.cfg",
+            False: "/boot/grub2/grub.cfg"}
+
+# Partition numbers, boot is /dev/sda1
+PARTITIONS = {"boot": 1, "home": 2, "holo": 3, "nutanix": 4}
+
+
+class SimFile(object):
+  __slots__ = ("size", "sha256", "md5", "mode")
+
+  def __init__(self, size=0, sha256="", md5="", mode=0o644):
+    self.size = size
+    self.sha256 = sha256
+    self.md5 = md5
+    self.mode = mode
+
+
+class SimNode(object):
+  """
+  State of one virtual node and the emulation of the commands run on it.
+  """
+  def __init__(self, ip, os_type="centos", uefi=True, boot_delay=30.0,
+               boot_jitter=0.0, boot_failure_rate=0.0,
+               command_failure_rate=0.0, command_latency=0.0, rng=None):
+    self.ip = ip
+    self.os_type = os_type
+    self.uefi = uefi
+    self.boot_delay = boot_delay
+    self.boot_jitter = boot_jitter
+    self.boot_failure_rate = boot_failure_rate
+    self.command_failure_rate = command_failure_rate
+    self.command_latency = command_latency
+    self.rng = rng or random.Random()
+    self.up = True
+    self.powered = True
+    # Boot source override set through the BMC, e.g. ("Pxe", "Once")
+    self.boot_override = None
+    self._boot_generation = 0
+    self.lock = threading.Lock()
+    self.reboots = 0
+    self.commands = 0
+    self.bytes_received = 0
+    self.boot_free_kb = 833536
+    self.uuids = dict((name, str(uuid.uuid4())) for name in PARTITIONS)
+    self.files = {
+      "/boot/%s" % HOLO_KERNEL: SimFile(mode=0o755),
+      "/boot/%s" % HOLO_INITRD: SimFile(),
+      "/boot/%s" % AHV_KERNEL: SimFile(mode=0o755),
+      "/boot/%s" % AHV_INITRD: SimFile(),
+      GRUB_CFG[uefi]: SimFile(),
+    }
+    if os_type != "centos":
+      # Imaged before: the holo kernel was renamed while staging phoenix
+      self.files["/boot/kernel-holo"] = self.files.pop("/boot/%s" % HOLO_KERNEL)
+      self.files["/boot/initrd-holo"] = self.files.pop("/boot/%s" % HOLO_INITRD)
+    self.fstab = ["UUID=%s /boot xfs defaults 0 0" % self.uuids["boot"],
+                  "UUID=%s /home xfs defaults 0 0" % self.uuids["home"],
+                  "UUID=%s /home/nutanix xfs defaults 0 0" %
+                  self.uuids["nutanix"]]
+    self.grub_default = "saved"
+    self.grub_args = {}
+    self.menuentries = self._scan_kernels()
+
+  def _scan_kernels(self):
+    entries = []
+    for path in sorted(self.files):
+      name = path.rsplit("/", 1)[-1]
+      if path.startswith("/boot/") and (name.startswith("vmlinuz-") or
+                                        name.startswith("kernel-")):
+        entries.append("CentOS Linux (%s) 7 (Core)" % name)
+    return entries
+
+  def hostname(self):
+    return "sim-%s" % self.ip.replace(".", "-")
+
+  def fingerprint(self, path):
+    return path in FINGERPRINT_FILES.get(self.os_type, [])
+
+  def exists(self, path):
+    return path in self.files or self.fingerprint(path) or \
+      path in ("/boot", "/home", "/etc/fstab", "/etc/default/grub") or \
+      (path == "/sys/firmware/efi" and self.uefi)
+
+  # Reboots
+
+  def reboot(self):
+    """
+    Takes the node down and boots it into the OS of the default grub
+    entry after the boot delay, unless a boot failure is injected.
+    """
+    with self.lock:
+      if not self.up:
+        return
+      self.up = False
+      self.reboots += 1
+      self._boot_generation += 1
+      generation = self._boot_generation
+    if self.rng.random() < self.boot_failure_rate:
+      # Hung node: stays down until it is power cycled
+      return
+    self._schedule_boot(generation)
+
+  def _schedule_boot(self, generation):
+    delay = self.boot_delay + self.rng.uniform(0, self.boot_jitter)
+    timer = threading.Timer(delay, self._boot, args=(generation,))
+    timer.daemon = True
+    timer.start()
+
+  def _boot(self, generation):
+    with self.lock:
+      # Superseded by a later reboot or power action
+      if generation != self._boot_generation or not self.powered:
+        return
+      target, enabled = self.boot_override or ("Hdd", "Continuous")
+      if enabled == "Once":
+        self.boot_override = None
+      if target != "Hdd":
+        # There is no network or virtual media boot source in the farm
+        return
+      entry = self.grub_default.lower()
+      if "phoenix" in entry:
+        self.os_type = "phoenix"
+      elif "nutanix" in entry:
+        self.os_type = "ahv"
+      else:
+        self.os_type = "centos"
+      self.up = True
+
+  # Power control, as driven through the BMC
+
+  def power_off(self):
+    with self.lock:
+      self.powered = False
+      self.up = False
+      self._boot_generation += 1
+
+  def power_on(self):
+    with self.lock:
+      if self.powered:
+        return
+      self.powered = True
+      self.reboots += 1
+      self._boot_generation += 1
+      generation = self._boot_generation
+    self._schedule_boot(generation)
+
+  def power_cycle(self):
+    self.power_off()
+    self.power_on()
+
+  # Command emulation
+
+  def execute(self, command):
+    """
+    Runs a command line. Returns (stdout, stderr, exit status).
+    """
+    self.commands += 1
+    if self.command_latency:
+      time.sleep(self.command_latency)
+    if self.rng.random() < self.command_failure_rate:
+      return "", "simulated failure\n", 1
+    out, code = [], 0
+    for part in _split_and_list(command):
+      o, e, code = self._run(part.strip())
+      out.append(o)
+      if code:
+        return "".join(out), e, code
+    return "".join(out), "", code
+
+  def _run(self, command):
+    try:
+      argv = shlex.split(command)
+    except ValueError as e:
+      return "", "sh: %s\n" % e, 2
+    if not argv:
+      return "", "", 0
+    if argv[0] == "sudo":
+      argv = argv[1:]
+    handler = getattr(self, "_cmd_%s" % argv[0].replace("-", "_"), None)
+    if handler is None:
+      return "", "sh: %s: command not found\n" % argv[0], 127
+    return handler(argv, command)
+
+  def _cmd_true(self, argv, command):
+    return "", "", 0
+
+  def _cmd_uname(self, argv, command):
+    return UNAME[self.os_type] % self.hostname() + "\n", "", 0
+
+  def _cmd_test(self, argv, command):
+    return "", "", 0 if self._test(argv[1:]) else 1
+
+  def _test(self, args):
+    if args and args[-1] == "]":
+      args = args[:-1]
+    result, negate, i = True, False, 0
+    while i < len(args):
+      arg = args[i]
+      if arg == "!":
+        negate = not negate
+        i += 1
+        continue
+      if arg == "-a":
+        i += 1
+        continue
+      if arg in ("-f", "-e", "-d", "-x") and i + 1 < len(args):
+        path = args[i + 1]
+        if arg == "-x":
+          ok = path in self.files and bool(self.files[path].mode & 0o111)
+        else:
+          ok = self.exists(path)
+        result = result and (ok != negate)
+        negate = False
+        i += 2
+        continue
+      if i + 2 < len(args) and args[i + 1] in ("=", "!="):
+        equal = args[i] == args[i + 2]
+        result = result and (equal == (args[i + 1] == "="))
+        i += 3
+        continue
+      return False
+    return result
+
+  def _cmd_cat(self, argv, command):
+    path = argv[-1]
+    if path == "/etc/fstab":
+      return "\n".join(self.fstab) + "\n", "", 0
+    if path == "/etc/centos-release" and self.os_type == "centos":
+      return CENTOS_RELEASE + "\n", "", 0
+    if path == "/etc/default/grub":
+      return 'GRUB_TIMEOUT=5\nGRUB_DEFAULT="%s"\n' % self.grub_default, "", 0
+    return "", "cat: %s: No such file or directory\n" % path, 1
+
+  def _cmd_df(self, argv, command):
+    mount = argv[-1]
+    if mount not in ("/boot", "/home"):
+      return "", "df: %s: No such file or directory\n" % mount, 1
+    return "%s\n/dev/sda%d 1038336 %d %d %d%% %s\n" % (
+      DF_HEADER, PARTITIONS[mount.strip("/")], 1038336 - self.boot_free_kb,
+      self.boot_free_kb, 100 - self.boot_free_kb * 100 // 1038336,
+      mount), "", 0
+
+  def _partition(self, device):
+    match = re.match(r"^/dev/sda(\d+)$", device)
+    if not match:
+      return None
+    for name, number in PARTITIONS.items():
+      if number == int(match.group(1)):
+        return name
+    return None
+
+  def _cmd_blkid(self, argv, command):
+    name = self._partition(argv[-1])
+    if name is None:
+      return "", "", 2
+    if "-o" in argv and "value" in argv:
+      return self.uuids[name] + "\n", "", 0
+    return '%s: UUID="%s" TYPE="xfs"\n' % (argv[-1], self.uuids[name]), "", 0
+
+  def _cmd_lsblk(self, argv, command):
+    if self._partition(argv[-1]) is None:
+      return "", "lsblk: %s: not a block device\n" % argv[-1], 32
+    return "sda\n", "", 0
+
+  def _cmd_chmod(self, argv, command):
+    for path in argv[2:]:
+      if path not in self.files:
+        return "", "chmod: cannot access '%s'\n" % path, 1
+      self.files[path].mode |= 0o111
+    return "", "", 0
+
+  def _cmd_mv(self, argv, command):
+    src, dst = argv[-2], argv[-1]
+    if src not in self.files:
+      return "", "mv: cannot stat '%s'\n" % src, 1
+    self.files[dst] = self.files.pop(src)
+    return "", "", 0
+
+  def _cmd_cp(self, argv, command):
+    src, dst = argv[-2], argv[-1]
+    if src not in self.files:
+      return "", "cp: cannot stat '%s'\n" % src, 1
+    orig = self.files[src]
+    self.files[dst] = SimFile(orig.size, orig.sha256, orig.md5, orig.mode)
+    return "", "", 0
+
+  def _cmd_sed(self, argv, command):
+    if argv[-1] == "/etc/default/grub":
+      match = re.search(r'GRUB_DEFAULT="(.*)"/g', command)
+      if match:
+        self.grub_default = match.group(1)
+      return "", "", 0
+    if argv[-1] == "/etc/fstab":
+      match = re.search(r"@\^(\S+)@d", command)
+      if match:
+        self.fstab = [l for l in self.fstab
+                      if not l.startswith(match.group(1))]
+      return "", "", 0
+    return "", "", 0
+
+  def _cmd_grub2_mkconfig(self, argv, command):
+    self.menuentries = self._scan_kernels()
+    return "", "Generating grub configuration file ...\ndone\n", 0
+
+  def _cmd_awk(self, argv, command):
+    return "".join("%s\n" % e for e in self.menuentries), "", 0
+
+  def _cmd_grubby(self, argv, command):
+    kernel = argv[-1]
+    if kernel not in self.files:
+      return "", "grubby: kernel not found\n", 1
+    if argv[1] == "--info":
+      return ('index=0\nkernel=%s\nargs="%s"\ntitle=CentOS Linux\n' %
+              (kernel, self.grub_args.get(kernel, ""))), "", 0
+    match = re.search(r'--(remove-args|args)="(.*?)" --update-kernel', command)
+    if not match:
+      return "", "grubby: bad arguments\n", 1
+    if match.group(1) == "args":
+      self.grub_args[kernel] = match.group(2)
+    else:
+      self.grub_args[kernel] = ""
+    return "", "", 0
+
+  def _cmd_reboot(self, argv, command):
+    # Like `reboot -f`, new connections fail right away
+    self.reboot()
+    return "", "", 0
+
+  def _cmd_sh(self, argv, command):
+    """
+    Evaluates the `if <check>; then echo name=1; ...` probes of steps.Phase
+    for plain test/[ checks, and the preflight probe. Anything else is
+    reported as unsatisfied.
+    """
+    if "echo boot_free_kb=" in argv[-1]:
+      return self._preflight(argv[-1]), "", 0
+    out = []
+    for cond, name in re.findall(
+        r"if (.*?); then echo (\S+)=1; else echo \S+=0; fi", argv[-1]):
+      try:
+        args = shlex.split(cond)
+      except ValueError:
+        args = []
+      ok = bool(args) and args[0] in ("test", "[") and self._test(args[1:])
+      out.append("%s=%d\n" % (name, 1 if ok else 0))
+    return "".join(out), "", 0
+
+  def _preflight(self, script):
+    out = ["boot_free_kb=%d" % self.boot_free_kb,
+           "boot_mode=%s" % ("uefi" if self.uefi else "bios")]
+    if GRUB_CFG[self.uefi] in self.files:
+      out.append("grub_cfg=%s" % GRUB_CFG[self.uefi])
+    files = re.search(r"for f in (.*?); do", script)
+    for name in (files.group(1).split() if files else []):
+      if "/boot/%s" % name in self.files:
+        out.append("file_%s=1" % name)
+    parts = re.search(r"for p in (.*?); do", script)
+    for number in (parts.group(1).split() if parts else []):
+      name = self._partition("/dev/sda%s" % number)
+      out.append("part_%s=%s" % (number, self.uuids[name] if name else ""))
+    return "".join("%s\n" % line for line in out)
+
+  def _cmd_python(self, argv, command):
+    return "", "", 0
+
+  def receive_file(self, path, size, sha256, md5):
+    self.bytes_received += size
+    self.files[path] = SimFile(size, sha256, md5)
+    if path.startswith("/boot/"):
+      self.menuentries = self._scan_kernels()
+
+
+def _split_and_list(command):
+  """
+  Splits `a && b && c` on the unquoted `&&` separators.
+  """
+  parts, start, quote, i = [], 0, None, 0
+  while i < len(command):
+    c = command[i]
+    if c == "\\" and quote != "'":
+      i += 2
+      continue
+    if quote:
+      if c == quote:
+        quote = None
+    elif c in "'\"":
+      quote = c
+    elif command.startswith("&&", i):
+      parts.append(command[start:i])
+      start = i + 2
+      i += 1
+    i += 1
+  parts.append(command[start:])
+  return parts
+
+
+class _SimServer(paramiko.ServerInterface):
+  def __init__(self, node):
+    self.node = node
+
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL
+
+  def get_allowed_auths(self, username):
+    return "password"
+
+  def check_channel_request(self, kind, chanid):
+    if kind == "session":
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+  def check_channel_pty_request(self, *args):
+    return True
+
+  def check_channel_exec_request(self, channel, command):
+    command = command.decode("utf-8", "replace")
+    handler = _scp_sink if command.startswith("scp ") else _exec
+    thread = threading.Thread(target=handler,
+                              args=(self.node, channel, command))
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def _exec(node, channel, command):
+  try:
+    out, err, code = node.execute(command)
+    if out:
+      channel.sendall(out.encode())
+    if err:
+      channel.sendall_stderr(err.encode())
+    channel.send_exit_status(code)
+    # The exec request reply may still be queued behind this thread, a
+    # close would beat it; leave closing the channel to the client.
+    channel.shutdown_write()
+  except (EOFError, socket.error, paramiko.SSHException):
+    channel.close()
+
+
+def _read_line(channel):
+  line = b""
+  while not line.endswith(b"\n"):
+    data = channel.recv(1)
+    if not data:
+      return None
+    line += data
+  return line
+
+
+def _scp_sink(node, channel, command):
+  """
+  Minimal `scp -t` sink: accepts C (file) records and discards payloads,
+  keeping only their size and digests.
+  """
+  target = shlex.split(command)[-1]
+  try:
+    channel.sendall(b"\0")
+    while True:
+      line = _read_line(channel)
+      if line is None:
+        break
+      if line[:1] in (b"T", b"D", b"E"):
+        channel.sendall(b"\0")
+        continue
+      if line[:1] != b"C":
+        break
+      _, size, name = line.decode().rstrip("\n").split(" ", 2)
+      size = int(size)
+      channel.sendall(b"\0")
+      sha256, md5, remaining = hashlib.sha256(), hashlib.md5(), size
+      while remaining:
+        data = channel.recv(min(remaining, 32768))
+        if not data:
+          raise EOFError()
+        sha256.update(data)
+        md5.update(data)
+        remaining -= len(data)
+      channel.recv(1)
+      path = target
+      if node.exists(target) and target not in node.files:
+        path = "%s/%s" % (target.rstrip("/"), name)
+      node.receive_file(path, size, sha256.hexdigest(), md5.hexdigest())
+      channel.sendall(b"\0")
+    channel.send_exit_status(0)
+  except (EOFError, socket.error, paramiko.SSHException, ValueError):
+    pass
+  finally:
+    channel.close()
+
+
+class NodeFarm(object):
+  """
+  A set of simulated nodes served from one accept loop.
+
+  Connections to a node that is rebooting are reset, like a real host
+  whose sshd is not up yet.
+  """
+  def __init__(self, count, base_ip="127.1.0.1", port=2222, **node_kwargs):
+    self.port = port
+    self.nodes = {}
+    first = ipaddress.ip_address(base_ip)
+    for i in range(count):
+      ip = str(first + i)
+      self.nodes[ip] = SimNode(ip, **node_kwargs)
+    self._selector = selectors.DefaultSelector()
+    self._host_key = None
+    self._thread = None
+    self._stopped = threading.Event()
+    self.connections = 0
+
+  def ips(self):
+    return list(self.nodes)
+
+  def start(self):
+    _raise_fd_limit()
+    self._host_key = paramiko.RSAKey.generate(2048)
+    for ip, node in self.nodes.items():
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind((ip, self.port))
+      sock.listen(64)
+      sock.setblocking(False)
+      self._selector.register(sock, selectors.EVENT_READ, node)
+    self._thread = threading.Thread(target=self._serve)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def _serve(self):
+    while not self._stopped.is_set():
+      for key, _ in self._selector.select(timeout=0.5):
+        try:
+          conn, _ = key.fileobj.accept()
+        except socket.error:
+          continue
+        node = key.data
+        if not node.up:
+          conn.close()
+          continue
+        self.connections += 1
+        conn.setblocking(True)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self._host_key)
+        try:
+          # Handshakes complete on the transport's own thread
+          transport.start_server(event=threading.Event(),
+                                 server=_SimServer(node))
+        except (paramiko.SSHException, EOFError, socket.error):
+          transport.close()
+
+  def stop(self):
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+    for key in list(self._selector.get_map().values()):
+      self._selector.unregister(key.fileobj)
+      key.fileobj.close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+
+def _raise_fd_limit():
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulated node farm for "
+                                               "the imaging workflow")
+  parser.add_argument("-n", "--nodes", type=int, default=10,
+                      help="Number of virtual nodes")
+  parser.add_argument("--base-ip", default="127.1.0.1",
+                      help="Loopback address of the first node")
+  parser.add_argument("--port", type=int, default=2222,
+                      help="SSH port every node listens on")
+  parser.add_argument("--os", dest="os_type", default="centos",
+                      choices=OS_TYPES, help="OS the nodes start in")
+  parser.add_argument("--bios", action="store_true",
+                      help="Emulate legacy BIOS boot instead of UEFI")
+  parser.add_argument("--boot-delay", type=float, default=30.0)
+  parser.add_argument("--boot-jitter", type=float, default=0.0)
+  parser.add_argument("--boot-failure-rate", type=float, default=0.0)
+  parser.add_argument("--command-failure-rate", type=float, default=0.0)
+  parser.add_argument("--command-latency", type=float, default=0.0)
+  parser.add_argument("--redfish-port", type=int, default=0,
+                      help="Also serve a Redfish BMC for every node on "
+                           "this port of 127.0.0.1")
+  args = parser.parse_args()
+  # Client disconnects are routine for the farm
+  logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+  farm = NodeFarm(args.nodes, base_ip=args.base_ip, port=args.port,
+                  os_type=args.os_type, uefi=not args.bios,
+                  boot_delay=args.boot_delay, boot_jitter=args.boot_jitter,
+                  boot_failure_rate=args.boot_failure_rate,
+                  command_failure_rate=args.command_failure_rate,
+                  command_latency=args.command_latency)
+  farm.start()
+  ips = farm.ips()
+  print("Serving %d nodes %s..%s on port %d" % (len(ips), ips[0], ips[-1],
+                                                args.port))
+  if args.redfish_port:
+    from redfish_mock import RedfishMock
+    bmc = RedfishMock(farm, port=args.redfish_port).start()
+    print("Serving Redfish at %s, system id is the node ip" % bmc.address)
+  try:
+    while True:
+      time.sleep(60)
+  except KeyboardInterrupt:
+    farm.stop()
+
+if __name__ == "__main__":
+  main()
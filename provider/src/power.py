@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Out-of-band power control of nodes through their BMC.
+#
+# A node whose config has a "bmc" section, e.g.
+#   "bmc": {"type": "redfish", "address": "https://10.1.1.10",
+#           "user": "ADMIN", "password": "..."}
+# gets a PowerController. The boot waiters use it to power cycle a node
+# that has not come back from a reboot after POWER_CYCLE_AFTER_S, instead
+# of waiting out the whole boot budget on a hung node.
+#
+# Drivers: "redfish" (default) and "ipmi" (needs ipmitool). Others can be
+# added with register_driver().
+
+import base64
+import json
+import os
+import ssl
+import subprocess
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from metrics import REGISTRY
+from tracing import span
+
+# Well within MAX_BOOT_WAIT_S, so a hung node is power cycled while most of
+# the boot budget is left
+POWER_CYCLE_AFTER_S = int(os.environ.get("GRIFFON_POWER_CYCLE_AFTER_S", "120"))
+MAX_POWER_CYCLES = 1
+BMC_TIMEOUT_S = 30
+BOOT_DEVICES = ("disk", "pxe", "cd")
+
+POWER_ACTIONS = REGISTRY.counter(
+  "griffon_power_actions", "BMC power control requests", ["action", "result"])
+
+
+class PowerError(Exception):
+  pass
+
+
+class PowerController(object):
+  """
+  Power control of one node.
+  """
+  def power_state(self):
+    """
+    Returns "On" or "Off".
+    """
+    raise NotImplementedError
+
+  def power_cycle(self):
+    """
+    Power cycles the node, or powers it on if it is off.
+    """
+    raise NotImplementedError
+
+  def set_boot_device(self, device, once=True):
+    """
+    Boots from device ("disk", "pxe" or "cd") on the next boot, or on
+    every boot unless once.
+    """
+    raise NotImplementedError
+
+
+class RedfishPower(PowerController):
+  BOOT_TARGETS = {"disk": "Hdd", "pxe": "Pxe", "cd": "Cd"}
+  # Preferred reset types for a node that is on, best first
+  RESET_TYPES = ("PowerCycle", "ForceRestart", "GracefulRestart")
+
+  def __init__(self, address, user="", password="", system_id=None,
+               timeout=BMC_TIMEOUT_S, verify=False):
+    if "://" not in address:
+      address = "https://%s" % address
+    self.address = address.rstrip("/")
+    self.system_id = system_id
+    self.timeout = timeout
+    self._auth = "Basic %s" % base64.b64encode(
+      ("%s:%s" % (user, password)).encode()).decode()
+    # BMCs mostly serve self-signed certificates
+    self._ssl = None if verify else ssl._create_unverified_context()
+    self._system = None
+
+  def _request(self, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = Request(self.address + path, data=data, method=method, headers={
+      "Authorization": self._auth, "Content-Type": "application/json",
+      "Accept": "application/json"})
+    try:
+      response = urlopen(request, timeout=self.timeout, context=self._ssl)
+      text = response.read()
+    except HTTPError as e:
+      raise PowerError("Redfish %s %s: HTTP %s %s" % (
+        method, path, e.code, e.read()[:200]))
+    except (URLError, OSError) as e:
+      raise PowerError("Redfish %s %s: %s" % (method, path, e))
+    return json.loads(text) if text else {}
+
+  def system(self):
+    """
+    Path of the node's ComputerSystem resource.
+    """
+    if self._system is None:
+      if self.system_id:
+        self._system = "/redfish/v1/Systems/%s" % self.system_id
+      else:
+        members = self._request("GET", "/redfish/v1/Systems")["Members"]
+        if not members:
+          raise PowerError("BMC %s has no systems" % self.address)
+        self._system = members[0]["@odata.id"]
+    return self._system
+
+  def power_state(self):
+    return self._request("GET", self.system())["PowerState"]
+
+  def power_cycle(self):
+    system = self._request("GET", self.system())
+    if system.get("PowerState") == "Off":
+      reset_type = "On"
+    else:
+      action = system.get("Actions", {}).get("#ComputerSystem.Reset", {})
+      allowed = action.get("ResetType@Redfish.AllowableValues",
+                           self.RESET_TYPES)
+      reset_type = next((t for t in self.RESET_TYPES if t in allowed),
+                        "ForceRestart")
+    self._request("POST", self.system() + "/Actions/ComputerSystem.Reset",
+                  {"ResetType": reset_type})
+
+  def set_boot_device(self, device, once=True):
+    self._request("PATCH", self.system(), {"Boot": {
+      "BootSourceOverrideTarget": self.BOOT_TARGETS[device],
+      "BootSourceOverrideEnabled": "Once" if once else "Continuous"}})
+
+
+class IpmiPower(PowerController):
+  BOOT_DEVICES = {"disk": "disk", "pxe": "pxe", "cd": "cdrom"}
+
+  def __init__(self, address, user="", password="", timeout=BMC_TIMEOUT_S,
+               **kwargs):
+    self.address = address
+    self.user = user
+    self.password = password
+    self.timeout = timeout
+
+  def _ipmitool(self, *args):
+    # The password goes through the environment, not the command line
+    env = dict(os.environ, IPMI_PASSWORD=self.password)
+    cmd = ["ipmitool", "-I", "lanplus", "-H", self.address, "-U", self.user,
+           "-E"] + list(args)
+    try:
+      proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, env=env)
+      out, err = proc.communicate(timeout=self.timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+      raise PowerError("ipmitool %s: %s" % (" ".join(args), e))
+    if proc.returncode:
+      raise PowerError("ipmitool %s: %s" % (" ".join(args),
+                                            err.decode().strip()))
+    return out.decode()
+
+  def power_state(self):
+    out = self._ipmitool("chassis", "power", "status")
+    return "On" if out.strip().lower().endswith("on") else "Off"
+
+  def power_cycle(self):
+    if self.power_state() == "Off":
+      self._ipmitool("chassis", "power", "on")
+    else:
+      self._ipmitool("chassis", "power", "cycle")
+
+  def set_boot_device(self, device, once=True):
+    args = ["chassis", "bootdev", self.BOOT_DEVICES[device]]
+    if not once:
+      args.append("options=persistent")
+    self._ipmitool(*args)
+
+
+DRIVERS = {"redfish": RedfishPower, "ipmi": IpmiPower}
+
+
+def register_driver(name, cls):
+  DRIVERS[name] = cls
+
+
+def from_config(config):
+  """
+  PowerController for the node's "bmc" config, None without one.
+  """
+  bmc = (config or {}).get("bmc")
+  if not bmc:
+    return None
+  kwargs = dict(bmc)
+  driver = kwargs.pop("type", "redfish")
+  if driver not in DRIVERS:
+    raise PowerError("Unknown BMC type %s" % driver)
+  return DRIVERS[driver](**kwargs)
+
+
+def power_cycle(controller, node_ip, boot_device=None):
+  """
+  Power cycles a node, booting it from boot_device once if given.
+  Returns (ok, err) like the host workflows.
+  """
+  with span("power.cycle", node_ip=node_ip, boot_device=boot_device) as s:
+    try:
+      if boot_device:
+        controller.set_boot_device(boot_device)
+      controller.power_cycle()
+    except PowerError as e:
+      POWER_ACTIONS.labels("power_cycle", "error").inc()
+      s.set(error=str(e))
+      return False, str(e)
+  POWER_ACTIONS.labels("power_cycle", "ok").inc()
+  return True, ""
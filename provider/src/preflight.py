@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Preflight checks of a batch of nodes before imaging.
+#
+# Each node is probed with a single ssh command that reports everything
+# stage_phoenix and reboot_to_target will depend on, so nodes that would
+# fail partway through are turned away before anything is downloaded or
+# copied to them:
+#   ssh         the node answers over ssh
+#   config      the config has the partition_table ids
+#   artifacts   the phoenix kernel and initrd can be fetched
+#   space       /boot has room for the phoenix kernel and initrd
+#   boot_mode   the node boots as the config's boot_mode, if it sets one,
+#               and the grub config of its boot mode exists
+#   kernels     the holo kernel and initrd are in /boot
+#   partitions  the nutanix and holo partitions have a UUID
+#
+# Example:
+#   python preflight.py config/node_172.26.1.5.json config/node_172.26.1.7.json
+
+import argparse
+import json
+import sys
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from fanout import DEFAULT_PARALLELISM, DEFAULT_TIMEOUT_S, run_on_nodes
+from linux_host import BOOT_DISK_SH, HOLO_INITRD, HOLO_KERNEL
+from metrics import REGISTRY
+import mirrors
+from steps import quote
+
+PAYLOAD_FIELDS = ("kernel", "initrd")
+PARTITIONS = ("nutanix", "holo")
+# Free space /boot needs over the size of the phoenix payload
+SPACE_MARGIN = 1.2
+ARTIFACT_TIMEOUT_S = 10
+GRUB_CFG = {"uefi": "/boot/efi/EFI/centos/grub.cfg",
+            "bios": "/boot/grub2/grub.cfg"}
+# Holo kernel and initrd, or their names once rename_holo_kernel ran
+KERNELS = ((HOLO_KERNEL, "kernel-holo"), (HOLO_INITRD, "initrd-holo"))
+
+PREFLIGHT_NODES = REGISTRY.counter(
+  "griffon_preflight_nodes", "Nodes checked before imaging", ["result"])
+PREFLIGHT_FAILURES = REGISTRY.counter(
+  "griffon_preflight_failures", "Failed preflight checks", ["check"])
+
+
+class NodeReport(object):
+  __slots__ = ("ip", "problems", "facts", "duration", "payload_bytes")
+
+  def __init__(self, ip):
+    self.ip = ip
+    self.problems = []
+    self.facts = {}
+    self.duration = 0
+    # Size of the phoenix payload, as far as the servers tell
+    self.payload_bytes = 0
+
+  @property
+  def go(self):
+    return not self.problems
+
+  def fail(self, check, message):
+    self.problems.append((check, message))
+
+  def summary(self):
+    return "; ".join("%s: %s" % problem for problem in self.problems)
+
+  def __repr__(self):
+    return "NodeReport(%s, %s)" % (self.ip, "go" if self.go else "no-go")
+
+
+def partition_ids(config):
+  """
+  Returns {name: id} of the config's partition_table, and the names
+  whose id is missing.
+  """
+  table = config.get("partition_table") or {}
+  ids, missing = {}, []
+  for name in PARTITIONS:
+    part_id = (table.get(name) or {}).get("id")
+    if isinstance(part_id, int) and not isinstance(part_id, bool):
+      ids[name] = part_id
+    else:
+      missing.append(name)
+  return ids, missing
+
+
+def probe_script(config):
+  """
+  Shell script printing key=value facts about the node for config.
+  """
+  ids, _ = partition_ids(config)
+  files = " ".join(name for pair in KERNELS for name in pair)
+  script = (
+    "echo boot_free_kb=$(df -Pk /boot | awk 'NR==2 {print $4}'); "
+    "if [ -d /sys/firmware/efi ]; then mode=uefi; cfg=%s; "
+    "else mode=bios; cfg=%s; fi; echo boot_mode=$mode; "
+    "[ -f $cfg ] && echo grub_cfg=$cfg; "
+    "for f in %s; do [ -f /boot/$f ] && echo file_$f=1; done; " % (
+      GRUB_CFG["uefi"], GRUB_CFG["bios"], files))
+  if ids:
+    script += (
+      "%s; for p in %s; do "
+      "echo part_$p=$(blkid -s UUID -o value $dev$p); done; " % (
+        BOOT_DISK_SH, " ".join(str(i) for i in sorted(ids.values()))))
+  return script + "true"
+
+
+def parse_facts(out):
+  facts = {}
+  for line in out.splitlines():
+    key, sep, value = line.strip().partition("=")
+    if sep:
+      facts[key] = value
+  return facts
+
+
+class ArtifactSizes(object):
+  """
+  Sizes of the artifacts of a batch, each looked up once.
+  """
+  def __init__(self):
+    self._sizes = {}
+
+  def size(self, url):
+    """
+    Returns (size or None if the server does not say, error).
+    """
+    if url not in self._sizes:
+      self._sizes[url] = self._head(mirrors.registry().select(url))
+    return self._sizes[url]
+
+  @staticmethod
+  def _head(url):
+    try:
+      response = urlopen(Request(url, method="HEAD"),
+                         timeout=ARTIFACT_TIMEOUT_S)
+      length = response.headers.get("Content-Length")
+      response.close()
+    except HTTPError as e:
+      return None, "HTTP %s" % e.code
+    except (URLError, OSError) as e:
+      return None, str(e)
+    return (int(length) if length and length.isdigit() else None), ""
+
+
+def evaluate(report, config, result, sizes):
+  """
+  Checks the facts probed from one node against its config.
+  """
+  report.duration = result.duration
+  ids, missing = partition_ids(config)
+  if missing:
+    report.fail("config", "no partition_table id for %s" % ", ".join(missing))
+
+  payload = 0
+  for name in PAYLOAD_FIELDS:
+    url = ((config.get("phoenix") or {}).get(name) or {}).get("url")
+    if not url:
+      report.fail("config", "no phoenix %s url" % name)
+      continue
+    size, err = sizes.size(url)
+    if err:
+      report.fail("artifacts", "cannot fetch %s: %s" % (url, err))
+    payload += size or 0
+  report.payload_bytes = payload
+
+  if result.exit_status != 0:
+    report.fail("ssh", "unreachable: %s" % (
+      result.err.strip() or "exit %s" % result.exit_status))
+    return report
+  facts = report.facts = parse_facts(result.out)
+
+  free_kb = facts.get("boot_free_kb", "")
+  if not free_kb.isdigit():
+    report.fail("space", "cannot read free space of /boot")
+  elif int(free_kb) * 1024 < payload * SPACE_MARGIN:
+    report.fail("space", "/boot has %d MB free, the payload needs %d MB" % (
+      int(free_kb) // 1024, payload * SPACE_MARGIN // (1024 * 1024)))
+
+  mode = facts.get("boot_mode")
+  expected = config.get("boot_mode")
+  if expected and mode != expected.lower():
+    report.fail("boot_mode", "booted in %s, expected %s" % (mode, expected))
+  if not facts.get("grub_cfg"):
+    report.fail("boot_mode", "no %s for %s boot" % (GRUB_CFG.get(mode), mode))
+
+  for names in KERNELS:
+    if not any(facts.get("file_%s" % name) for name in names):
+      report.fail("kernels", "/boot/%s is missing" % names[0])
+
+  for name, part_id in sorted(ids.items()):
+    if not facts.get("part_%d" % part_id):
+      report.fail("partitions", "%s partition %d has no UUID" % (name,
+                                                                 part_id))
+  return report
+
+
+def preflight(nodes, parallelism=DEFAULT_PARALLELISM,
+              timeout=DEFAULT_TIMEOUT_S, user="root"):
+  """
+  Checks every node in {ip: config} concurrently, one probe per node.
+  Returns {ip: NodeReport}.
+  """
+  sizes = ArtifactSizes()
+  reports = {}
+
+  def command(ip):
+    return ["sh", "-c", quote(probe_script(nodes[ip]))]
+
+  for result in run_on_nodes(list(nodes), command, parallelism, timeout,
+                             user):
+    report = evaluate(NodeReport(result.ip), nodes[result.ip], result, sizes)
+    PREFLIGHT_NODES.labels("go" if report.go else "no_go").inc()
+    for check in set(check for check, _ in report.problems):
+      PREFLIGHT_FAILURES.labels(check).inc()
+    reports[result.ip] = report
+  return reports
+
+
+def format_report(reports):
+  lines = []
+  for ip in sorted(reports):
+    report = reports[ip]
+    lines.append("%-15s %-5s %s" % (ip, "go" if report.go else "NO-GO",
+                                    report.summary()))
+  go = sum(1 for report in reports.values() if report.go)
+  lines.append("%d of %d nodes go" % (go, len(reports)))
+  return "\n".join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Check nodes before imaging them")
+  parser.add_argument("configs", nargs="+",
+                      help="Node config files, as given to stage_phoenix")
+  parser.add_argument("-p", "--parallelism", type=int,
+                      default=DEFAULT_PARALLELISM)
+  parser.add_argument("-t", "--timeout", type=int, default=DEFAULT_TIMEOUT_S,
+                      help="Per node timeout in seconds")
+  parser.add_argument("--user", default="root")
+  args = parser.parse_args()
+
+  nodes = {}
+  for path in args.configs:
+    with open(path) as f:
+      config = json.load(f)
+    nodes[config["hypervisor_ip"]] = config
+  start = time.time()
+  reports = preflight(nodes, args.parallelism, args.timeout, args.user)
+  print(format_report(reports))
+  print("checked in %.1fs" % (time.time() - start))
+  sys.exit(0 if all(report.go for report in reports.values()) else 1)
+
+
+if __name__ == "__main__":
+  main()
@@ -6,7 +6,10 @@
 #
 # Class to boot node into AHV.
 
+from griffon_log import log_context
+from job_store import JobStore
 from remote_host import (RemoteHost, module_print)
+from tracing import job_span
 
 class RebootToAhv(object):
   """
@@ -32,10 +35,18 @@ class RebootToAhv(object):
     import json
     with open(self.options.config, "r") as f:
       cfg = json.load(f)
-    ret, err = self.host.reboot_to_target(target="ahv", config=cfg)
+    # Resumes an interrupted run from its last checkpoint
+    self.host.job = JobStore().open_job(self.options.node_ip,
+                                        "reboot_to_ahv", cfg)
+    with job_span("reboot_to_ahv", node_ip=self.options.node_ip,
+                  job_id=self.host.job.job_id), \
+        log_context(node_ip=self.options.node_ip,
+                    session=self.host.job.job_id):
+      ret, err = self.host.reboot_to_target(target="ahv", config=cfg)
+    self.host.job.finish(ret, err)
     if not ret:
-      module_print("Unable to boot node [%s] into Ahv err: [%s]" %
-                   (self.options.node_ip, err))
+      module_print("Unable to boot node [%s] into Ahv err: [%s]",
+                   self.options.node_ip, err)
       return False
 
     # wait for node to boot into Ahv
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Minimal Redfish BMC for the simulated node farm.
+#
+# Serves a ComputerSystem per farm node, with the node ip as system id:
+# power state, ComputerSystem.Reset and one-time boot source overrides,
+# enough for power.RedfishPower. Start it with node_simulator.py
+# --redfish-port, or from code:
+#
+#   bmc = RedfishMock(farm).start()
+#   config["bmc"] = bmc.bmc_config(ip)
+
+import base64
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SYSTEMS = "/redfish/v1/Systems"
+RESET_TYPES = ["On", "ForceOff", "GracefulShutdown", "ForceRestart",
+               "PowerCycle"]
+BOOT_TARGETS = ["None", "Pxe", "Hdd", "Cd"]
+
+
+class _Handler(BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def _reply(self, code, body=None):
+    data = json.dumps(body).encode() if body is not None else b""
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _node(self):
+    """
+    Returns (node, rest of the path) for /redfish/v1/Systems/<ip>[/...].
+    """
+    if self.headers.get("Authorization") != self.server.mock.auth:
+      self._reply(401, {"error": "unauthorized"})
+      return None, None
+    path = self.path.rstrip("/")
+    if not path.startswith(SYSTEMS + "/"):
+      self._reply(404, {"error": "not found"})
+      return None, None
+    ip, _, rest = path[len(SYSTEMS) + 1:].partition("/")
+    node = self.server.mock.farm.nodes.get(ip)
+    if node is None:
+      self._reply(404, {"error": "no system %s" % ip})
+    return node, rest
+
+  def _body(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    return json.loads(self.rfile.read(length) or b"{}")
+
+  def do_GET(self):
+    if self.path.rstrip("/") == SYSTEMS:
+      if self.headers.get("Authorization") != self.server.mock.auth:
+        return self._reply(401, {"error": "unauthorized"})
+      return self._reply(200, {"Members": [
+        {"@odata.id": "%s/%s" % (SYSTEMS, ip)}
+        for ip in self.server.mock.farm.nodes]})
+    node, rest = self._node()
+    if node is None:
+      return
+    if rest:
+      return self._reply(404, {"error": "not found"})
+    target, enabled = node.boot_override or ("None", "Disabled")
+    self._reply(200, {
+      "@odata.id": "%s/%s" % (SYSTEMS, node.ip),
+      "Id": node.ip,
+      "HostName": node.hostname(),
+      "PowerState": "On" if node.powered else "Off",
+      "Boot": {"BootSourceOverrideTarget": target,
+               "BootSourceOverrideEnabled": enabled,
+               "BootSourceOverrideTarget@Redfish.AllowableValues":
+                 BOOT_TARGETS},
+      "Actions": {"#ComputerSystem.Reset": {
+        "target": "%s/%s/Actions/ComputerSystem.Reset" % (SYSTEMS, node.ip),
+        "ResetType@Redfish.AllowableValues": RESET_TYPES}},
+    })
+
+  def do_POST(self):
+    node, rest = self._node()
+    if node is None:
+      return
+    if rest != "Actions/ComputerSystem.Reset":
+      return self._reply(404, {"error": "not found"})
+    reset_type = self._body().get("ResetType")
+    if reset_type not in RESET_TYPES:
+      return self._reply(400, {"error": "bad ResetType %s" % reset_type})
+    self.server.mock.record(node.ip, reset_type)
+    if reset_type == "On":
+      node.power_on()
+    elif reset_type in ("ForceOff", "GracefulShutdown"):
+      node.power_off()
+    else:
+      node.power_cycle()
+    self._reply(204)
+
+  def do_PATCH(self):
+    node, rest = self._node()
+    if node is None:
+      return
+    if rest:
+      return self._reply(404, {"error": "not found"})
+    boot = self._body().get("Boot", {})
+    target = boot.get("BootSourceOverrideTarget", "None")
+    enabled = boot.get("BootSourceOverrideEnabled", "Once")
+    if target not in BOOT_TARGETS:
+      return self._reply(400, {"error": "bad boot target %s" % target})
+    self.server.mock.record(node.ip, "Boot:%s:%s" % (target, enabled))
+    with node.lock:
+      node.boot_override = None if target == "None" else (target, enabled)
+    self._reply(204)
+
+
+class RedfishMock(object):
+  def __init__(self, farm, host="127.0.0.1", port=0, user="admin",
+               password="admin"):
+    self.farm = farm
+    self.user = user
+    self.password = password
+    self.auth = "Basic %s" % base64.b64encode(
+      ("%s:%s" % (user, password)).encode()).decode()
+    self.actions = []
+    self._lock = threading.Lock()
+    self._server = ThreadingHTTPServer((host, port), _Handler)
+    self._server.daemon_threads = True
+    self._server.mock = self
+    self._thread = None
+
+  @property
+  def address(self):
+    host, port = self._server.server_address[:2]
+    return "http://%s:%d" % (host, port)
+
+  def record(self, ip, action):
+    with self._lock:
+      self.actions.append((ip, action))
+
+  def bmc_config(self, ip):
+    """
+    The "bmc" node config section for a farm node.
+    """
+    return {"type": "redfish", "address": self.address, "user": self.user,
+            "password": self.password, "system_id": ip}
+
+  def start(self):
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
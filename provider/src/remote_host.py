@@ -6,17 +6,34 @@
 #
 # This script kickstarts imaging process on remote cloud instance.
 
+import functools
 import json
+import logging
 import os
+import shlex
 import socket
 import sys
 import time
 import threading
 
-SSH_TIMEOUT = 30
+import cancellation
+from griffon_log import get_logger
+from hedging import Hedger
+from job_store import Job
+from metrics import BYTES_PER_S_BUCKETS, REGISTRY
+import power
+import replay
+from step_history import history
+from tracing import span
+
+try:
+  StandardError
+except NameError:
+  StandardError = Exception
+
 SSH_SEMA = threading.Semaphore(value=32)
-MAX_BOOT_WAIT_CYCLES = 6 * 60     # 1 hour
-CHECK_INTERVAL_S = 10
+# How often a thread queued on SSH_SEMA checks for cancellation
+SEMA_CANCEL_POLL_S = 0.5
 
 try:
   import paramiko
@@ -25,17 +42,43 @@ except ImportError:
   print("Please install paramiko package before running this utility")
   raise SystemExit("Required package paramiko missing")
 
-SSH_TIMEOUT = 120
+SSH_TIMEOUT = int(os.environ.get("GRIFFON_SSH_TIMEOUT_S", "120"))
 SCP_RETRIES = 3
 STAGING_DIR = "/home/nutanix/phoenix"
 SVM_CFG_FILE = "%s/svm_cfg.json" % STAGING_DIR
 SVM_TMP_PATH = "/tmp/svm_cfg.json"
 
-MAX_BOOT_WAIT_CYCLES = 6 * 5     # 5 minutes.
+# Boot wait without history. Nodes of a fingerprint with enough step
+# history are given up on at a margin over their observed p99 instead,
+# and fingerprints whose boots timed out get longer waits, never longer
+# than the ceiling.
+MAX_BOOT_WAIT_S = int(os.environ.get("GRIFFON_MAX_BOOT_WAIT_S", "300"))
+MAX_BOOT_WAIT_CEILING_S = int(os.environ.get(
+  "GRIFFON_MAX_BOOT_WAIT_CEILING_S", "3600"))
 CHECK_INTERVAL_S = 10
 HOST_DEFAULT_USER = "root"
+SSH_PORT = int(os.environ.get("GRIFFON_SSH_PORT", "22"))
 CVM_USERNAME = "nutanix"
 
+SSH_CONNECTS = REGISTRY.counter(
+  "griffon_ssh_connects", "SSH connection attempts", ["result"])
+SSH_POOL_SIZE = REGISTRY.gauge("griffon_ssh_pool_size", "Open SSH clients")
+SSH_SEMA_WAITING = REGISTRY.gauge(
+  "griffon_ssh_sema_waiting", "Threads queued for an SSH connection slot")
+SSH_SEMA_WAIT = REGISTRY.histogram(
+  "griffon_ssh_sema_wait_seconds", "Time queued for an SSH connection slot")
+SSH_COMMAND_SECONDS = REGISTRY.histogram(
+  "griffon_ssh_command_duration_seconds", "Remote command latency",
+  ["command"])
+TRANSFER_BYTES = REGISTRY.counter(
+  "griffon_transfer_bytes", "Bytes downloaded or copied to nodes", ["kind"])
+TRANSFER_THROUGHPUT = REGISTRY.histogram(
+  "griffon_transfer_throughput_bytes_per_second",
+  "Throughput of single downloads and copies", ["kind"],
+  buckets=BYTES_PER_S_BUCKETS)
+
+CONNECT_HEDGER = Hedger("ssh.connect")
+
 class RemoteHost(object):
   """
   Base class to perform operations on remote host.
@@ -44,6 +87,11 @@ class RemoteHost(object):
 
   def __init__(self, options):
     self.options = options
+    # Checkpoints of the imaging job this host is driven by, if any
+    self.job = Job()
+    # BMC power control, if the node config has one
+    self.power = None
+    self._fingerprint = None
 
   @staticmethod
   def get_instance(options):
@@ -54,7 +102,7 @@ class RemoteHost(object):
     """
     os_type = RemoteHost._detect_remote_os_type(options.node_ip)
 
-    module_print("Detected remote os type [%s]" % os_type)
+    module_print("Detected remote os type [%s]", os_type)
     if os_type == "ahv":
       from linux_host import LinuxHost
       return LinuxHost(options)
@@ -69,8 +117,8 @@ class RemoteHost(object):
       return LinuxHost(options)
     else:
       module_print("OS type '%s' is not supported for this "
-                   "workflow" % os_type)
-      module_print("Supported OSes : [%s]" %
+                   "workflow", os_type)
+      module_print("Supported OSes : [%s]",
                    RemoteHost.SUPPORTED_OS)
       return None
 
@@ -107,22 +155,99 @@ class RemoteHost(object):
       else:
         module_print("Remote host seems to be a Linux-like host but "
                      "could not determine the exact flavor. "
-                     "stdout: %s\nstderr: %s\n" % (out, err))
+                     "stdout: %s\nstderr: %s\n", out, err)
     return ""
 
-  @staticmethod
   def is_node_up(self):
     """
     Checks if node is reachable
     """
-    module_print("Checking host ip %s" % self.options.node_ip)
-    out, _, ret = self.ssh(cmd=["true"])
+    module_print("Checking host ip %s", self.options.node_ip)
+    out, _, ret = self.ssh(cmd=["true"], throw_on_error=False,
+                           log_on_error=False)
     if ret:
       return False
     return True
 
-  @staticmethod
-  def wait_for_host(self):
+  def fingerprint(self):
+    """
+    Hardware/firmware fingerprint the step history is kept by, e.g.
+    "ProLiant DL360 Gen10/uefi". Probed once, while the node is up.
+    """
+    if self._fingerprint is None:
+      out, _, ret = self.ssh(
+        cmd=["sh", "-c", shlex.quote(
+          "cat /sys/class/dmi/id/product_name; "
+          "test -d /sys/firmware/efi && echo uefi || echo bios")],
+        throw_on_error=False, log_on_error=False)
+      lines = out.strip().splitlines() if not ret else []
+      if len(lines) >= 2:
+        self._fingerprint = "%s/%s" % (lines[0].strip(), lines[-1].strip())
+      else:
+        self._fingerprint = "unknown/%s" % (lines[-1].strip() if lines
+                                            else "unknown")
+    return self._fingerprint
+
+  def wait_until(self, step, is_up, message):
+    """
+    Polls is_up() until it returns True or the step's deadline passes.
+
+    The deadline and the polling interval come from the step history of
+    the node's fingerprint; MAX_BOOT_WAIT_S and CHECK_INTERVAL_S without
+    history. A wait that runs past the p99 margin of the fingerprint is
+    reported as an outlier when it does. A node with a BMC that stays down
+    past POWER_CYCLE_AFTER_S, the outlier margin or the deadline is power
+    cycled and waited for again. A wait given up on is recorded as timed
+    out, which lengthens the next deadline of a slow fingerprint.
+    Returns True if is_up() succeeded.
+    """
+    fingerprint = self._fingerprint or "unknown"
+    steps = history()
+    deadline = steps.deadline(step, fingerprint, MAX_BOOT_WAIT_S,
+                              MAX_BOOT_WAIT_CEILING_S)
+    outlier_after = steps.outlier_after(step, fingerprint)
+    power_cycles = 0
+    with span(step, node_ip=self.options.node_ip, deadline_s=deadline) as s:
+      started, slept, cycles, outlier = time.time(), 0, 0, False
+      while True:
+        # Sleeps are skipped while replaying, count them as waited
+        waited = max(time.time() - started, slept)
+        if is_up():
+          steps.record(step, fingerprint, waited)
+          return True
+        overdue = waited >= deadline
+        if not outlier and outlier_after is not None and \
+            waited > outlier_after:
+          outlier = steps.is_outlier(step, fingerprint, waited)
+          module_print("Node still down after %ds, %s on %s usually takes "
+                       "less than %ds", waited, step, fingerprint,
+                       outlier_after)
+          s.set(outlier=True)
+        if (overdue or outlier or waited >= power.POWER_CYCLE_AFTER_S) and \
+            self.power is not None and power_cycles < power.MAX_POWER_CYCLES:
+          module_print("Node did not come up in %ds, power cycling it",
+                       waited)
+          ret, err = power.power_cycle(self.power, self.options.node_ip,
+                                       boot_device="disk")
+          if not ret:
+            module_print("Power cycle failed: %s", err)
+          power_cycles += 1
+          started, slept = time.time(), 0
+          continue
+        if overdue:
+          steps.record(step, fingerprint, waited, ok=False, censored=True)
+          module_print("Gave up waiting after %ds, deadline for %s on %s "
+                       "is %ds", waited, step, fingerprint, deadline)
+          return False
+        cycles += 1
+        module_print("[%ds/%ds] %s", waited, deadline, message)
+        s.set(cycles=cycles)
+        interval = steps.poll_interval(step, fingerprint, waited,
+                                       CHECK_INTERVAL_S)
+        replay.sleep(interval)
+        slept += interval
+
+  def wait_for_host(self, step="wait.host"):
     """
     Wait for node to boot up an try to detect the OS
 
@@ -131,39 +256,67 @@ class RemoteHost(object):
            False, "" otherwise
     """
     # Wait until we can ssh to Holo
-    for i in range(MAX_BOOT_WAIT_CYCLES):
-      if self.is_node_up():
-        module_print("Node is up, detecting OS")
-        os_type = self._detect_remote_os_type(self.options.node_ip)
-        return True, os_type
-      module_print("[%s/%s] Waiting for node to boot up" % (i, MAX_BOOT_WAIT_CYCLES))
-      time.sleep(CHECK_INTERVAL_S)
+    if self.wait_until(step, self.is_node_up, "Waiting for node to boot up"):
+      module_print("Node is up, detecting OS")
+      os_type = self._detect_remote_os_type(self.options.node_ip)
+      return True, os_type
     return False, ""
 
   @staticmethod
   def get_ssh_client(*args, **kwargs):
-    with SSH_SEMA:
-      timeout = kwargs.get("timeout", None)
-      assert timeout is None or timeout > 0, (
-        "timeout cannot be negative: %s" % timeout)
-
-      client = paramiko.SSHClient()
-      client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-      # Switch to paramiko 2.2.0+?
-      # see https://github.com/paramiko/paramiko/issues/869
-      if timeout:
-        timer = threading.Timer(timeout, client.close)
-        timer.daemon = True
-        timer.start()
-      else:
-        timer = None
+    with span("ssh.connect", node_ip=kwargs.get("hostname")) as s:
+      queued_at = time.time()
+      SSH_SEMA_WAITING.inc()
+      token = cancellation.current()
+      try:
+        while not SSH_SEMA.acquire(timeout=SEMA_CANCEL_POLL_S):
+          token.check()
+      finally:
+        SSH_SEMA_WAITING.dec()
+      try:
+        SSH_SEMA_WAIT.observe(time.time() - queued_at)
+        s.set(sema_wait_s=time.time() - queued_at)
+        timeout = kwargs.get("timeout", None)
+        assert timeout is None or timeout > 0, (
+          "timeout cannot be negative: %s" % timeout)
+
+        # A connect slower than the usual connect to any node is hedged
+        # with a second one, the client of the loser is closed
+        client = CONNECT_HEDGER.run(
+          None,
+          lambda attempt: RemoteHost._connect(attempt, *args, **kwargs),
+          discard=lambda client: client.close())
+        SSH_POOL_SIZE.inc()
+        return client
+      finally:
+        SSH_SEMA.release()
 
-      client.connect(*args, **kwargs)
+  @staticmethod
+  def _connect(attempt, *args, **kwargs):
+    timeout = kwargs.get("timeout", None)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
+    # Switch to paramiko 2.2.0+?
+    # see https://github.com/paramiko/paramiko/issues/869
+    if timeout:
+      timer = threading.Timer(timeout, client.close)
+      timer.daemon = True
+      timer.start()
+    else:
+      timer = None
+
+    try:
+      with attempt.interrupting(client.close):
+        client.connect(*args, **kwargs)
+    except (Exception, cancellation.Cancelled):
+      SSH_CONNECTS.labels("error").inc()
+      raise
+    finally:
       if timer:
         timer.cancel()
-      return client
+    SSH_CONNECTS.labels("ok").inc()
+    return client
 
   @staticmethod
   def _ssh(ip, command, throw_on_error=True, user="nutanix",
@@ -172,25 +325,51 @@ class RemoteHost(object):
     """
     Execute the commands via ssh on the remote machine with given ip.
     """
-    ssh_client = None
-    params = {"hostname": ip, "username": user, "password": password}
-    if timeout:
-      params["timeout"] = timeout
-    params.update(kwargs)
+    cmd_str = " ".join(command)
+    module_print("[%s]Running command [%s]", ip, cmd_str)
+    run = functools.partial(RemoteHost._run_ssh, ip, cmd_str, user=user,
+                            password=password, timeout=timeout,
+                            get_pty=get_pty, **kwargs)
+
+    with span("ssh.command", node_ip=ip, command=cmd_str) as s, \
+        SSH_COMMAND_SECONDS.labels(_command_name(cmd_str)).time():
+      try:
+        out, err, exit_status = replay.current().ssh(ip, cmd_str, run)
+      except (paramiko.AuthenticationException, paramiko.SSHException,
+              socket.error, Exception) as e:
+        if log_on_error:
+          module_print("Exception on executing cmd: %s", command)
+        if throw_on_error:
+          raise
+        else:
+          return "", str(e), -1
+      s.set(exit_status=exit_status, bytes_out=len(out), bytes_err=len(err))
 
-    try:
-      client = RemoteHost.get_ssh_client(**params)
-    except (paramiko.AuthenticationException, paramiko.SSHException,
-            socket.error, Exception) as e:
+    # module_print("ssh: %s\n%s" % (cmd_str, out))
+
+    if exit_status != 0:
+      message = "Command '%s' returned error code %d\n" % (
+                " ".join(command), exit_status)
+      message += "stdout:\n%s\nstderr:\n%s" % (out, err)
       if log_on_error:
-        module_print("Exception on executing cmd: %s" % command)
+        module_print("%s", message)
       if throw_on_error:
-        raise
-      else:
-        return "", str(e), -1
+        raise StandardError(message)
 
-    cmd_str = " ".join(command)
-    module_print("[%s]Running command [%s]" % (ip, cmd_str))
+    return out, err, exit_status
+
+  @staticmethod
+  def _run_ssh(ip, cmd_str, user, password, timeout, get_pty, **kwargs):
+    """
+    Runs the command over a new ssh connection. Raises if the connection
+    cannot be made. Returns out, err, exit_status.
+    """
+    params = {"hostname": ip, "port": SSH_PORT, "username": user,
+              "password": password}
+    if timeout:
+      params["timeout"] = timeout
+    params.update(kwargs)
+    client = RemoteHost.get_ssh_client(**params)
 
     out, err = [], []
     # use Timer to shutdown client.exec_command, the paramiko's
@@ -203,48 +382,40 @@ class RemoteHost(object):
     else:
       timer = None
 
-    try:
-      stdin, stdout, stderr = client.exec_command(cmd_str, get_pty=get_pty, timeout=timeout)
-      channel = stdout.channel
-      while not channel.exit_status_ready():
-        if channel.recv_ready():
-          outbuf = channel.recv(1024)
-          while outbuf:
-            out.append(outbuf)
+    # A cancelled workflow closes the client like the timer does, and
+    # raises Cancelled once the command is unblocked
+    with cancellation.current().interrupting(client.close):
+      try:
+        stdin, stdout, stderr = client.exec_command(cmd_str, get_pty=get_pty, timeout=timeout)
+        channel = stdout.channel
+        while not channel.exit_status_ready():
+          if channel.recv_ready():
             outbuf = channel.recv(1024)
-        if channel.recv_stderr_ready():
-          errbuf = channel.recv_stderr(1024)
-          while errbuf:
-            err.append(errbuf)
+            while outbuf:
+              out.append(outbuf)
+              outbuf = channel.recv(1024)
+          if channel.recv_stderr_ready():
             errbuf = channel.recv_stderr(1024)
-      else:
-        out.append(stdout.read())
-        err.append(stderr.read())
-      exit_status = stdout.channel.recv_exit_status()
-    except (socket.timeout, paramiko.SSHException, EOFError) as e:
-      # paramiko.transport.py:open_channel raises EOFError
-      err.append(str(e))
-      exit_status = -1
-    finally:
-      client.close()
+            while errbuf:
+              err.append(errbuf)
+              errbuf = channel.recv_stderr(1024)
+        else:
+          out.append(stdout.read())
+          err.append(stderr.read())
+        exit_status = stdout.channel.recv_exit_status()
+      except (socket.timeout, paramiko.SSHException, EOFError) as e:
+        # paramiko.transport.py:open_channel raises EOFError
+        err.append(str(e).encode())
+        exit_status = -1
+      finally:
+        client.close()
+        SSH_POOL_SIZE.dec()
 
     if timer:
       timer.cancel()
 
-    out = "".join(out)
-    err = "".join(err)
-
-    # module_print("ssh: %s\n%s" % (cmd_str, out))
-
-    if exit_status != 0:
-      message = "Command '%s' returned error code %d\n" % (
-                " ".join(command), exit_status)
-      message += "stdout:\n%s\nstderr:\n%s" % (out, err)
-      if log_on_error:
-        module_print("%s" % message)
-      if throw_on_error:
-        raise StandardError(message)
-
+    out = b"".join(out).decode("utf-8", "replace")
+    err = b"".join(err).decode("utf-8", "replace")
     return out, err, exit_status
 
   @staticmethod
@@ -259,33 +430,51 @@ class RemoteHost(object):
       timeout: Use None for no-timeout limit , do not use -1, that means
       timeout immediately after (or before) connect.
     """
-    client = None
-    params = {"hostname": ip, "username": user, "password": password}
-    if timeout:
-      params["timeout"] = timeout
-
+    module_print("[%s] copying files %s -> %s", ip, files[0], target_path)
+    run = functools.partial(RemoteHost._run_scp, ip, target_path, files,
+                            user=user, password=password, timeout=timeout,
+                            recursive=recursive)
     try:
-      client = RemoteHost.get_ssh_client(**params)
+      replay.current().scp(ip, target_path, files, run)
+    except SCPException as e:
+      if log_on_error:
+        module_print("Failed to scp files %s to %s:%s", files, ip, target_path)
+      if throw_on_error:
+        raise
+      return "", str(e), -1
     except (paramiko.AuthenticationException, paramiko.SSHException,
             socket.error, Exception) as e:
       if log_on_error:
-        module_print("Failed to connect to remote host %s" % ip)
+        module_print("Failed to connect to remote host %s", ip)
       if throw_on_error:
         raise
       else:
         return "", str(e), -1
+    return "", "", 0
 
-    scp_client = SCPClient(client.get_transport(), socket_timeout=timeout)
-    module_print("[%s] copying files %s -> %s" % (ip, files[0], target_path))
+  @staticmethod
+  def _run_scp(ip, target_path, files, user, password, timeout, recursive):
+    """
+    Copies files over a new ssh connection. Raises if the connection
+    cannot be made or the copy fails.
+    """
+    params = {"hostname": ip, "port": SSH_PORT, "username": user,
+              "password": password}
+    if timeout:
+      params["timeout"] = timeout
+    client = RemoteHost.get_ssh_client(**params)
     try:
-      scp_client.put(files, target_path, recursive=recursive)
-    except SCPException as e:
-      if log_on_error:
-        module_print("Failed to scp files %s to %s:%s" % (files, ip, target_path))
-      if throw_on_error:
-        raise
-      return "", str(e), -1
-    return "", "", 0
+      scp_client = SCPClient(client.get_transport(), socket_timeout=timeout)
+      size = _local_size(files)
+      with span("scp.put", node_ip=ip, target=target_path, files=len(files),
+                bytes=size), \
+          cancellation.current().interrupting(client.close):
+        start = time.time()
+        scp_client.put(files, target_path, recursive=recursive)
+        record_transfer("scp", size, time.time() - start)
+    finally:
+      client.close()
+      SSH_POOL_SIZE.dec()
 
   @staticmethod
   def get_my_ip(dest_ip, port=80):
@@ -327,7 +516,7 @@ class RemoteHost(object):
     Returns:
       True if node is reachable. False, otherwise
     """
-    module_print("Checking host ip %s" % options.node_ip)
+    module_print("Checking host ip %s", self.options.node_ip)
     _, _, ret = self.ssh(cmd=["true"])
     if ret:
       return False
@@ -341,7 +530,7 @@ class RemoteHost(object):
     Returns:
       True if node is in Phoenix. False, otherwise
     """
-    module_print("Checking host ip %s" % options.node_ip)
+    module_print("Checking host ip %s", self.options.node_ip)
     _, _, ret = self.ssh(cmd=["test", "-f", "/usr/bin/layout_finder.py"])
     if ret:
       return False
@@ -355,12 +544,9 @@ class RemoteHost(object):
     False otherwise.
     """
     # Wait until we can ssh to Phoenix
-    for i in range(MAX_BOOT_WAIT_CYCLES):
-      if self.is_phoenix_up():
-        module_print("Phoenix is up")
-        return True
-      module_print("[%s/%s] Waiting for Phoenix" % (i, MAX_BOOT_WAIT_CYCLES))
-      time.sleep(CHECK_INTERVAL_S)
+    if self.wait_until("wait.phoenix", self.is_phoenix_up, "Waiting for Phoenix"):
+      module_print("Phoenix is up")
+      return True
     return False
 
   def is_ahv_up(self):
@@ -370,11 +556,11 @@ class RemoteHost(object):
     Returns:
       True if node is in Ahv. False, otherwise
     """
-    module_print("Checking host ip %s" % options.node_ip)
+    module_print("Checking host ip %s", self.options.node_ip)
     out, err, ret = self.ssh(cmd=["uname", "-a"])
     if ret:
       module_print("Error executing command: "
-                   "cmd: %s, out: %s, err: %s" % (cmd, out, err))
+                   "cmd: uname -a, out: %s, err: %s", out, err)
       return False
     if "linux" in out.lower() and ".nutanix." in out.lower():
       return True
@@ -388,18 +574,39 @@ class RemoteHost(object):
     False otherwise.
     """
     # Wait until we can ssh to Phoenix
-    for i in range(MAX_BOOT_WAIT_CYCLES):
-      if self.is_ahv_up():
-        module_print("Hypervisor is up")
-        return True
-      module_print("[%s/%s] Waiting for AHV" % (i, MAX_BOOT_WAIT_CYCLES))
-      time.sleep(CHECK_INTERVAL_S)
+    if self.wait_until("wait.ahv", self.is_ahv_up, "Waiting for AHV"):
+      module_print("Hypervisor is up")
+      return True
     return False
 
-def module_print(msg):
+def record_transfer(kind, size, seconds):
+  TRANSFER_BYTES.labels(kind).inc(size)
+  if seconds > 0:
+    TRANSFER_THROUGHPUT.labels(kind).observe(size / seconds)
+
+def _command_name(cmd_str):
+  words = cmd_str.split()
+  return os.path.basename(words[0]) if words else ""
+
+def _local_size(paths):
+  size = 0
+  for path in paths:
+    walk = os.walk(path) if os.path.isdir(path) else [("", (), (path,))]
+    for root, _, names in walk:
+      for name in names:
+        try:
+          size += os.path.getsize(os.path.join(root, name))
+        except OSError:
+          pass
+  return size
+
+def module_print(msg, *args, **kwargs):
   """
-  Print the message
+  Logs the message through the queued griffon logger. The message is
+  only %-formatted with args if the record is emitted.
   :param msg:
+  :param level: Logging level, INFO by default
   :return:
   """
-  print(msg)
+  level = kwargs.pop("level", logging.INFO)
+  get_logger().log(level, msg, *args, **kwargs)
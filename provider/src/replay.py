@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Record/replay transports for remote commands, copies and downloads.
+#
+# RemoteHost._ssh/_scp and LinuxHost.download go through the current
+# transport. The default one runs them for real. A RecordingTransport also
+# appends every call with its outcome and latency to a JSON lines
+# transcript; a ReplayTransport serves a transcript back from memory, so
+# workflows run without nodes, networks or wait loop sleeps, or with the
+# recorded timing when real_time is set.
+#
+# GRIFFON_RECORD=<file> records and GRIFFON_REPLAY=<file> replays for the
+# whole process; GRIFFON_REPLAY_REALTIME=1 keeps the recorded timing.
+
+import base64
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from scp import SCPException
+
+import cancellation
+
+# Downloads up to this size are recorded with their content, larger ones
+# are replayed as a sparse file of the recorded size
+MAX_RECORDED_CONTENT = 64 * 1024
+# Parts of commands that differ between runs of the same workflow, masked
+# before recorded and replayed commands are matched
+VOLATILE = [(re.compile(r"SESSION=\S*"), "SESSION=*")]
+
+
+class DirectTransport(object):
+  """
+  Runs every call for real.
+  """
+  def ssh(self, ip, command, run):
+    return run()
+
+  def scp(self, ip, target, files, run):
+    return run()
+
+  def download(self, url, path, run):
+    return run()
+
+  def sleep(self, seconds):
+    cancellation.current().sleep(seconds)
+
+
+class RecordingTransport(DirectTransport):
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._file = open(path, "a")
+
+  def _record(self, entry, start):
+    entry["latency"] = round(time.time() - start, 6)
+    line = json.dumps(entry, sort_keys=True)
+    with self._lock:
+      self._file.write(line + "\n")
+      self._file.flush()
+
+  def _call(self, entry, run, raised_by):
+    start = time.time()
+    try:
+      result = run()
+    except Exception as e:
+      entry.update(raised=raised_by(e), err=str(e))
+      self._record(entry, start)
+      raise
+    return start, result
+
+  def ssh(self, ip, command, run):
+    entry = {"kind": "ssh", "ip": ip, "command": command}
+    start, (out, err, ret) = self._call(entry, run, lambda e: "connect")
+    entry.update(out=out, err=err, exit=ret)
+    self._record(entry, start)
+    return out, err, ret
+
+  def scp(self, ip, target, files, run):
+    entry = {"kind": "scp", "ip": ip, "target": target,
+             "files": [os.path.basename(f) for f in files]}
+    start, result = self._call(entry, run, lambda e: (
+      "scp" if isinstance(e, SCPException) else "connect"))
+    self._record(entry, start)
+    return result
+
+  def download(self, url, path, run):
+    entry = {"kind": "download", "url": url}
+    start, result = self._call(entry, run, lambda e: "download")
+    entry["bytes"] = os.path.getsize(path)
+    if entry["bytes"] <= MAX_RECORDED_CONTENT:
+      with open(path, "rb") as f:
+        entry["content"] = base64.b64encode(f.read()).decode("ascii")
+    self._record(entry, start)
+    return result
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+
+class ReplayMiss(Exception):
+  pass
+
+
+class ReplayTransport(DirectTransport):
+  """
+  Serves recorded outcomes in the order they were recorded, per node and
+  command. Once a command's recordings are used up its last outcome is
+  repeated, so extra polls of a wait loop see the final state.
+
+  template_ip: Node whose transcript is replayed for nodes that have no
+               recordings of their own, to fan one recording out to many
+               simulated nodes.
+  """
+  def __init__(self, path, real_time=False, speed=1.0, template_ip=None):
+    self.real_time = real_time
+    self.speed = speed
+    self.template_ip = template_ip
+    self._recorded = {}
+    self._cursors = {}
+    self._lock = threading.Lock()
+    with open(path) as f:
+      for line in f:
+        if line.strip():
+          entry = json.loads(line)
+          self._recorded.setdefault(self._key(entry), []).append(entry)
+    self._ips = set(key[0] for key in self._recorded)
+
+  @staticmethod
+  def _key(entry):
+    detail = {"ssh": "command", "scp": "target", "download": "url"}
+    return (entry.get("ip"), entry["kind"],
+            _mask(entry[detail[entry["kind"]]]))
+
+  def _next(self, ip, kind, detail):
+    detail = _mask(detail)
+    source = ip
+    if ip not in self._ips and self.template_ip:
+      source = self.template_ip
+    entries = self._recorded.get((source, kind, detail))
+    if not entries:
+      raise ReplayMiss("No recorded %s %s for %s" % (kind, detail, ip))
+    with self._lock:
+      cursor = self._cursors.get((ip, kind, detail), 0)
+      self._cursors[(ip, kind, detail)] = cursor + 1
+    entry = entries[min(cursor, len(entries) - 1)]
+    if self.real_time:
+      time.sleep(entry["latency"] / self.speed)
+    if entry.get("raised") == "scp":
+      raise SCPException(entry["err"])
+    if entry.get("raised"):
+      raise socket.error(entry["err"])
+    return entry
+
+  def ssh(self, ip, command, run):
+    entry = self._next(ip, "ssh", command)
+    return entry["out"], entry["err"], entry["exit"]
+
+  def scp(self, ip, target, files, run):
+    self._next(ip, "scp", target)
+
+  def download(self, url, path, run):
+    entry = self._next(None, "download", url)
+    with open(path, "wb") as f:
+      if "content" in entry:
+        f.write(base64.b64decode(entry["content"]))
+      else:
+        f.truncate(entry["bytes"])
+
+  def sleep(self, seconds):
+    if self.real_time:
+      cancellation.current().sleep(seconds / self.speed)
+    else:
+      cancellation.current().check()
+
+  def unused(self):
+    """
+    Recorded calls that were never replayed, e.g. to spot workflow
+    changes that skip commands.
+    """
+    used = set((key[0] if key[0] in self._ips else self.template_ip,) +
+               key[1:] for key in self._cursors)
+    return sorted(key for key in self._recorded if key not in used)
+
+
+def _mask(detail):
+  for pattern, replacement in VOLATILE:
+    detail = pattern.sub(replacement, detail)
+  return detail
+
+
+_transport = DirectTransport()
+
+
+def current():
+  return _transport
+
+
+def install(transport):
+  """
+  Makes transport the process-wide transport. Returns the previous one.
+  """
+  global _transport
+  previous, _transport = _transport, transport
+  return previous
+
+
+def sleep(seconds):
+  """
+  time.sleep for wait loops, skipped while replaying in fast mode. Raises
+  cancellation.Cancelled once the thread's token is cancelled.
+  """
+  _transport.sleep(seconds)
+
+
+def from_env():
+  if os.environ.get("GRIFFON_REPLAY"):
+    install(ReplayTransport(
+      os.environ["GRIFFON_REPLAY"],
+      real_time=os.environ.get("GRIFFON_REPLAY_REALTIME") == "1"))
+  elif os.environ.get("GRIFFON_RECORD"):
+    install(RecordingTransport(os.environ["GRIFFON_RECORD"]))
+
+from_env()
@@ -35,13 +35,13 @@ class SanitizeNode(object):
       with open(self.options.config, "r") as f:
         cfg = json.load(f)
     except ValueError as e:
-      module_print("Invalid json data in config file: %s" % str(e))
+      module_print("Invalid json data in config file: %s", str(e))
       return False
 
     ret, err = self.host.sanitize_node(self.options, cfg)
     if not ret:
-      module_print("Unable to sanitize node [%s] err: [%s]" %
-                   (self.options.node_ip, err))
+      module_print("Unable to sanitize node [%s] err: [%s]",
+                   self.options.node_ip, err)
       return False
 
     module_print("Successfully sanitized node")
@@ -6,7 +6,10 @@
 #
 # Class to stage phoenix payload on remote node.
 
+from griffon_log import log_context
+from job_store import JobStore
 from remote_host import (RemoteHost, module_print)
+from tracing import job_span
 
 class StagePhoenix(object):
   """
@@ -32,11 +35,19 @@ class StagePhoenix(object):
     import json
     with open(self.options.config, "r") as f:
       cfg = json.load(f)
-    ret, err = self.host.stage_phoenix(cfg)
+    # Resumes an interrupted run from its last checkpoint
+    self.host.job = JobStore().open_job(self.options.node_ip,
+                                        "stage_phoenix", cfg)
+    with job_span("stage_phoenix", node_ip=self.options.node_ip,
+                  job_id=self.host.job.job_id), \
+        log_context(node_ip=self.options.node_ip,
+                    session=self.host.job.job_id):
+      ret, err = self.host.stage_phoenix(cfg)
+    self.host.job.finish(ret, err)
     if not ret:
       module_print("Unable to stage phoenix payload "
-                   "on node [%s] err: [%s]" %
-                   (self.options.node_ip, err))
+                   "on node [%s] err: [%s]",
+                   self.options.node_ip, err)
       return False
 
     # wait for ivu to come back up
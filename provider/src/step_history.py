@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Observed step durations per hardware/OS fingerprint, and the deadlines
+# derived from them.
+#
+# Every boot wait and workflow step records how long it took on a node
+# of a given fingerprint (product name and firmware mode). Once a step
+# has enough samples for a fingerprint, waits give up at a margin over
+# its p99 instead of the fixed budget, polling is spaced out while a boot
+# cannot be done yet, and steps that take far longer than usual are
+# reported as outliers. Waits that timed out are kept as censored samples
+# (the step took at least that long), so a model slower than the budget
+# gets longer deadlines, up to a hard ceiling.
+
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from job_store import JOB_DB_PATH, SQLITE_BUSY_TIMEOUT_S
+from metrics import REGISTRY
+
+HISTORY_DB_PATH = os.environ.get("GRIFFON_STEP_HISTORY_DB", JOB_DB_PATH)
+# Samples kept per step and fingerprint, of successful and of failed runs
+MAX_SAMPLES = 200
+# Samples needed before deadlines are derived from history
+MIN_SAMPLES = 20
+DEADLINE_PERCENTILE = 99
+DEADLINE_MARGIN = 1.5
+MIN_DEADLINE_S = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS step_durations (
+  step TEXT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  duration REAL NOT NULL,
+  ok INTEGER NOT NULL,
+  recorded_at REAL NOT NULL,
+  censored INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS step_durations_by_step
+  ON step_durations (step, fingerprint, recorded_at);
+"""
+
+OUTLIERS = REGISTRY.counter(
+  "griffon_step_outliers", "Steps and waits past their derived deadline",
+  ["step"])
+
+
+def percentile(ordered, pct):
+  rank = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+  return ordered[min(rank, len(ordered) - 1)]
+
+
+class StepHistory(object):
+  """
+  SQLite backed history of step durations, cached in memory per (step,
+  fingerprint). Failed runs are stored but do not count towards the
+  percentiles, so a node that failed fast cannot shorten the deadlines.
+  Timed out runs only count towards the deadlines.
+  """
+  def __init__(self, path=HISTORY_DB_PATH):
+    self.path = path
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    # (step, fingerprint): (durations of successful runs, of timed out runs)
+    self._samples = {}
+    with self._conn() as conn:
+      conn.executescript(SCHEMA)
+      columns = [row[1] for row in
+                 conn.execute("PRAGMA table_info(step_durations)")]
+      if "censored" not in columns:
+        conn.execute("ALTER TABLE step_durations ADD COLUMN "
+                     "censored INTEGER NOT NULL DEFAULT 0")
+
+  def _conn(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_S)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      self._local.conn = conn
+    return conn
+
+  def _load(self, step, fingerprint, where):
+    rows = self._conn().execute(
+      "SELECT duration FROM step_durations WHERE step = ? AND "
+      "fingerprint = ? AND %s ORDER BY recorded_at DESC LIMIT ?" % where,
+      (step, fingerprint, MAX_SAMPLES)).fetchall()
+    return deque(reversed([r[0] for r in rows]), maxlen=MAX_SAMPLES)
+
+  def _cached(self, step, fingerprint):
+    key = (step, fingerprint)
+    with self._lock:
+      samples = self._samples.get(key)
+    if samples is not None:
+      return samples
+    loaded = (self._load(step, fingerprint, "ok = 1"),
+              self._load(step, fingerprint, "censored = 1"))
+    with self._lock:
+      return self._samples.setdefault(key, loaded)
+
+  def record(self, step, fingerprint, seconds, ok=True, censored=False):
+    """
+    Records a run of the step. censored marks a failed run that was
+    given up on after seconds, i.e. would have taken longer.
+    """
+    succeeded, timed_out = self._cached(step, fingerprint)
+    censored = bool(censored and not ok)
+    with self._conn() as conn:
+      conn.execute(
+        "INSERT INTO step_durations (step, fingerprint, duration, ok, "
+        "recorded_at, censored) VALUES (?, ?, ?, ?, ?, ?)",
+        (step, fingerprint, seconds, int(ok), time.time(), int(censored)))
+      conn.execute(
+        "DELETE FROM step_durations WHERE step = ? AND fingerprint = ? AND "
+        "ok = ? AND rowid NOT IN (SELECT rowid FROM step_durations WHERE "
+        "step = ? AND fingerprint = ? AND ok = ? ORDER BY recorded_at DESC "
+        "LIMIT ?)", (step, fingerprint, int(ok), step, fingerprint, int(ok),
+                     MAX_SAMPLES))
+    if ok or censored:
+      with self._lock:
+        (succeeded if ok else timed_out).append(seconds)
+
+  def percentiles(self, step, fingerprint, *pcts):
+    """
+    The given percentiles of successful durations, or None while there
+    are fewer than MIN_SAMPLES.
+    """
+    samples = self._cached(step, fingerprint)[0]
+    with self._lock:
+      if len(samples) < MIN_SAMPLES:
+        return None
+      ordered = sorted(samples)
+    return [percentile(ordered, pct) for pct in pcts]
+
+  def deadline(self, step, fingerprint, default, ceiling=None):
+    """
+    Seconds after which the step is overdue: a margin over its p99, timed
+    out runs counting at the time they were given up on, at least
+    MIN_DEADLINE_S. The default without history. Runs that timed out
+    raise the deadline to a margin over the longest of them, so a slow
+    model is given more time on every timeout, up to ceiling (default if
+    not given).
+    """
+    succeeded, timed_out = self._cached(step, fingerprint)
+    with self._lock:
+      ordered = sorted(list(succeeded) + list(timed_out))
+      longest_timeout = max(timed_out) if timed_out else 0
+    if len(ordered) >= MIN_SAMPLES:
+      deadline = max(MIN_DEADLINE_S,
+                     percentile(ordered, DEADLINE_PERCENTILE) * DEADLINE_MARGIN)
+    else:
+      deadline = default
+    if len(succeeded) < MIN_SAMPLES:
+      deadline = max(deadline, longest_timeout * DEADLINE_MARGIN)
+    return min(ceiling or default, deadline)
+
+  def poll_interval(self, step, fingerprint, waited, interval):
+    """
+    Time to sleep before polling a wait again: until the fastest runs
+    usually finish (p5), in at most 6 intervals, then every interval.
+    """
+    pcts = self.percentiles(step, fingerprint, 5)
+    if pcts is None or waited >= pcts[0]:
+      return interval
+    return max(interval, min(pcts[0] - waited, 6 * interval))
+
+  def outlier_after(self, step, fingerprint):
+    """
+    Seconds past which a run of the step is an outlier, None without
+    history.
+    """
+    pcts = self.percentiles(step, fingerprint, DEADLINE_PERCENTILE)
+    return None if pcts is None else pcts[0] * DEADLINE_MARGIN
+
+  def is_outlier(self, step, fingerprint, seconds):
+    """
+    True, counting the outlier, if a run of seconds took far longer than
+    the step usually does.
+    """
+    threshold = self.outlier_after(step, fingerprint)
+    if threshold is None or seconds <= threshold:
+      return False
+    OUTLIERS.labels(step).inc()
+    return True
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def history():
+  """
+  The process-wide step history, opened on first use.
+  """
+  global _history
+  if _history is None:
+    with _history_lock:
+      if _history is None:
+        _history = StepHistory()
+  return _history
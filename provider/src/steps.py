@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Convergent workflow steps: skip the ones the node already satisfies.
+
+import time
+
+try:
+  from shlex import quote
+except ImportError:
+  from pipes import quote
+
+from griffon_log import log_context
+from metrics import REGISTRY
+from remote_host import module_print
+from step_history import history
+from tracing import span
+
+
+STEPS = REGISTRY.counter(
+  "griffon_steps", "Workflow steps by outcome: ran, satisfied on the node "
+  "or resumed from a checkpoint", ["result"])
+
+
+class Step(object):
+  """
+  One workflow step.
+
+  check: Shell condition that succeeds when the step's effect is already
+         in place on the node, or None if that cannot be checked cheaply.
+  action: Callable performing the step. Returns (True, outputs) where
+          outputs is an optional dict recorded with the job checkpoint,
+          or (False, err).
+  depends_on: Steps whose action invalidates this step's check result,
+              e.g. re-copying a file drops the execute bit set later.
+  """
+  def __init__(self, name, check, action, depends_on=()):
+    self.name = name
+    self.check = check
+    self.action = action
+    self.depends_on = depends_on
+
+
+class Phase(object):
+  """
+  Ordered steps run against one host.
+
+  The checks of all steps are evaluated in a single batched SSH probe.
+  Steps checkpointed by the host's job or already satisfied on the node
+  are skipped, so retries and re-runs only do the missing work.
+  """
+  def __init__(self, host, name, steps):
+    self.host = host
+    self.name = name
+    self.steps = steps
+
+  def probe_script(self):
+    lines = []
+    for step in self.steps:
+      if step.check is None or self.host.job.is_done(step.name):
+        continue
+      lines.append("if %s; then echo %s=1; else echo %s=0; fi" % (
+        step.check, step.name, step.name))
+    return "; ".join(lines)
+
+  def probe(self):
+    """
+    Returns the names of the steps already satisfied on the node.
+    """
+    script = self.probe_script()
+    if not script:
+      return set()
+    with span("phase.probe", phase=self.name):
+      out, err, ret = self.host.ssh(cmd=["sh", "-c", quote(script)],
+                                    throw_on_error=False, log_on_error=False)
+    if ret:
+      module_print("[%s] %s probe failed, running all steps: %s",
+        self.host.node_ip(), self.name, err)
+      return set()
+    satisfied = set()
+    for line in out.splitlines():
+      name, _, value = line.strip().partition("=")
+      if value == "1":
+        satisfied.add(name)
+    return satisfied
+
+  def record(self, step, seconds, ok):
+    """
+    Adds a step run to the step history, reporting it if it took far
+    longer than the step usually takes on this kind of node.
+    """
+    fingerprint = self.host.fingerprint()
+    steps = history()
+    if ok and steps.is_outlier(step.name, fingerprint, seconds):
+      module_print("[%s] %s: %s took %ds, much longer than usual on %s",
+        self.host.node_ip(), self.name, step.name, seconds, fingerprint)
+    steps.record(step.name, fingerprint, seconds, ok)
+
+  def run(self):
+    """
+    Runs the phase. Returns (True, "") or (False, err) of the failed step.
+    """
+    job = self.host.job
+    satisfied = self.probe()
+    ran = set()
+    for step in self.steps:
+      if job.is_done(step.name):
+        STEPS.labels("resumed").inc()
+        continue
+      if step.name in satisfied and not ran.intersection(step.depends_on):
+        module_print("[%s] %s: %s already satisfied",
+          self.host.node_ip(), self.name, step.name)
+        STEPS.labels("satisfied").inc()
+        job.checkpoint(step.name)
+        continue
+      STEPS.labels("ran").inc()
+      started = time.time()
+      with span("step", node_ip=self.host.node_ip(), step=step.name), \
+          log_context(step=step.name):
+        ok, outputs = step.action()
+      self.record(step, time.time() - started, ok)
+      if not ok:
+        return False, outputs
+      ran.add(step.name)
+      job.checkpoint(step.name, **(outputs or {}))
+    return True, ""
@@ -0,0 +1,1050 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Rack-local peer-to-peer distribution of phoenix payloads.
+#
+# Without it every node pulls the livefs and the installer payloads from
+# the artifact server. With GRIFFON_SWARM_PORT set the provider runs a
+# chunk tracker next to a seed, its cache of each artifact fetched once
+# from the origin. Peers (swarm agents on rack hosts, see `peer` below)
+# fetch artifacts chunk by chunk: chunks other peers of the same rack
+# already hold come from them, and each chunk no peer of the rack holds
+# yet is claimed by one peer, which brings it in from the seed. The seed
+# thus sends about one copy per rack, and the origin one copy in all.
+#
+# Phoenix fetches LIVEFS_URL with a plain GET. For nodes whose request
+# names their rack, LIVEFS_URL points at the tracker, which redirects to
+# a peer of the rack holding the whole livefs, or to the seed.
+#
+# Examples:
+#   python swarm.py tracker --port 8001
+#   python swarm.py peer --tracker http://172.26.1.2:8001 --rack r12 \
+#       http://172.26.2.4:8000/phoenix/squashfs.img
+#   python swarm.py simulate --peers 64 --racks 4 --size-mb 64
+
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import (BaseHTTPRequestHandler, SimpleHTTPRequestHandler,
+                         ThreadingHTTPServer)
+from urllib.error import URLError
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+import cancellation
+from griffon_log import get_logger
+from metrics import REGISTRY
+import mirrors
+
+SWARM_PORT = int(os.environ.get("GRIFFON_SWARM_PORT", "0"))
+SWARM_CACHE_DIR = os.environ.get("GRIFFON_SWARM_CACHE", "swarm_cache")
+CHUNK_SIZE = int(os.environ.get("GRIFFON_SWARM_CHUNK_MB", "4")) * 1024 * 1024
+# A peer that claimed a chunk for its rack has this long to bring it in
+CLAIM_TIMEOUT_S = 30
+# Peers that were not heard from for this long are forgotten
+PEER_TTL_S = 60
+HEARTBEAT_S = PEER_TTL_S / 3
+# Chunks a peer asks for, and fetches concurrently
+ASSIGN_BATCH = 4
+# Pause of a peer whose missing chunks are all being brought in by others
+ASSIGN_WAIT_S = 0.2
+# Rack sources offered per chunk, before the seed as last resort
+RACK_SOURCES = 2
+REQUEST_TIMEOUT_S = 15
+BLOCK_SIZE = 1024 * 1024
+# The seed checks a cached artifact against its origin at most this often
+REVALIDATE_S = 30
+# Cached artifacts whose origin sends neither ETag nor Last-Modified, and
+# that have no md5sum to check, are fetched again after this long
+UNVALIDATED_MAX_AGE_S = 600
+LOCK_POLL_S = 0.5
+
+SWARM_BYTES = REGISTRY.counter(
+  "griffon_swarm_bytes", "Payload bytes fetched by peers, by source",
+  ["source"])
+SWARM_REDIRECTS = REGISTRY.counter(
+  "griffon_swarm_redirects", "Whole artifact fetches by where they were sent",
+  ["source"])
+
+
+class ChunkCorrupt(Exception):
+  pass
+
+
+def artifact_id(url, content=""):
+  """
+  Id of url, or of one content of url: chunks of an artifact rebuilt at
+  the same url do not mix with the old ones.
+  """
+  return hashlib.sha256(("%s\n%s" % (url, content)).encode()).hexdigest()[:16]
+
+
+def file_md5(path):
+  token = cancellation.current()
+  digest = hashlib.md5()
+  with open(path, "rb") as f:
+    while True:
+      block = f.read(BLOCK_SIZE)
+      if not block:
+        return digest.hexdigest()
+      digest.update(block)
+      token.check()
+
+
+def origin_version(url):
+  """
+  ETag or Last-Modified the origin sends for url, "" if neither, None if
+  the origin cannot be reached.
+  """
+  try:
+    response = urlopen(Request(url, method="HEAD"), timeout=REQUEST_TIMEOUT_S)
+  except (URLError, OSError):
+    return None
+  try:
+    return (response.headers.get("ETag") or
+            response.headers.get("Last-Modified") or "")
+  finally:
+    response.close()
+
+
+class Manifest(object):
+  __slots__ = ("artifact", "url", "size", "chunk_size", "digests")
+
+  def __init__(self, artifact, url, size, chunk_size, digests):
+    self.artifact = artifact
+    self.url = url
+    self.size = size
+    self.chunk_size = chunk_size
+    self.digests = digests
+
+  @property
+  def count(self):
+    return len(self.digests)
+
+  def extent(self, index):
+    """
+    Returns (offset, length) of chunk index.
+    """
+    offset = index * self.chunk_size
+    return offset, min(self.chunk_size, self.size - offset)
+
+  @classmethod
+  def from_file(cls, url, path, artifact=None, chunk_size=CHUNK_SIZE):
+    digests = []
+    with open(path, "rb") as f:
+      while True:
+        data = f.read(chunk_size)
+        if not data:
+          break
+        digests.append(hashlib.sha256(data).hexdigest())
+    return cls(artifact or artifact_id(url), url, os.path.getsize(path),
+               chunk_size, digests)
+
+  def to_dict(self):
+    return {"artifact": self.artifact, "url": self.url, "size": self.size,
+            "chunk_size": self.chunk_size, "digests": self.digests}
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(d["artifact"], d["url"], d["size"], d["chunk_size"],
+               d["digests"])
+
+
+class ChunkFile(object):
+  """
+  An artifact on disk and the chunks of it written so far.
+  """
+  def __init__(self, manifest, path, complete=False):
+    self.manifest = manifest
+    self.path = path
+    if complete:
+      self.have = set(range(manifest.count))
+    else:
+      self.have = set()
+      with open(path, "wb") as f:
+        f.truncate(manifest.size)
+
+  @property
+  def complete(self):
+    return len(self.have) == self.manifest.count
+
+  def read(self, index):
+    if index not in self.have:
+      raise KeyError(index)
+    offset, length = self.manifest.extent(index)
+    with open(self.path, "rb") as f:
+      f.seek(offset)
+      return f.read(length)
+
+  def write(self, index, data):
+    """
+    Stores chunk index after checking it against the manifest.
+    """
+    if hashlib.sha256(data).hexdigest() != self.manifest.digests[index]:
+      raise ChunkCorrupt("chunk %d of %s does not match its digest" % (
+        index, self.manifest.artifact))
+    offset, _ = self.manifest.extent(index)
+    with open(self.path, "r+b") as f:
+      f.seek(offset)
+      f.write(data)
+    self.have.add(index)
+
+
+class _Peer(object):
+  __slots__ = ("peer_id", "rack", "address", "ttl", "seen", "chunks",
+               "counts", "uploads")
+
+  def __init__(self, peer_id, rack, address, ttl):
+    self.peer_id = peer_id
+    # None for the seed
+    self.rack = rack
+    # Base URL of its chunks, "" for the tracker's own server
+    self.address = address
+    self.ttl = ttl
+    self.seen = 0
+    # (artifact, index) it holds
+    self.chunks = set()
+    # {artifact: chunks held}
+    self.counts = {}
+    # Chunk and artifact fetches sent its way
+    self.uploads = 0
+
+
+class ChunkTracker(object):
+  """
+  Which peer of which rack holds which chunks. Hands every peer the chunks
+  it misses along with where to fetch them.
+  """
+  def __init__(self, rng=None, clock=time.time):
+    self._rng = rng or random.Random()
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._manifests = {}
+    self._peers = {}
+    # (artifact, index): {peer_id: _Peer}
+    self._holders = {}
+    # (artifact, rack, index): (peer_id, expires)
+    self._claims = {}
+    self._bytes = {}
+
+  def publish(self, manifest):
+    with self._lock:
+      self._manifests[manifest.artifact] = manifest
+
+  def manifest(self, artifact):
+    with self._lock:
+      return self._manifests[artifact]
+
+  def forget(self, artifact):
+    """
+    Drops an artifact that was replaced, with who holds its chunks.
+    """
+    with self._lock:
+      self._manifests.pop(artifact, None)
+      for key in [k for k in self._holders if k[0] == artifact]:
+        for peer in self._holders.pop(key).values():
+          peer.chunks.discard(key)
+          peer.counts.pop(artifact, None)
+      for key in [k for k in self._claims if k[0] == artifact]:
+        del self._claims[key]
+
+  def join(self, peer_id, rack, address, ttl=PEER_TTL_S):
+    """
+    Registers a peer, or keeps a registered one alive.
+    """
+    with self._lock:
+      peer = self._peers.get(peer_id)
+      if peer is None:
+        peer = self._peers[peer_id] = _Peer(peer_id, rack, address, ttl)
+      peer.seen = self._clock()
+
+  def leave(self, peer_id):
+    with self._lock:
+      self._drop(peer_id)
+
+  def _drop(self, peer_id):
+    peer = self._peers.pop(peer_id, None)
+    if peer is None:
+      return
+    for key in peer.chunks:
+      self._holders.get(key, {}).pop(peer_id, None)
+    for key, (claimer, _) in list(self._claims.items()):
+      if claimer == peer_id:
+        del self._claims[key]
+
+  def _expire(self, now):
+    for peer in list(self._peers.values()):
+      if peer.ttl is not None and now - peer.seen > peer.ttl:
+        self._drop(peer.peer_id)
+
+  def _peer(self, peer_id):
+    peer = self._peers.get(peer_id)
+    if peer is None:
+      raise KeyError(peer_id)
+    return peer
+
+  def hold(self, peer_id, artifact, indexes):
+    """
+    Records chunks the peer holds without counting them as transferred.
+    """
+    with self._lock:
+      peer = self._peer(peer_id)
+      for index in indexes:
+        self._add(peer, artifact, index)
+
+  def _add(self, peer, artifact, index):
+    key = (artifact, index)
+    if key in peer.chunks:
+      return
+    peer.chunks.add(key)
+    peer.counts[artifact] = peer.counts.get(artifact, 0) + 1
+    self._holders.setdefault(key, {})[peer.peer_id] = peer
+    self._claims.pop((artifact, peer.rack, index), None)
+
+  def announce(self, peer_id, artifact, index, source, size):
+    """
+    Records that the peer fetched chunk index from a source of the given
+    kind (rack, seed or remote).
+    """
+    with self._lock:
+      peer = self._peer(peer_id)
+      peer.seen = self._clock()
+      self._add(peer, artifact, index)
+      self._bytes[source] = self._bytes.get(source, 0) + size
+    SWARM_BYTES.labels(source).inc(size)
+
+  def _sources(self, peer, artifact, index):
+    """
+    Returns [(url, kind)] to fetch the chunk from, or None if another peer
+    of the rack is already bringing it in.
+    """
+    holders = [p for p in self._holders.get((artifact, index), {}).values()
+               if p is not peer]
+    local = [p for p in holders if p.rack == peer.rack]
+    seeds = [p for p in holders if p.rack is None]
+    path = "/chunks/%s/%d" % (artifact, index)
+    if local:
+      self._rng.shuffle(local)
+      local.sort(key=lambda p: p.uploads)
+      picked = local[:RACK_SOURCES]
+      picked[0].uploads += 1
+      return ([(p.address + path, "rack") for p in picked] +
+              [(p.address + path, "seed") for p in seeds])
+    key = (artifact, peer.rack, index)
+    claim = self._claims.get(key)
+    if claim and claim[0] != peer.peer_id and claim[1] > self._clock():
+      return None
+    remote = [p for p in holders if p.rack is not None]
+    if not seeds and not remote:
+      return None
+    self._claims[key] = (peer.peer_id, self._clock() + CLAIM_TIMEOUT_S)
+    return ([(p.address + path, "seed") for p in seeds] +
+            [(p.address + path, "remote") for p in remote])
+
+  def assign(self, peer_id, artifact, limit=ASSIGN_BATCH):
+    """
+    Returns ([(index, [(url, kind)])] of up to limit chunks the peer is
+    missing, True once it holds them all). Chunks fewest peers of its
+    rack hold come first, so a rack fills up in parallel.
+    """
+    with self._lock:
+      now = self._clock()
+      self._expire(now)
+      peer = self._peer(peer_id)
+      peer.seen = now
+      manifest = self._manifests[artifact]
+      missing = [i for i in range(manifest.count)
+                 if (artifact, i) not in peer.chunks]
+      if not missing:
+        return [], True
+
+      def rack_holders(index):
+        return sum(1 for p in self._holders.get((artifact, index), {}).values()
+                   if p.rack == peer.rack)
+
+      missing.sort(key=lambda i: (rack_holders(i), self._rng.random()))
+      assigned = []
+      for index in missing:
+        sources = self._sources(peer, artifact, index)
+        if sources:
+          assigned.append((index, sources))
+          if len(assigned) == limit:
+            break
+      return assigned, False
+
+  def locate(self, artifact, rack):
+    """
+    Base URL of a peer of the rack holding the whole artifact, least used
+    first, None if there is none.
+    """
+    with self._lock:
+      self._expire(self._clock())
+      count = self._manifests[artifact].count
+      complete = [p for p in self._peers.values()
+                  if p.rack is not None and p.rack == rack and
+                  p.counts.get(artifact) == count]
+      if not complete:
+        return None
+      self._rng.shuffle(complete)
+      peer = min(complete, key=lambda p: p.uploads)
+      peer.uploads += 1
+      return peer.address
+
+  def stats(self):
+    """
+    Bytes fetched by peers by source kind, and peers by rack.
+    """
+    with self._lock:
+      racks = {}
+      for peer in self._peers.values():
+        if peer.rack is not None:
+          racks[peer.rack] = racks.get(peer.rack, 0) + 1
+      return {"bytes": dict(self._bytes), "racks": racks}
+
+
+class _Entry(object):
+  __slots__ = ("chunk_file", "version", "md5sum", "fetched_at", "checked_at")
+
+  def __init__(self, chunk_file, version, md5sum, fetched_at):
+    self.chunk_file = chunk_file
+    # Origin's ETag or Last-Modified when fetched, "" if it sent neither
+    self.version = version
+    self.md5sum = md5sum
+    self.fetched_at = fetched_at
+    self.checked_at = 0
+
+
+class Seed(object):
+  """
+  The provider's cache of artifacts, each fetched once from its origin,
+  from which racks take the chunks none of their peers hold. Cached
+  artifacts are checked against the md5sum asked for, or against the
+  origin's ETag or Last-Modified, and fetched again when they changed.
+  """
+  PEER_ID = "seed"
+
+  def __init__(self, tracker, files, cache_dir):
+    self.tracker = tracker
+    self.files = files
+    self.cache_dir = cache_dir
+    self._urls = {}
+    self._entries = {}
+    self._locks = {}
+    self._lock = threading.Lock()
+    tracker.join(self.PEER_ID, None, "", ttl=None)
+
+  def register(self, url):
+    """
+    Makes url known to the seed by its name, without fetching it.
+    """
+    name = artifact_id(url)
+    with self._lock:
+      self._urls[name] = url
+    return name
+
+  def url(self, name):
+    with self._lock:
+      return self._urls[name]
+
+  def artifact(self, url, md5sum=None):
+    """
+    Returns the Manifest of url, fetching it into the cache first unless
+    the cached copy is still current. Stops with Cancelled once the
+    thread's cancellation token is cancelled.
+    """
+    name = self.register(url)
+    with self._lock:
+      lock = self._locks.setdefault(name, threading.Lock())
+    token = cancellation.current()
+    while not lock.acquire(timeout=LOCK_POLL_S):
+      token.check()
+    try:
+      entry = self._entries.get(name) or self._load(name, url)
+      if entry is None or not self._current(entry, url, md5sum):
+        entry = self._fetch(name, url, md5sum)
+      self._install(name, entry)
+      return entry.chunk_file.manifest
+    finally:
+      lock.release()
+
+  def _current(self, entry, url, md5sum):
+    if md5sum:
+      return entry.md5sum == md5sum
+    now = time.time()
+    if now - entry.checked_at < REVALIDATE_S:
+      return True
+    version = origin_version(url)
+    entry.checked_at = now
+    if version is None:
+      get_logger().warning("Cannot revalidate %s, serving the cached copy",
+                           url)
+      return True
+    if version or entry.version:
+      return version == entry.version
+    return now - entry.fetched_at < UNVALIDATED_MAX_AGE_S
+
+  def _paths(self, name):
+    path = os.path.join(self.cache_dir, name)
+    return path, path + ".json"
+
+  def _load(self, name, url):
+    """
+    The entry a previous run left in the cache, if any.
+    """
+    path, meta_path = self._paths(name)
+    try:
+      with open(meta_path) as f:
+        meta = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    if not os.path.exists(path):
+      return None
+    return self._entry(url, path, meta["version"], meta["md5sum"],
+                       meta["fetched_at"])
+
+  def _entry(self, url, path, version, md5sum, fetched_at):
+    manifest = Manifest.from_file(url, path, artifact_id(url, md5sum))
+    return _Entry(ChunkFile(manifest, path, complete=True), version, md5sum,
+                  fetched_at)
+
+  def _fetch(self, name, url, md5sum):
+    path, meta_path = self._paths(name)
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    version = origin_version(url) or ""
+    new = path + ".new"
+    mirrors.fetch(url, new)
+    digest = file_md5(new)
+    if md5sum and digest != md5sum:
+      os.remove(new)
+      raise IOError("%s has md5sum %s, expected %s" % (url, digest, md5sum))
+    # Open readers of the previous copy keep reading it
+    os.rename(new, path)
+    fetched_at = time.time()
+    with open(meta_path, "w") as f:
+      json.dump({"url": url, "version": version, "md5sum": digest,
+                 "fetched_at": fetched_at}, f)
+    entry = self._entry(url, path, version, digest, fetched_at)
+    entry.checked_at = fetched_at
+    return entry
+
+  def _install(self, name, entry):
+    manifest = entry.chunk_file.manifest
+    old = self._entries.get(name)
+    self._entries[name] = entry
+    if old is not None and old.chunk_file.manifest.artifact != manifest.artifact:
+      self.files.pop(old.chunk_file.manifest.artifact, None)
+      self.tracker.forget(old.chunk_file.manifest.artifact)
+    if manifest.artifact not in self.files:
+      self.files[manifest.artifact] = entry.chunk_file
+      self.tracker.publish(manifest)
+      self.tracker.hold(self.PEER_ID, manifest.artifact, range(manifest.count))
+
+  def copy(self, url, path, md5sum=None):
+    """
+    Copies the current content of url to path.
+    """
+    source = self.files[self.artifact(url, md5sum).artifact].path
+    token = cancellation.current()
+    with open(source, "rb") as src, open(path, "wb") as dst:
+      while True:
+        block = src.read(BLOCK_SIZE)
+        if not block:
+          break
+        dst.write(block)
+        token.check()
+
+  def prefetch(self, url):
+    """
+    Fetches url into the cache in the background.
+    """
+    def fetch():
+      try:
+        self.artifact(url)
+      except Exception as e:
+        get_logger().warning("Prefetching %s for the swarm failed: %s", url, e)
+    thread = threading.Thread(target=fetch, name="swarm-prefetch")
+    thread.daemon = True
+    thread.start()
+
+
+class _Handler(BaseHTTPRequestHandler):
+  """
+  Serves the chunks and whole artifacts in server.files and, on the
+  provider, the tracker:
+    GET  /chunks/<artifact>/<index>
+    GET  /artifacts/<artifact>
+    GET  /racks/<rack>/artifacts/<name>       redirect to a rack peer or
+    GET  /racks/<rack>/fetch?url=<url>        the seed
+    GET  /swarm/manifest?url=<url>
+    POST /swarm/join|leave|hold|assign|announce
+  """
+  def log_message(self, *args):
+    pass
+
+  def _send(self, status, body=b"", content_type="text/plain", headers=None):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(body)
+
+  def _json(self, value):
+    self._send(200, json.dumps(value).encode(), "application/json")
+
+  def do_HEAD(self):
+    self.do_GET()
+
+  def do_GET(self):
+    parts = urlsplit(self.path)
+    path = [unquote(p) for p in parts.path.strip("/").split("/")]
+    query = parse_qs(parts.query)
+    server = self.server
+    try:
+      if len(path) == 3 and path[0] == "chunks":
+        return self._send(200, server.files[path[1]].read(int(path[2])),
+                          "application/octet-stream")
+      if len(path) == 2 and path[0] == "artifacts":
+        return self._artifact(server.files[path[1]])
+      if server.tracker is None:
+        return self._send(404)
+      if path == ["swarm", "manifest"]:
+        return self._json(server.seed.artifact(query["url"][0]).to_dict())
+      if len(path) == 4 and path[0] == "racks" and path[2] == "artifacts":
+        return self._redirect(path[1], server.seed.url(path[3]))
+      if len(path) == 3 and path[0] == "racks" and path[2] == "fetch":
+        return self._redirect(path[1], query["url"][0])
+    except (KeyError, ValueError):
+      return self._send(404)
+    except (IOError, OSError) as e:
+      return self._send(502, str(e).encode())
+    self._send(404)
+
+  def _artifact(self, chunk_file):
+    if not chunk_file.complete:
+      return self._send(404)
+    self.send_response(200)
+    self.send_header("Content-Type", "application/octet-stream")
+    self.send_header("Content-Length", str(chunk_file.manifest.size))
+    self.end_headers()
+    if self.command == "HEAD":
+      return
+    try:
+      with open(chunk_file.path, "rb") as f:
+        shutil.copyfileobj(f, self.wfile, BLOCK_SIZE)
+    except (BrokenPipeError, ConnectionResetError):
+      # The client went away
+      pass
+
+  def _redirect(self, rack, url):
+    artifact = self.server.seed.artifact(url).artifact
+    address = self.server.tracker.locate(artifact, rack)
+    SWARM_REDIRECTS.labels("seed" if address is None else "rack").inc()
+    self._send(302, headers={
+      "Location": "%s/artifacts/%s" % (address or "", artifact)})
+
+  def do_POST(self):
+    tracker = self.server.tracker
+    if tracker is None:
+      return self._send(404)
+    length = int(self.headers.get("Content-Length") or 0)
+    try:
+      body = json.loads(self.rfile.read(length) or b"{}")
+      op = self.path.strip("/")
+      if op == "swarm/join":
+        tracker.join(body["peer"], str(body["rack"]), body["address"])
+        return self._json({})
+      if op == "swarm/hold":
+        tracker.hold(body["peer"], body["artifact"], body["indexes"])
+        return self._json({})
+      if op == "swarm/leave":
+        tracker.leave(body["peer"])
+        return self._json({})
+      if op == "swarm/assign":
+        chunks, done = tracker.assign(body["peer"], body["artifact"],
+                                      body.get("limit", ASSIGN_BATCH))
+        return self._json({"chunks": chunks, "done": done})
+      if op == "swarm/announce":
+        tracker.announce(body["peer"], body["artifact"], body["index"],
+                         body["source"], body["size"])
+        return self._json({})
+    except KeyError as e:
+      # Unknown peers join again
+      return self._send(404, str(e).encode())
+    except ValueError as e:
+      return self._send(400, str(e).encode())
+    self._send(404)
+
+
+class SwarmServer(ThreadingHTTPServer):
+  daemon_threads = True
+  # Every node of a batch asks the tracker at about the same time
+  request_queue_size = 256
+
+  def __init__(self, address, files, tracker=None, seed=None):
+    ThreadingHTTPServer.__init__(self, address, _Handler)
+    self.files = files
+    self.tracker = tracker
+    self.seed = seed
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever, name="swarm-http")
+    thread.daemon = True
+    thread.start()
+
+
+class SwarmService(object):
+  """
+  Tracker and seed, served on one port.
+  """
+  def __init__(self, host="", port=SWARM_PORT, cache_dir=SWARM_CACHE_DIR):
+    self.files = {}
+    self.tracker = ChunkTracker()
+    self.seed = Seed(self.tracker, self.files, cache_dir)
+    self.server = SwarmServer((host, port), self.files, self.tracker,
+                              self.seed)
+    self.port = self.server.server_address[1]
+
+  def start(self):
+    self.server.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def rack_url(self, host, url, rack):
+    """
+    URL a node of rack fetches url from, registered with the seed and
+    fetched into its cache ahead of the node's request.
+    """
+    name = self.seed.register(url)
+    self.seed.prefetch(url)
+    return "http://%s:%d/racks/%s/artifacts/%s" % (
+      host, self.port, quote(rack, safe=""), name)
+
+
+_service = None
+
+
+def start(host="", port=SWARM_PORT):
+  global _service
+  _service = SwarmService(host, port).start()
+  return _service
+
+
+def service():
+  """
+  The provider's swarm service, None unless started.
+  """
+  return _service
+
+
+def _request(url, body=None, timeout=REQUEST_TIMEOUT_S):
+  data = None
+  headers = {}
+  if body is not None:
+    data = json.dumps(body).encode()
+    headers["Content-Type"] = "application/json"
+  response = urlopen(Request(url, data=data, headers=headers),
+                     timeout=timeout)
+  try:
+    return response.read()
+  finally:
+    response.close()
+
+
+class Peer(object):
+  """
+  Swarm agent on a rack host: fetches artifacts through the tracker and
+  serves their chunks to the rack, until stopped.
+  """
+  def __init__(self, tracker_url, rack, host="0.0.0.0", port=0,
+               advertise=None, directory=None):
+    self.tracker_url = tracker_url.rstrip("/")
+    self.rack = rack
+    self.directory = directory or tempfile.mkdtemp(prefix="griffon-swarm-")
+    self.files = {}
+    self.server = SwarmServer((host, port), self.files)
+    port = self.server.server_address[1]
+    if advertise is None:
+      advertise = host if host not in ("", "0.0.0.0") else socket.gethostname()
+    self.address = "http://%s:%d" % (advertise, port)
+    self.peer_id = "%s:%d" % (advertise, port)
+    self._stopped = threading.Event()
+
+  def start(self):
+    self.server.start()
+    self._join()
+    thread = threading.Thread(target=self._heartbeat, name="swarm-heartbeat")
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self._stopped.set()
+    try:
+      self._post("leave", {"peer": self.peer_id})
+    except (URLError, OSError):
+      pass
+    self.server.shutdown()
+    self.server.server_close()
+
+  def _post(self, op, body):
+    return json.loads(_request("%s/swarm/%s" % (self.tracker_url, op), body))
+
+  def _join(self):
+    self._post("join", {"peer": self.peer_id, "rack": self.rack,
+                        "address": self.address})
+    # A tracker that restarted or forgot the peer learns its chunks again
+    for artifact, chunk_file in list(self.files.items()):
+      self._post("hold", {"peer": self.peer_id, "artifact": artifact,
+                          "indexes": sorted(chunk_file.have)})
+
+  def _heartbeat(self):
+    while not self._stopped.wait(HEARTBEAT_S):
+      try:
+        self._join()
+      except (URLError, OSError) as e:
+        get_logger().warning("Swarm heartbeat failed: %s", e)
+
+  def _manifest(self, url):
+    """
+    The artifact's Manifest, once the seed has it.
+    """
+    return Manifest.from_dict(json.loads(_request(
+      "%s/swarm/manifest?%s" % (self.tracker_url, urlencode({"url": url})),
+      timeout=None)))
+
+  def fetch(self, url, path=None):
+    """
+    Fetches url through the swarm to path, by default in the peer's
+    directory, and returns the path. Stops with Cancelled once the
+    thread's cancellation token is cancelled.
+    """
+    token = cancellation.current()
+    manifest = self._manifest(url)
+    artifact = manifest.artifact
+    chunk_file = ChunkFile(manifest, path or
+                           os.path.join(self.directory, artifact))
+    self.files[artifact] = chunk_file
+    with ThreadPoolExecutor(max_workers=ASSIGN_BATCH) as pool:
+      while True:
+        token.check()
+        try:
+          reply = self._post("assign", {"peer": self.peer_id,
+                                        "artifact": artifact})
+        except URLError as e:
+          if getattr(e, "code", None) != 404:
+            raise
+          # The tracker restarted, or the artifact changed
+          self._join()
+          if self._manifest(url).artifact != artifact:
+            self.files.pop(artifact, None)
+            return self.fetch(url, path)
+          continue
+        if reply["done"]:
+          break
+        fetched = pool.map(lambda chunk: self._fetch_chunk(chunk_file, *chunk),
+                           reply["chunks"])
+        if not any(list(fetched)):
+          token.sleep(ASSIGN_WAIT_S)
+    return chunk_file.path
+
+  def _fetch_chunk(self, chunk_file, index, sources):
+    for url, kind in sources:
+      if url.startswith("/"):
+        url = self.tracker_url + url
+      try:
+        data = _request(url)
+        chunk_file.write(index, data)
+      except (URLError, OSError, ChunkCorrupt) as e:
+        get_logger().warning("Chunk %d from %s failed: %s", index, url, e)
+        continue
+      self._post("announce", {"peer": self.peer_id,
+                              "artifact": chunk_file.manifest.artifact,
+                              "index": index, "source": kind,
+                              "size": len(data)})
+      return True
+    return False
+
+
+class _CountingHandler(SimpleHTTPRequestHandler):
+  bytes_sent = 0
+  lock = threading.Lock()
+
+  def copyfile(self, source, outputfile):
+    data = source.read()
+    outputfile.write(data)
+    with _CountingHandler.lock:
+      _CountingHandler.bytes_sent += len(data)
+
+  def log_message(self, *args):
+    pass
+
+
+def _sim_peer(tracker_url, rack, url, delay, done, results):
+  """
+  Child process: one node fetching url, then seeding until done is set.
+  """
+  time.sleep(delay)
+  peer = Peer(tracker_url, rack, host="127.0.0.1")
+  start = time.time()
+  try:
+    peer.start()
+    path = peer.fetch(url)
+    with open(path, "rb") as f:
+      digest = hashlib.sha256(f.read()).hexdigest()
+    results.put((rack, time.time() - start, digest, ""))
+  except Exception as e:
+    results.put((rack, time.time() - start, "", str(e)))
+  done.wait()
+  peer.stop()
+  shutil.rmtree(peer.directory, ignore_errors=True)
+
+
+def simulate(args):
+  """
+  Runs an origin server, the tracker and seed, and one process per peer
+  spread over the racks, and reports where the bytes came from.
+  """
+  origin_dir = tempfile.mkdtemp(prefix="griffon-swarm-origin-")
+  payload = os.urandom(args.size_mb * 1024 * 1024)
+  with open(os.path.join(origin_dir, "livefs"), "wb") as f:
+    f.write(payload)
+  digest = hashlib.sha256(payload).hexdigest()
+  origin = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(
+    _CountingHandler, directory=origin_dir))
+  thread = threading.Thread(target=origin.serve_forever)
+  thread.daemon = True
+  thread.start()
+  url = "http://127.0.0.1:%d/livefs" % origin.server_address[1]
+
+  service = SwarmService("127.0.0.1", 0, tempfile.mkdtemp(
+    prefix="griffon-swarm-cache-")).start()
+  tracker_url = "http://127.0.0.1:%d" % service.port
+  racks = ["rack%d" % i for i in range(args.racks)]
+  done = multiprocessing.Event()
+  results = multiprocessing.Queue()
+  rng = random.Random(args.seed)
+  processes = [multiprocessing.Process(target=_sim_peer, args=(
+    tracker_url, racks[i % len(racks)], url, rng.uniform(0, args.stagger),
+    done, results)) for i in range(args.peers)]
+  start = time.time()
+  for process in processes:
+    process.start()
+  outcomes = []
+  while len(outcomes) < len(processes):
+    try:
+      outcomes.append(results.get(timeout=1))
+    except queue.Empty:
+      # Peers only exit once done is set, unless they crashed
+      dead = sum(1 for p in processes if p.exitcode is not None)
+      if len(outcomes) + dead >= len(processes):
+        outcomes += [("", 0, "", "crashed")] * dead
+        break
+  wall = time.time() - start
+
+  # Whole-artifact fetches, as phoenix does them, go to a rack peer
+  in_rack = 0
+  for rack in racks:
+    response = urlopen("%s/racks/%s/fetch?%s" % (
+      tracker_url, rack, urlencode({"url": url})))
+    if hashlib.sha256(response.read()).hexdigest() == digest:
+      in_rack += not response.geturl().startswith(tracker_url)
+    response.close()
+  done.set()
+  for process in processes:
+    process.join()
+  service.stop()
+  origin.shutdown()
+  shutil.rmtree(origin_dir, ignore_errors=True)
+
+  size = float(len(payload))
+  stats = service.tracker.stats()
+  errors = [e for _, _, _, e in outcomes if e]
+  corrupt = sum(1 for _, _, d, e in outcomes if not e and d != digest)
+  durations = sorted(t for _, t, _, e in outcomes if not e)
+  print("%d peers in %d racks fetched %d MB in %.1fs (p50 %.2fs, max %.2fs)"
+        % (args.peers, args.racks, args.size_mb, wall,
+           durations[len(durations) // 2] if durations else 0,
+           durations[-1] if durations else 0))
+  print("origin sent    %5.2f copies" % (_CountingHandler.bytes_sent / size))
+  for source in ("seed", "rack", "remote"):
+    print("%-14s %5.2f copies" % (
+      "from " + source, stats["bytes"].get(source, 0) / size))
+  print("whole-artifact fetches served in rack: %d of %d" % (in_rack,
+                                                             len(racks)))
+  if errors or corrupt:
+    print("%d failed, %d corrupt: %s" % (len(errors), corrupt,
+                                         "; ".join(errors[:3])))
+    return 1
+  return 0
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Rack-local peer-to-peer distribution of phoenix payloads")
+  commands = parser.add_subparsers(dest="command")
+  tracker = commands.add_parser("tracker", help="Run a tracker and seed")
+  tracker.add_argument("--host", default="")
+  tracker.add_argument("--port", type=int, default=SWARM_PORT or 8001)
+  tracker.add_argument("--cache", default=SWARM_CACHE_DIR)
+  peer = commands.add_parser("peer", help="Fetch artifacts and seed them")
+  peer.add_argument("--tracker", required=True)
+  peer.add_argument("--rack", required=True)
+  peer.add_argument("--host", default="0.0.0.0")
+  peer.add_argument("--port", type=int, default=0)
+  peer.add_argument("--advertise", help="Address other peers reach this at")
+  peer.add_argument("--dir", help="Where to keep the artifacts")
+  peer.add_argument("urls", nargs="+")
+  sim = commands.add_parser("simulate", help="Simulate a swarm locally")
+  sim.add_argument("--peers", type=int, default=32)
+  sim.add_argument("--racks", type=int, default=4)
+  sim.add_argument("--size-mb", type=int, default=32)
+  sim.add_argument("--stagger", type=float, default=1.0,
+                   help="Peers start within this many seconds")
+  sim.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  if args.command == "tracker":
+    service = SwarmService(args.host, args.port, args.cache)
+    print("Swarm tracker on port %d" % service.port)
+    service.server.serve_forever()
+  elif args.command == "peer":
+    node = Peer(args.tracker, args.rack, args.host, args.port,
+                args.advertise, args.dir).start()
+    for url in args.urls:
+      print("%s -> %s" % (url, node.fetch(url)))
+    print("Seeding at %s" % node.address)
+    try:
+      while True:
+        time.sleep(3600)
+    except KeyboardInterrupt:
+      node.stop()
+  elif args.command == "simulate":
+    sys.exit(simulate(args))
+  else:
+    parser.print_help()
+
+
+if __name__ == "__main__":
+  main()
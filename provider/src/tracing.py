@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2020 Nutanix Inc. All rights reserved.
+#
+# Author: sarabjit.saini@nutanix.com
+#
+# Per-operation tracing spans for the imaging workflow.
+#
+# Spans wrap SSH connects, commands, SCP transfers, downloads, template
+# renders and wait loops. They nest per thread, inherit node_ip/step from
+# their parent and belong to the trace of the job they run under. Finished
+# spans are exported as a Chrome trace (chrome://tracing, Perfetto) where
+# every job is its own process row, or as OTLP/JSON lines for an
+# OpenTelemetry collector's file receiver.
+#
+# Tracing is off unless GRIFFON_TRACE names an output file; the format
+# follows its extension (.json: Chrome trace, .otlp/.jsonl: OTLP). The
+# file is rewritten when a job finishes, at most every
+# GRIFFON_TRACE_EXPORT_S (default 30) seconds, and at exit, so a provider
+# that runs until it is stopped still leaves a trace behind.
+
+import atexit
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+TRACE_PATH = os.environ.get("GRIFFON_TRACE", "")
+EXPORT_INTERVAL_S = float(os.environ.get("GRIFFON_TRACE_EXPORT_S", "30"))
+MAX_SPANS = 1000000
+INHERITED_ATTRS = ("node_ip", "step", "job_id")
+
+
+class Span(object):
+  __slots__ = ("name", "trace_id", "span_id", "parent_id", "job", "start",
+               "end", "tid", "attrs")
+
+  def __init__(self, name, trace_id, span_id, parent_id, job, attrs):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = span_id
+    self.parent_id = parent_id
+    self.job = job
+    self.attrs = attrs
+    self.tid = threading.current_thread().ident
+    self.start = time.time()
+    self.end = None
+
+  def set(self, **attrs):
+    self.attrs.update(attrs)
+
+  def add(self, key, value):
+    self.attrs[key] = self.attrs.get(key, 0) + value
+
+
+class _NoSpan(object):
+  """
+  Shared span handed out while tracing is disabled.
+  """
+  def set(self, **attrs):
+    pass
+
+  def add(self, key, value):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+NO_SPAN = _NoSpan()
+
+
+class _SpanContext(object):
+  __slots__ = ("tracer", "span")
+
+  def __init__(self, tracer, span):
+    self.tracer = tracer
+    self.span = span
+
+  def __enter__(self):
+    self.tracer._stack().append(self.span)
+    return self.span
+
+  def __exit__(self, exc_type, exc, tb):
+    span = self.span
+    span.end = time.time()
+    if exc_type is not None:
+      span.attrs["error"] = "%s: %s" % (exc_type.__name__, exc)
+    stack = self.tracer._stack()
+    if stack and stack[-1] is span:
+      stack.pop()
+    self.tracer._finish(span)
+    return False
+
+
+class _Attached(object):
+  """
+  Makes a span of another thread the parent of spans opened in this one.
+  """
+  __slots__ = ("tracer", "span")
+
+  def __init__(self, tracer, span):
+    self.tracer = tracer
+    self.span = span
+
+  def __enter__(self):
+    if self.span is not None:
+      self.tracer._stack().append(self.span)
+    return self.span
+
+  def __exit__(self, *args):
+    stack = self.tracer._stack()
+    if self.span is not None and stack and stack[-1] is self.span:
+      stack.pop()
+    return False
+
+
+class Tracer(object):
+  def __init__(self, enabled=False, max_spans=MAX_SPANS, path="",
+               export_interval=EXPORT_INTERVAL_S):
+    self.enabled = enabled
+    self.path = path
+    self.export_interval = export_interval
+    self._exported_at = 0
+    self._export_lock = threading.Lock()
+    self._spans = deque(maxlen=max_spans)
+    self._local = threading.local()
+    self._ids = itertools.count(1)
+    self._jobs = itertools.count(1)
+
+  def _stack(self):
+    stack = getattr(self._local, "stack", None)
+    if stack is None:
+      stack = self._local.stack = []
+    return stack
+
+  def _finish(self, span):
+    self._spans.append(span)
+    if (span.parent_id is None and self.path and
+        time.time() - self._exported_at >= self.export_interval):
+      self.flush()
+
+  def current(self):
+    stack = self._stack()
+    return stack[-1] if stack else None
+
+  def span(self, name, **attrs):
+    """
+    Context manager timing the enclosed operation.
+    """
+    if not self.enabled:
+      return NO_SPAN
+    parent = self.current()
+    if parent is not None:
+      for key in INHERITED_ATTRS:
+        if key not in attrs and key in parent.attrs:
+          attrs[key] = parent.attrs[key]
+      return _SpanContext(self, Span(name, parent.trace_id, next(self._ids),
+                                     parent.span_id, parent.job, attrs))
+    return self.job_span(name, **attrs)
+
+  def attached(self, span):
+    """
+    Context manager nesting the spans this thread opens under span, e.g.
+    the span current in the thread that started this one.
+    """
+    return _Attached(self, span)
+
+  def job_span(self, name, **attrs):
+    """
+    Root span of a job: starts a new trace that nested spans join.
+    """
+    if not self.enabled:
+      return NO_SPAN
+    job = next(self._jobs)
+    span_id = next(self._ids)
+    return _SpanContext(self, Span(name, "%032x" % ((job << 64) | span_id),
+                                   span_id, None, job, attrs))
+
+  def spans(self):
+    return list(self._spans)
+
+  def clear(self):
+    self._spans.clear()
+
+  def chrome_trace(self):
+    events = []
+    jobs = {}
+    for span in self.spans():
+      if span.parent_id is None:
+        jobs[span.job] = "%s %s" % (span.name, span.attrs.get("node_ip", ""))
+      events.append({
+        "name": span.name, "cat": span.name.split(".")[0], "ph": "X",
+        "ts": int(span.start * 1e6), "dur": int((span.end - span.start) * 1e6),
+        "pid": span.job, "tid": span.tid, "args": span.attrs,
+      })
+    for job, label in jobs.items():
+      events.append({"name": "process_name", "ph": "M", "pid": job,
+                     "args": {"name": label.strip()}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+  def otlp_lines(self):
+    """
+    One OTLP/JSON ExportTraceServiceRequest per trace.
+    """
+    traces = {}
+    for span in self.spans():
+      traces.setdefault(span.trace_id, []).append({
+        "traceId": span.trace_id,
+        "spanId": "%016x" % span.span_id,
+        "parentSpanId": "%016x" % span.parent_id if span.parent_id else "",
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(int(span.start * 1e9)),
+        "endTimeUnixNano": str(int(span.end * 1e9)),
+        "attributes": [_otlp_attr(k, v) for k, v in span.attrs.items()],
+        "status": {"code": 2 if "error" in span.attrs else 1},
+      })
+    for spans in traces.values():
+      yield json.dumps({"resourceSpans": [{
+        "resource": {"attributes": [_otlp_attr("service.name", "griffon")]},
+        "scopeSpans": [{"scope": {"name": "griffon"}, "spans": spans}],
+      }]})
+
+  def export(self, path):
+    # Readers of the file never see half of a trace
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+      if path.endswith(".otlp") or path.endswith(".jsonl"):
+        for line in self.otlp_lines():
+          f.write(line + "\n")
+      else:
+        json.dump(self.chrome_trace(), f)
+    os.replace(tmp, path)
+
+  def flush(self):
+    """
+    Writes the spans finished so far to the trace file.
+    """
+    if not self.path:
+      return
+    with self._export_lock:
+      self._exported_at = time.time()
+      self.export(self.path)
+
+
+def _otlp_attr(key, value):
+  if isinstance(value, bool):
+    typed = {"boolValue": value}
+  elif isinstance(value, int):
+    typed = {"intValue": str(value)}
+  elif isinstance(value, float):
+    typed = {"doubleValue": value}
+  else:
+    typed = {"stringValue": str(value)}
+  return {"key": key, "value": typed}
+
+
+TRACER = Tracer(enabled=bool(TRACE_PATH), path=TRACE_PATH)
+span = TRACER.span
+job_span = TRACER.job_span
+attached = TRACER.attached
+flush = TRACER.flush
+
+if TRACE_PATH:
+  atexit.register(TRACER.flush)
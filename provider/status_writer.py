@@ -0,0 +1,227 @@
+"""
+Coalesced, batched writer for papiea entity updates.
+
+Progress updates stream in from every in-flight node. Instead of one
+papiea round trip per transition, updates are parked per entity and
+flushed on a short interval: rapid transitions of the same entity
+collapse into a single write carrying the latest values, and spec
+writes go through entity clients pooled per owner/tenant and invoking
+user. Pooled clients are closed once idle for CLIENT_IDLE_S, or when more
+than MAX_POOLED_CLIENTS are open, least recently used first.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_S = 0.25
+MAX_CONCURRENT_WRITES = 16
+MAX_WRITE_ATTEMPTS = 3
+MAX_POOLED_CLIENTS = 256
+CLIENT_IDLE_S = 300
+
+
+class _Pending(object):
+    __slots__ = ("seq", "ctx", "metadata", "status", "spec", "attempts")
+
+    def __init__(self, seq, ctx, metadata):
+        self.seq = seq
+        self.ctx = ctx
+        self.metadata = metadata
+        self.status = {}
+        self.spec = {}
+        self.attempts = 0
+
+
+class _Pooled(object):
+    __slots__ = ("client", "users", "used_at")
+
+    def __init__(self, client):
+        self.client = client
+        self.users = 0
+        self.used_at = time.monotonic()
+
+
+def _pool_key(entry) -> Tuple[str, str, str]:
+    """
+    Spec writes carry the credentials of the user who invoked the
+    procedure, so a client is only shared by requests of that user.
+    """
+    extension = entry.metadata.get("extension") or {}
+    return (extension.get("owner", ""), extension.get("tenant_uuid", ""),
+            entry.ctx.get_invoking_token() or "")
+
+
+class StatusWriter(object):
+    """
+    Last-writer-wins update coalescer.
+
+    Every write is stamped with a global sequence number. Writes to the
+    same entity are merged into one pending entry and an entity is never
+    written by two flushes at once, so papiea always receives an entity's
+    updates in the order they were made and ends at the latest value.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL_S,
+                 concurrency=MAX_CONCURRENT_WRITES,
+                 max_clients=MAX_POOLED_CLIENTS, client_idle_s=CLIENT_IDLE_S):
+        self.flush_interval = flush_interval
+        self.max_clients = max_clients
+        self.client_idle_s = client_idle_s
+        self._seq = itertools.count(1)
+        self._pending: Dict[str, _Pending] = {}
+        self._inflight = set()
+        self._clients: Dict[Tuple[str, str, str], _Pooled] = OrderedDict()
+        self._pool_lock = asyncio.Lock()
+        self._sema = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.coalesced = 0
+        self.closed_clients = 0
+        # Called with (metadata, changes) for every queued spec write
+        self.spec_listeners = []
+
+    def _entry(self, ctx, metadata) -> _Pending:
+        uuid = metadata["uuid"]
+        entry = self._pending.get(uuid)
+        if entry is None:
+            entry = self._pending[uuid] = _Pending(next(self._seq), ctx, metadata)
+        else:
+            self.coalesced += 1
+            entry.seq = next(self._seq)
+            entry.ctx = ctx
+            entry.metadata = metadata
+        return entry
+
+    def write_status(self, ctx, metadata, status: dict):
+        """
+        Queues a status update for the entity.
+        """
+        self._entry(ctx, metadata).status.update(status)
+
+    def write_spec(self, ctx, metadata, changes: dict):
+        """
+        Queues spec field changes for the entity. They are applied on top
+        of the entity's current spec when flushed.
+        """
+        self._entry(ctx, metadata).spec.update(changes)
+        for listener in self.spec_listeners:
+            listener(metadata, changes)
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _acquire_client(self, entry) -> _Pooled:
+        key = _pool_key(entry)
+        async with self._pool_lock:
+            pooled = self._clients.get(key)
+            if pooled is None:
+                client = entry.ctx.entity_client_for_user(entry.metadata)
+                await client.__aenter__()
+                pooled = self._clients[key] = _Pooled(client)
+            self._clients.move_to_end(key)
+            pooled.users += 1
+        if len(self._clients) > self.max_clients:
+            await self._close_idle_clients()
+        return pooled
+
+    @staticmethod
+    def _release_client(pooled):
+        pooled.users -= 1
+        pooled.used_at = time.monotonic()
+
+    async def _close_idle_clients(self):
+        """
+        Closes clients unused for client_idle_s, and the least recently
+        used unused ones beyond max_clients. Clients in use are kept.
+        """
+        now = time.monotonic()
+        closing = []
+        async with self._pool_lock:
+            for key, pooled in list(self._clients.items()):
+                over = len(self._clients) > self.max_clients
+                if pooled.users or not (
+                        over or now - pooled.used_at >= self.client_idle_s):
+                    continue
+                del self._clients[key]
+                closing.append(pooled.client)
+        for client in closing:
+            self.closed_clients += 1
+            try:
+                await client.__aexit__(None, None, None)
+            except Exception as e:
+                logger.warning(f"Failed to close entity client: {e}")
+
+    async def _write(self, uuid, entry):
+        try:
+            async with self._sema:
+                if entry.status:
+                    await entry.ctx.update_status(entry.metadata, entry.status)
+                if entry.spec:
+                    pooled = await self._acquire_client(entry)
+                    try:
+                        client = pooled.client
+                        entity = await client.get(entry.metadata)
+                        for key, value in entry.spec.items():
+                            setattr(entity.spec, key, value)
+                        await client.update(entity.metadata, entity.spec)
+                    finally:
+                        self._release_client(pooled)
+            self.writes += 1
+        except Exception as e:
+            entry.attempts += 1
+            logger.error(f"Failed to write entity {uuid} "
+                         f"(attempt {entry.attempts}): {e}")
+            if entry.attempts < MAX_WRITE_ATTEMPTS:
+                self._requeue(uuid, entry)
+        finally:
+            self._inflight.discard(uuid)
+
+    def _requeue(self, uuid, entry):
+        newer = self._pending.get(uuid)
+        if newer is None:
+            self._pending[uuid] = entry
+            return
+        # Fold the failed values under the newer ones
+        status, spec = dict(entry.status), dict(entry.spec)
+        status.update(newer.status)
+        spec.update(newer.spec)
+        newer.status, newer.spec = status, spec
+
+    async def flush(self):
+        """
+        Writes every pending entity that is not already being written.
+        """
+        batch = []
+        for uuid in sorted(self._pending, key=lambda u: self._pending[u].seq):
+            if uuid in self._inflight:
+                continue
+            batch.append((uuid, self._pending.pop(uuid)))
+            self._inflight.add(uuid)
+        if batch:
+            await asyncio.gather(*(self._write(uuid, entry) for uuid, entry in batch))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            await self._close_idle_clients()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        while self._pending or self._inflight:
+            await self.flush()
+            await asyncio.sleep(0)
+        for pooled in self._clients.values():
+            await pooled.client.__aexit__(None, None, None)
+        self._clients.clear()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+PROVIDER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The provider modules, and the host workflow modules they import lazily
+sys.path[:0] = [PROVIDER_DIR, os.path.join(PROVIDER_DIR, "src")]
@@ -0,0 +1,119 @@
+import asyncio
+import types
+
+import pytest
+
+import admission
+from admission import FairAdmission, TenantPolicy
+
+
+class Job(object):
+    def __init__(self, tenant, name, payload_bytes=0):
+        self.metadata = {"extension": {"owner": "nutanix", "tenant_uuid": tenant}}
+        self.name = name
+        self.payload_bytes = payload_bytes
+
+
+def fill(queue, tenant, count, payload_bytes=0):
+    jobs = [Job(tenant, f"{tenant}-{i}", payload_bytes) for i in range(count)]
+    for job in jobs:
+        queue.put(job)
+    return jobs
+
+
+async def admit(queue, count, timeout=1):
+    return [await asyncio.wait_for(queue.get(), timeout) for _ in range(count)]
+
+
+def test_small_tenant_not_stuck_behind_large_one():
+    async def run():
+        queue = FairAdmission({})
+        fill(queue, "big", 300)
+        small, = fill(queue, "small", 1)
+        admitted = await admit(queue, 2)
+        assert small in admitted
+        assert queue.qsize() == 299
+        assert queue.depths() == {"nutanix/big": 299}
+
+    asyncio.run(run())
+
+
+def test_weights_share_the_workers():
+    async def run():
+        queue = FairAdmission({"heavy": TenantPolicy(weight=2)})
+        fill(queue, "heavy", 30)
+        fill(queue, "light", 30)
+        admitted = await admit(queue, 12)
+        heavy = sum(1 for job in admitted if job.name.startswith("heavy"))
+        assert heavy == 8
+
+    asyncio.run(run())
+
+
+def test_max_active_caps_a_tenant_until_release():
+    async def run():
+        queue = FairAdmission({"capped": TenantPolicy(max_active=2)})
+        jobs = fill(queue, "capped", 3)
+        first = await admit(queue, 2)
+        assert first == jobs[:2]
+        assert queue.active() == {"nutanix/capped": 2}
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.1)
+
+        waiter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        queue.release(first[0])
+        assert await asyncio.wait_for(waiter, 1) is jobs[2]
+
+    asyncio.run(run())
+
+
+def test_capped_tenant_does_not_block_others():
+    async def run():
+        queue = FairAdmission({"capped": TenantPolicy(max_active=1)})
+        fill(queue, "capped", 5)
+        other = fill(queue, "other", 3)
+        admitted = await admit(queue, 4)
+        assert [job for job in admitted if job in other] == other
+
+    asyncio.run(run())
+
+
+def test_bandwidth_budget_delays_admission(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission, "time",
+                        types.SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def run():
+        # 1 MiB/s saves up to a 10 MiB burst
+        queue = FairAdmission({"slow": TenantPolicy(bandwidth_mb_s=1)})
+        mib = 1024 * 1024
+        jobs = fill(queue, "slow", 2, payload_bytes=10 * mib)
+        assert await admit(queue, 1) == jobs[:1]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.1)
+        now[0] += 10
+        assert await admit(queue, 1) == jobs[1:]
+
+    asyncio.run(run())
+
+
+def test_remove_drops_a_queued_job():
+    async def run():
+        queue = FairAdmission({})
+        jobs = fill(queue, "t", 3)
+        assert queue.remove(jobs[1])
+        assert not queue.remove(jobs[1])
+        assert queue.qsize() == 2
+        assert await admit(queue, 2) == [jobs[0], jobs[2]]
+
+    asyncio.run(run())
+
+
+def test_policies_by_tenant_label_or_uuid(tmp_path):
+    path = tmp_path / "policies.json"
+    path.write_text('{"nutanix/a": {"weight": 3}, "b": {"max_active": 4}}')
+    queue = FairAdmission(admission.load_policies(str(path)))
+    assert queue._tenant(("nutanix", "a")).policy.weight == 3
+    assert queue._tenant(("other", "b")).policy.max_active == 4
+    assert queue._tenant(("nutanix", "c")).policy is queue.default
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from hedging import Hedger
+
+
+def make_hedger(delay=0.05):
+    hedger = Hedger("test", min_samples=1)
+    hedger.record("key", delay)
+    hedger.budget._tokens = hedger.budget.max_tokens
+    return hedger
+
+
+def test_first_attempt_runs_in_the_calling_thread():
+    hedger = make_hedger(delay=10)
+    caller = threading.current_thread()
+    threads = []
+
+    def operation(attempt):
+        threads.append(threading.current_thread())
+        return "ok"
+
+    assert hedger.run("key", operation) == "ok"
+    assert threads == [caller]
+
+
+def test_slow_first_attempt_is_hedged_and_cancelled():
+    hedger = make_hedger()
+    cancelled = []
+
+    def operation(attempt):
+        if attempt.index == 0:
+            try:
+                attempt.sleep(5)
+            finally:
+                cancelled.append(attempt.cancelled)
+        return attempt.index
+
+    assert hedger.run("key", operation) == 1
+    assert cancelled == [True]
+
+
+def test_first_attempt_finishing_first_cancels_the_hedge():
+    hedger = make_hedger()
+    discarded = []
+    hedge_started = threading.Event()
+
+    def operation(attempt):
+        if attempt.index == 1:
+            hedge_started.set()
+            attempt.sleep(5)
+        else:
+            hedge_started.wait(5)
+        return attempt.index
+
+    assert hedger.run("key", operation, discard=discarded.append) == 0
+    assert discarded == []
+
+
+def test_first_error_is_raised_when_all_attempts_fail():
+    hedger = make_hedger()
+
+    def operation(attempt):
+        if attempt.index == 0:
+            attempt.sleep(0.2)
+        raise ValueError("attempt %d" % attempt.index)
+
+    with pytest.raises(ValueError, match="attempt 0"):
+        hedger.run("key", operation)
@@ -0,0 +1,288 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import imaging_jobs
+from imaging_jobs import DONE, FAILED, IMAGING, QUEUED, RUNNING, ImagingJobs
+from job_store import JobStore
+
+METADATA = {"extension": {"owner": "nutanix", "tenant_uuid": "t1"}}
+
+
+@pytest.fixture(autouse=True)
+def no_preflight_window(monkeypatch):
+    monkeypatch.setattr(imaging_jobs, "PREFLIGHT_WINDOW_S", 0)
+
+
+def passing_preflight(nodes):
+    return {ip: ("", 0) for ip in nodes}
+
+
+class Workflow(object):
+    """
+    Host workflow that reports its steps and then blocks until released
+    or cancelled.
+    """
+    def __init__(self):
+        self.released = threading.Event()
+        self.started = []
+
+    def __call__(self, node_ip, config, on_step, token):
+        self.started.append(node_ip)
+        on_step("staging")
+        while not self.released.wait(0.01):
+            if token.cancelled:
+                raise imaging_jobs.WorkflowError(f"Cancelled: {token.reason}")
+        on_step("reboot_to_phoenix")
+
+
+@pytest.fixture
+def workflow():
+    workflow = Workflow()
+    yield workflow
+    # Lets a workflow thread left blocked by a failed test exit
+    workflow.released.set()
+
+
+def make_jobs(workflow, preflight=passing_preflight, concurrency=1):
+    jobs = None
+
+    async def advance(job, status, failed, message):
+        jobs.progress(job.node_ip, status, failed, message)
+
+    jobs = ImagingJobs(advance, run_workflow=workflow, preflight=preflight,
+                       concurrency=concurrency)
+    jobs.start()
+    return jobs
+
+
+async def until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_job_runs_until_phoenix_takes_over(workflow):
+    async def run():
+        workflow.released.set()
+        jobs = make_jobs(workflow)
+        job = jobs.submit("10.0.0.1", METADATA, None, {})
+        assert job.state == QUEUED
+        await until(lambda: job.state == IMAGING)
+        assert job.status == "reboot_to_phoenix"
+        assert jobs.get_active("10.0.0.1") is job
+
+        jobs.progress("10.0.0.1", "done", False)
+        assert job.state == DONE
+        assert jobs.get_active("10.0.0.1") is None
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_resubmitting_a_node_returns_its_job(workflow):
+    async def run():
+        jobs = make_jobs(workflow)
+        job = jobs.submit("10.0.0.1", METADATA, None, {})
+        assert jobs.submit("10.0.0.1", METADATA, None, {}) is job
+        await jobs.cancel(job)
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_preflight_failure_fails_the_job_without_a_worker(workflow):
+    async def run():
+        checked = []
+
+        def preflight(nodes):
+            checked.append(sorted(nodes))
+            return {ip: ("/boot full" if ip == "10.0.0.2" else "", 0)
+                    for ip in nodes}
+
+        jobs = make_jobs(workflow, preflight)
+        good = jobs.submit("10.0.0.1", METADATA, None, {})
+        bad = jobs.submit("10.0.0.2", METADATA, None, {})
+        await until(lambda: bad.finished and good.state == RUNNING)
+        # Submissions within the window are checked in one batch
+        assert checked == [["10.0.0.1", "10.0.0.2"]]
+        assert bad.state == FAILED
+        assert bad.message == "Preflight: /boot full"
+        assert workflow.started == ["10.0.0.1"]
+        workflow.released.set()
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_cancelling_a_queued_job_releases_its_slot(workflow):
+    async def run():
+        jobs = make_jobs(workflow)
+        running = jobs.submit("10.0.0.1", METADATA, None, {})
+        await until(lambda: running.state == RUNNING)
+        queued = jobs.submit("10.0.0.2", METADATA, None, {})
+        await until(lambda: jobs.admission.qsize() == 1)
+
+        await jobs.cancel(queued, "operator")
+        assert queued.state == FAILED
+        assert queued.message == "Cancelled: operator"
+        assert jobs.queued() == 0
+        # The node can be imaged again, and the worker takes the new job
+        again = jobs.submit("10.0.0.2", METADATA, None, {})
+        assert again is not queued
+        workflow.released.set()
+        await until(lambda: again.state == IMAGING)
+        assert workflow.started == ["10.0.0.1", "10.0.0.2"]
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_cancelling_a_running_job_frees_its_worker(workflow):
+    async def run():
+        jobs = make_jobs(workflow)
+        first = jobs.submit("10.0.0.1", METADATA, None, {})
+        second = jobs.submit("10.0.0.2", METADATA, None, {})
+        await until(lambda: first.state == RUNNING)
+
+        await jobs.cancel(first, "operator")
+        await until(lambda: first.finished and second.state == RUNNING)
+        assert first.state == FAILED
+        assert first.message == "Cancelled: operator"
+        workflow.released.set()
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_job_imaged_by_phoenix_needs_force_or_stalls(workflow):
+    async def run():
+        workflow.released.set()
+        jobs = make_jobs(workflow)
+        job = jobs.submit("10.0.0.1", METADATA, None, {})
+        await until(lambda: job.state == IMAGING)
+        with pytest.raises(Exception, match="cancel with force"):
+            await jobs.cancel(job)
+        assert job.state == IMAGING
+
+        # Phoenix stopped reporting: a new request replaces the job
+        job.active_at -= imaging_jobs.IMAGING_STALL_S + 1
+        again = jobs.submit("10.0.0.1", METADATA, None, {})
+        assert job.state == FAILED
+        assert job.message.startswith("No progress from phoenix")
+        assert again is not job
+
+        await until(lambda: again.state == IMAGING)
+        await jobs.cancel(again, "node replaced", force=True)
+        assert again.state == FAILED
+        assert again.message == "Abandoned: node replaced"
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_progress_reports_keep_a_job_from_stalling(workflow):
+    async def run():
+        workflow.released.set()
+        jobs = make_jobs(workflow)
+        job = jobs.submit("10.0.0.1", METADATA, None, {})
+        await until(lambda: job.state == IMAGING)
+        version = job.version
+        job.active_at -= imaging_jobs.IMAGING_STALL_S + 1
+        # Phoenix reports the status it is already in
+        jobs.touch("10.0.0.1")
+        assert jobs.submit("10.0.0.1", METADATA, None, {}) is job
+        assert job.state == IMAGING and job.version == version
+        await jobs.cancel(job, force=True)
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_finished_jobs_expire(workflow):
+    async def run():
+        jobs = make_jobs(workflow, preflight=None)
+        job = jobs.submit("10.0.0.1", METADATA, None, {})
+        await jobs.cancel(job)
+        assert jobs.get(job.session_id) is job
+        job.updated_at -= imaging_jobs.FINISHED_JOB_TTL_S + 1
+        jobs.submit("10.0.0.2", METADATA, None, {})
+        assert jobs.get(job.session_id) is None
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_wait_returns_on_change_or_timeout(workflow):
+    async def run():
+        jobs = make_jobs(workflow, preflight=None)
+        job = jobs.submit("10.0.0.1", METADATA, None, {})
+        await until(lambda: job.state == RUNNING)
+        version = job.version
+        started = time.monotonic()
+        assert await jobs.wait(job, version, timeout=0.05) is job
+        assert time.monotonic() - started >= 0.05
+
+        assert await jobs.wait(job, version - 1, timeout=5) is job
+        waiter = asyncio.ensure_future(jobs.wait(job, version, timeout=5))
+        await asyncio.sleep(0.01)
+        await jobs.cancel(job)
+        await asyncio.wait_for(waiter, 1)
+        assert job.version > version
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_job_session_goes_into_the_workflow_config(workflow):
+    async def run():
+        jobs = make_jobs(workflow, preflight=None)
+        job = jobs.submit("10.0.0.1", METADATA, None, {"session": "forged"})
+        assert job.config["session"] == job.session_id != "forged"
+        await jobs.cancel(job)
+        again = jobs.submit("10.0.0.1", METADATA, None, {}, session_id="s-1")
+        assert again.session_id == again.config["session"] == "s-1"
+        assert jobs.get("s-1") is again
+        await jobs.cancel(again)
+        await jobs.close()
+
+    asyncio.run(run())
+
+
+def test_imaging_again_resumes_a_job_interrupted_by_a_restart(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    done_before = []
+
+    def workflow(node_ip, config, on_step, token):
+        job = store.open_job(node_ip, "stage_phoenix", config)
+        done_before.append(job.is_done("copy_payload"))
+        job.checkpoint("copy_payload")
+        if len(done_before) == 1:
+            raise imaging_jobs.WorkflowError("provider stopped")
+        job.finish(True)
+
+    async def run():
+        jobs = make_jobs(workflow, preflight=None)
+        first = jobs.submit("10.0.0.1", METADATA, None, {"hypervisor": "ahv"})
+        await until(lambda: first.finished)
+        await jobs.close()
+
+        # The restarted provider continues the session of the node
+        jobs = make_jobs(workflow, preflight=None)
+        jobs.load_interrupted(store)
+        again = jobs.submit("10.0.0.1", METADATA, None, {"hypervisor": "ahv"})
+        assert again.session_id == first.session_id
+        await until(lambda: again.state == IMAGING)
+        assert done_before == [False, True]
+        assert store.running_jobs() == []
+        # Later jobs of the node get a session of their own
+        jobs.progress("10.0.0.1", "done", False)
+        other = jobs.submit("10.0.0.1", METADATA, None, {"hypervisor": "ahv"})
+        assert other.session_id != first.session_id
+        await jobs.cancel(other)
+        await jobs.close()
+
+    asyncio.run(run())
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from job_store import REDACTED, JobStore, redact
+
+CONFIG = {
+    "hypervisor": "ahv",
+    "bmc": {"type": "redfish", "address": "10.0.0.9", "user": "ADMIN",
+            "password": "hunter2"},
+}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+def test_redact_masks_credentials_only():
+    redacted = redact(CONFIG)
+    assert redacted["bmc"] == dict(CONFIG["bmc"], password=REDACTED)
+    assert redacted["hypervisor"] == "ahv"
+    assert CONFIG["bmc"]["password"] == "hunter2"
+
+
+def test_credentials_are_not_persisted(store):
+    store.open_job("10.0.0.1", "stage_phoenix", CONFIG)
+    row = store._conn().execute("SELECT config FROM jobs").fetchone()
+    assert "hunter2" not in row[0]
+    assert json.loads(row[0])["bmc"]["password"] == REDACTED
+
+
+def test_open_job_resumes_with_the_same_config(store):
+    job = store.open_job("10.0.0.1", "stage_phoenix", CONFIG)
+    job.checkpoint("download", path="/tmp/x")
+    again = store.open_job("10.0.0.1", "stage_phoenix", CONFIG)
+    assert again.job_id == job.job_id
+    assert again.is_done("download")
+    other = store.open_job("10.0.0.1", "stage_phoenix",
+                           dict(CONFIG, hypervisor="esx"))
+    assert other.job_id != job.job_id
+    assert not other.is_done("download")
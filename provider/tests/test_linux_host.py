@@ -0,0 +1,45 @@
+import os
+import subprocess
+import types
+
+import pytest
+
+from linux_host import BOOT_DISK_SH, LinuxHost
+
+DF = ("Filesystem 1K-blocks Used Available Use%% Mounted on\n"
+      "%s 1038336 1024 1037312 1%% /boot\n")
+
+
+class FakeHost(LinuxHost):
+    def __init__(self, boot_part, disk):
+        super(FakeHost, self).__init__(types.SimpleNamespace(node_ip="10.0.0.1"))
+        self.outputs = {"df": DF % boot_part, "lsblk": disk + "\n"}
+
+    def ssh(self, cmd, **kwargs):
+        return self.outputs[cmd[0]], "", 0
+
+
+@pytest.mark.parametrize("boot_part, disk, partition", [
+    ("/dev/sda1", "sda", "/dev/sda5"),
+    ("/dev/sda12", "sda", "/dev/sda5"),
+    ("/dev/nvme0n1p1", "nvme0n1", "/dev/nvme0n1p5"),
+    ("/dev/mmcblk0p1", "mmcblk0", "/dev/mmcblk0p5"),
+])
+def test_boot_disk_partition(boot_part, disk, partition):
+    assert FakeHost(boot_part, disk).get_boot_disk_partition(5) == partition
+
+
+@pytest.mark.parametrize("boot_part, disk, prefix", [
+    ("/dev/sda12", "sda", "/dev/sda"),
+    ("/dev/nvme0n1p1", "nvme0n1", "/dev/nvme0n1p"),
+])
+def test_boot_disk_shell_snippet(tmp_path, boot_part, disk, prefix):
+    (tmp_path / "df").write_text("#!/bin/sh\ncat <<EOF\n%sEOF\n" % (DF % boot_part))
+    (tmp_path / "lsblk").write_text(
+        "#!/bin/sh\n[ \"$3\" = %s ] && echo %s\n" % (boot_part, disk))
+    for tool in ("df", "lsblk"):
+        os.chmod(str(tmp_path / tool), 0o755)
+    env = dict(os.environ, PATH="%s:%s" % (tmp_path, os.environ["PATH"]))
+    out = subprocess.check_output(
+        ["sh", "-c", BOOT_DISK_SH + "; echo $dev"], env=env)
+    assert out.decode().strip() == prefix
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import signal
+import types
+
+import pytest
+
+pytest.importorskip("papiea")
+
+import permission_cache  # noqa: E402
+from papiea.core import Action  # noqa: E402
+from permission_cache import PermissionCache  # noqa: E402
+
+
+class Ctx(object):
+    """
+    Procedure context of one caller, counting papiea permission checks.
+    """
+    def __init__(self, token="user", allowed=True):
+        self.token = token
+        self.allowed = allowed
+        self.checks = 0
+
+    def get_invoking_token(self):
+        return self.token
+
+    async def check_permission(self, entity_actions):
+        self.checks += 1
+        await asyncio.sleep(0)
+        return self.allowed
+
+
+def node(tenant):
+    return {"kind": "node",
+            "extension": {"owner": "nutanix", "tenant_uuid": tenant}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(permission_cache, "time",
+                        types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_decisions_are_shared_by_the_nodes_of_a_tenant():
+    async def run():
+        cache, ctx = PermissionCache(), Ctx()
+        assert await cache.check(ctx, node("t1"), Action.Update)
+        assert await cache.check(ctx, node("t1"), Action.Update)
+        assert ctx.checks == 1
+        await cache.check(ctx, node("t1"), Action.Read)
+        await cache.check(ctx, node("t2"), Action.Update)
+        await cache.check(Ctx("other"), node("t1"), Action.Update)
+        assert ctx.checks == 3
+        assert cache.hits == 1 and cache.misses == 4
+
+    asyncio.run(run())
+
+
+def test_concurrent_misses_share_one_check():
+    async def run():
+        cache, ctx = PermissionCache(), Ctx(allowed=False)
+        results = await asyncio.gather(
+            *[cache.check(ctx, node("t1")) for _ in range(10)])
+        assert results == [False] * 10
+        assert ctx.checks == 1
+
+    asyncio.run(run())
+
+
+def test_decisions_expire(clock):
+    async def run():
+        cache, ctx = PermissionCache(ttl=30), Ctx()
+        await cache.check(ctx, node("t1"))
+        clock[0] += 29
+        await cache.check(ctx, node("t1"))
+        assert ctx.checks == 1
+        clock[0] += 1
+        await cache.check(ctx, node("t1"))
+        assert ctx.checks == 2
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_decision_is_evicted():
+    async def run():
+        cache, ctx = PermissionCache(max_entries=2), Ctx()
+        await cache.check(ctx, node("t1"))
+        await cache.check(ctx, node("t2"))
+        # A hit keeps t1 over t2
+        await cache.check(ctx, node("t1"))
+        await cache.check(ctx, node("t3"))
+        assert cache.evictions == 1
+        await cache.check(ctx, node("t1"))
+        assert ctx.checks == 3
+        await cache.check(ctx, node("t2"))
+        assert ctx.checks == 4
+
+    asyncio.run(run())
+
+
+def test_sighup_invalidates_decisions():
+    async def run():
+        cache, ctx = PermissionCache(), Ctx()
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGHUP, cache.invalidate)
+        try:
+            await cache.check(ctx, node("t1"))
+            os.kill(os.getpid(), signal.SIGHUP)
+            await asyncio.sleep(0.05)
+            assert cache.stats()["entries"] == 0
+            await cache.check(ctx, node("t1"))
+            assert ctx.checks == 2
+        finally:
+            loop.remove_signal_handler(signal.SIGHUP)
+
+    asyncio.run(run())
@@ -0,0 +1,62 @@
+import asyncio
+
+from progress import ProgressTracker, parse_callback
+
+STATUSES = ["initial", "staging", "reboot_to_phoenix", "phoenix", "done"]
+
+
+def make_tracker():
+    published = []
+
+    async def publish(node):
+        published.append((node.node_ip, node.status, node.failed))
+
+    return ProgressTracker(STATUSES, publish), published
+
+
+def callback(session, status, msg="progress"):
+    return parse_callback(
+        f"node_ip=10.0.0.1&session={session}&status={status}&msg={msg}".encode())
+
+
+def test_callbacks_of_another_session_are_ignored():
+    async def run():
+        tracker, published = make_tracker()
+        tracker.track("10.0.0.1", {}, None, session="new")
+        assert not await tracker.handle(callback("old", "phoenix"))
+        assert await tracker.handle(callback("new", "phoenix"))
+        assert published == [("10.0.0.1", "phoenix", False)]
+
+    asyncio.run(run())
+
+
+def test_transitions_only_move_forward():
+    async def run():
+        tracker, published = make_tracker()
+        tracker.track("10.0.0.1", {}, None, session="s")
+        assert await tracker.advance("10.0.0.1", "reboot_to_phoenix")
+        assert not await tracker.advance("10.0.0.1", "staging")
+        assert await tracker.advance("10.0.0.1", "done")
+        # Finished nodes are no longer tracked
+        assert tracker.get("10.0.0.1") is None
+        assert [status for _, status, _ in published] == [
+            "reboot_to_phoenix", "done"]
+
+    asyncio.run(run())
+
+
+def test_every_accepted_callback_is_activity():
+    async def run():
+        tracker, published = make_tracker()
+        active = []
+        tracker.activity_listeners.append(active.append)
+        tracker.track("10.0.0.1", {}, None, session="s")
+        assert await tracker.handle(callback("s", "phoenix"))
+        # Heartbeats of the same status and stale sessions change nothing,
+        # only the heartbeat counts as activity
+        assert not await tracker.handle(callback("s", "phoenix", "heartbeat"))
+        assert not await tracker.handle(callback("old", "phoenix"))
+        assert active == ["10.0.0.1", "10.0.0.1"]
+        assert len(published) == 1
+
+    asyncio.run(run())
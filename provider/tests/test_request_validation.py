@@ -0,0 +1,108 @@
+import copy
+import json
+import os
+
+import pytest
+import yaml
+
+from request_validation import (InvalidRequest, Validator, compile_schema,
+                                parse_image_node)
+
+PROVIDER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def validator():
+    with open(os.path.join(PROVIDER_DIR, "kinds", "image_node.yml")) as f:
+        return Validator(yaml.safe_load(f))
+
+
+@pytest.fixture
+def node_request():
+    with open(os.path.join(PROVIDER_DIR, "config", "node_172.26.1.5.json")) as f:
+        return json.load(f)
+
+
+def errors_of(validator, request):
+    with pytest.raises(InvalidRequest) as e:
+        parse_image_node(validator, request)
+    return e.value.errors
+
+
+def test_sample_node_config_is_valid(validator, node_request):
+    assert validator.errors(node_request) == []
+
+
+def test_normalized_config(validator, node_request):
+    config = parse_image_node(validator, copy.deepcopy(node_request)).to_dict()
+    assert config["host_ip"] == "172.26.1.5"
+    assert config["host_subnet_mask"] == "255.255.255.0"
+    assert config["default_gw"] == "172.26.1.2"
+    assert config["phoenix"]["mode"] == "installer"
+    assert config["phoenix"]["kernel"] == node_request["phoenix"]["kernel"]
+    assert config["partition_table"] == {"nutanix": {"id": 4}, "holo": {"id": 3}}
+    assert config["nos_package"] == node_request["nos_package"]
+    # Fields the workflow does not read are passed through
+    assert config["node_position"] == "A"
+
+
+def test_missing_fields_are_all_reported(validator, node_request):
+    del node_request["cvm_ip"]
+    del node_request["phoenix"]["initrd"]
+    errors = errors_of(validator, node_request)
+    assert "image_node.cvm_ip: required" in errors
+    assert "image_node.phoenix.initrd: required" in errors
+
+
+@pytest.mark.parametrize("field, value, message", [
+    ("hypervisor_ip", "172.26.1.500", "is not an IPv4 address"),
+    ("hypervisor_netmask", "255.0.255.0", "is not an IPv4 netmask"),
+    ("hypervisor_netmask", "24", "is not an IPv4 netmask"),
+    ("hypervisor_netmask", "0.0.0.255", "is not an IPv4 netmask"),
+    ("arizona_url", "file:///etc/arizona.json", "is not a http(s), ftp or nfs url"),
+    ("cvm_num_vcpus", True, "expected integer, got bool"),
+    ("bond_uplinks", "aa:bb:cc:dd:ee:ff", "expected array, got str"),
+    ("boot_mode", "efi", "is not one of"),
+])
+def test_malformed_field(validator, node_request, field, value, message):
+    node_request[field] = value
+    errors = errors_of(validator, node_request)
+    assert len(errors) == 1
+    assert errors[0].startswith(f"image_node.{field}: ")
+    assert message in errors[0]
+
+
+def test_malformed_nested_fields(validator, node_request):
+    node_request["phoenix"]["mode"] = "rescue"
+    node_request["phoenix"]["livefs"]["url"] = "squashfs.img"
+    node_request["partition_table"]["holo"]["id"] = "3"
+    errors = errors_of(validator, node_request)
+    assert [e.split(":")[0] for e in errors] == [
+        "image_node.phoenix.mode",
+        "image_node.phoenix.livefs.url",
+        "image_node.partition_table.holo.id",
+    ]
+
+
+@pytest.mark.parametrize("changes, message", [
+    ({"default_gateway": "172.26.2.1"}, "is not in the hypervisor network"),
+    ({"cvm_ip": "172.26.1.5"}, "same as hypervisor_ip"),
+    ({"partition_table": {"nutanix": {"id": 3}, "holo": {"id": 3}}},
+     "partitions are the same"),
+])
+def test_inconsistent_fields(validator, node_request, changes, message):
+    node_request.update(changes)
+    errors = errors_of(validator, node_request)
+    assert len(errors) == 1
+    assert message in errors[0]
+
+
+def test_compile_schema_shorthand_and_items():
+    check = compile_schema({"type": "object", "properties": {
+        "name": "string",
+        "ports": {"type": "array", "items": {"type": "integer"}},
+    }})
+    errors = []
+    check({"name": 1, "ports": [22, "80"]}, "x", errors)
+    assert errors == ["x.name: expected string, got int",
+                      "x.ports[1]: expected integer, got str"]
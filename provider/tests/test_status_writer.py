@@ -0,0 +1,152 @@
+import asyncio
+import types
+
+import status_writer
+from status_writer import MAX_WRITE_ATTEMPTS, StatusWriter
+
+
+class Client(object):
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.closed = True
+
+    async def get(self, metadata):
+        return types.SimpleNamespace(metadata=metadata,
+                                     spec=types.SimpleNamespace())
+
+    async def update(self, metadata, spec):
+        self.ctx.writes.append((metadata["uuid"], "spec", vars(spec)))
+
+
+class Ctx(object):
+    """
+    Procedure context recording the papiea writes made through it.
+    """
+    def __init__(self, token="user", failures=0):
+        self.token = token
+        self.failures = failures
+        self.writes = []
+        self.clients = []
+
+    def get_invoking_token(self):
+        return self.token
+
+    async def update_status(self, metadata, status):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("papiea unavailable")
+        self.writes.append((metadata["uuid"], "status", dict(status)))
+
+    def entity_client_for_user(self, metadata):
+        client = Client(self)
+        self.clients.append(client)
+        return client
+
+
+def entity(uuid, tenant="t1"):
+    return {"uuid": uuid,
+            "extension": {"owner": "nutanix", "tenant_uuid": tenant}}
+
+
+def test_updates_of_an_entity_are_coalesced():
+    async def run():
+        writer, ctx = StatusWriter(), Ctx()
+        writer.write_status(ctx, entity("a"), {"status": "staging"})
+        writer.write_status(ctx, entity("a"), {"status": "phoenix"})
+        writer.write_spec(ctx, entity("a"), {"state": "imaging"})
+        await writer.flush()
+        assert ctx.writes == [("a", "status", {"status": "phoenix"}),
+                              ("a", "spec", {"state": "imaging"})]
+        assert writer.coalesced == 2 and writer.writes == 1
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_entities_are_written_in_update_order():
+    async def run():
+        writer, ctx = StatusWriter(), Ctx()
+        writer.write_status(ctx, entity("a"), {"status": "staging"})
+        writer.write_status(ctx, entity("b"), {"status": "staging"})
+        # The latest update of a moves it behind b
+        writer.write_status(ctx, entity("a"), {"status": "phoenix"})
+        await writer.flush()
+        assert [uuid for uuid, _, _ in ctx.writes] == ["b", "a"]
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_failed_write_is_requeued_under_newer_updates():
+    async def run():
+        writer, ctx = StatusWriter(), Ctx(failures=1)
+        writer.write_status(ctx, entity("a"), {"status": "staging",
+                                               "message": "copying"})
+        await writer.flush()
+        assert ctx.writes == [] and writer.pending() == 1
+        writer.write_status(ctx, entity("a"), {"status": "phoenix"})
+        await writer.flush()
+        assert ctx.writes == [("a", "status", {"status": "phoenix",
+                                               "message": "copying"})]
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_write_is_dropped_after_max_attempts():
+    async def run():
+        writer, ctx = StatusWriter(), Ctx(failures=MAX_WRITE_ATTEMPTS)
+        writer.write_status(ctx, entity("a"), {"status": "staging"})
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            await writer.flush()
+        assert writer.pending() == 0 and ctx.writes == []
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_spec_clients_are_pooled_and_closed_when_idle(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(status_writer, "time",
+                        types.SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def run():
+        writer, ctx = StatusWriter(client_idle_s=300), Ctx()
+        writer.write_spec(ctx, entity("a"), {"state": "imaging"})
+        await writer.flush()
+        writer.write_spec(ctx, entity("b"), {"state": "imaging"})
+        await writer.flush()
+        # Nodes of one tenant and user share a client
+        assert len(ctx.clients) == 1
+        now[0] += 299
+        await writer._close_idle_clients()
+        assert not ctx.clients[0].closed
+        now[0] += 1
+        await writer._close_idle_clients()
+        assert ctx.clients[0].closed and writer.closed_clients == 1
+        writer.write_spec(ctx, entity("a"), {"state": "ready"})
+        await writer.flush()
+        assert len(ctx.clients) == 2
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_clients_are_closed_over_the_bound():
+    async def run():
+        writer, ctx = StatusWriter(max_clients=2), Ctx()
+        for tenant in ("t1", "t2", "t1", "t3"):
+            writer.write_spec(ctx, entity(tenant, tenant), {"state": "imaging"})
+            await writer.flush()
+        # t1 was used after t2, so t2's client goes
+        assert [c.closed for c in ctx.clients] == [False, True, False]
+        await writer.close()
+        assert all(c.closed for c in ctx.clients)
+
+    asyncio.run(run())
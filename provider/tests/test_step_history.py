@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+import step_history
+from step_history import MIN_DEADLINE_S, MIN_SAMPLES, StepHistory
+
+STEP = "boot.phoenix"
+FP = "NX-3060-G6/uefi"
+
+
+@pytest.fixture
+def steps(tmp_path):
+    return StepHistory(str(tmp_path / "history.db"))
+
+
+def record_many(steps, seconds, count=MIN_SAMPLES, **kwargs):
+    for _ in range(count):
+        steps.record(STEP, FP, seconds, **kwargs)
+
+
+def test_deadline_defaults_without_history(steps):
+    record_many(steps, 100, MIN_SAMPLES - 1)
+    assert steps.deadline(STEP, FP, 300) == 300
+
+
+def test_deadline_follows_p99(steps):
+    record_many(steps, 100)
+    assert steps.deadline(STEP, FP, 300) == 150
+    assert steps.deadline(STEP, "other/bios", 300) == 300
+
+
+def test_deadline_has_a_floor(steps):
+    record_many(steps, 5)
+    assert steps.deadline(STEP, FP, 300) == MIN_DEADLINE_S
+
+
+def test_slow_model_deadline_goes_past_default_up_to_ceiling(steps):
+    record_many(steps, 400)
+    assert steps.deadline(STEP, FP, 300, 3600) == 600
+    assert steps.deadline(STEP, FP, 300, 500) == 500
+    # Without a ceiling the default stays the limit
+    assert steps.deadline(STEP, FP, 300) == 300
+
+
+def test_timeouts_grow_the_deadline(steps):
+    deadline = steps.deadline(STEP, FP, 300, 3600)
+    deadlines = []
+    for _ in range(7):
+        steps.record(STEP, FP, deadline, ok=False, censored=True)
+        deadline = steps.deadline(STEP, FP, 300, 3600)
+        deadlines.append(deadline)
+    assert deadlines == [450, 675, 1012.5, 1518.75, 2278.125, 3417.1875, 3600]
+
+
+def test_failures_do_not_move_the_deadline(steps):
+    steps.record(STEP, FP, 20, ok=False)
+    assert steps.deadline(STEP, FP, 300, 3600) == 300
+
+
+def test_censored_samples_survive_a_restart(steps):
+    steps.record(STEP, FP, 300, ok=False, censored=True)
+    reopened = StepHistory(steps.path)
+    assert reopened.deadline(STEP, FP, 300, 3600) == 450
+
+
+def test_old_database_gains_the_censored_column(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE step_durations (step TEXT NOT NULL, "
+                 "fingerprint TEXT NOT NULL, duration REAL NOT NULL, "
+                 "ok INTEGER NOT NULL, recorded_at REAL NOT NULL)")
+    conn.commit()
+    conn.close()
+    steps = StepHistory(path)
+    steps.record(STEP, FP, 300, ok=False, censored=True)
+    assert steps.deadline(STEP, FP, 300, 3600) == 450
+
+
+def test_rows_are_pruned(steps, monkeypatch):
+    monkeypatch.setattr(step_history, "MAX_SAMPLES", 5)
+    record_many(steps, 10, 8)
+    record_many(steps, 20, 8, ok=False)
+    rows = steps._conn().execute(
+        "SELECT ok, count(*) FROM step_durations GROUP BY ok").fetchall()
+    assert sorted(rows) == [(0, 5), (1, 5)]
+
+
+def test_poll_interval_waits_for_the_fastest_boots(steps):
+    assert steps.poll_interval(STEP, FP, 0, 10) == 10
+    record_many(steps, 100)
+    # Up to 6 intervals at once until p5, then every interval
+    assert steps.poll_interval(STEP, FP, 0, 10) == 60
+    assert steps.poll_interval(STEP, FP, 75, 10) == 25
+    assert steps.poll_interval(STEP, FP, 95, 10) == 10
+    assert steps.poll_interval(STEP, FP, 100, 10) == 10
+
+
+def test_is_outlier(steps):
+    assert not steps.is_outlier(STEP, FP, 10000)
+    assert steps.outlier_after(STEP, FP) is None
+    record_many(steps, 100)
+    assert steps.outlier_after(STEP, FP) == 150
+    before = step_history.OUTLIERS.value(STEP)
+    assert not steps.is_outlier(STEP, FP, 150)
+    assert steps.is_outlier(STEP, FP, 151)
+    assert step_history.OUTLIERS.value(STEP) == before + 1
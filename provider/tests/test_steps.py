@@ -0,0 +1,127 @@
+import subprocess
+
+import pytest
+
+import steps
+from job_store import JobStore
+from step_history import StepHistory
+from steps import Phase, Step
+
+
+class Host(object):
+    """
+    Host whose step checks run in a local shell.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.probes = []
+
+    def node_ip(self):
+        return "10.0.0.1"
+
+    def fingerprint(self):
+        return "NX-3060-G6/uefi"
+
+    def ssh(self, cmd, **kwargs):
+        self.probes.append(cmd)
+        proc = subprocess.run(" ".join(cmd), shell=True, capture_output=True,
+                              text=True)
+        return proc.stdout, proc.stderr, proc.returncode
+
+
+@pytest.fixture(autouse=True)
+def step_history(tmp_path, monkeypatch):
+    history = StepHistory(str(tmp_path / "history.db"))
+    monkeypatch.setattr(steps, "history", lambda: history)
+    return history
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+@pytest.fixture
+def job(store):
+    return store.open_job("10.0.0.1", "stage_phoenix", {})
+
+
+def touch_step(name, path, ran):
+    def action():
+        ran.append(name)
+        path.write_text(name)
+        return True, {"path": str(path)}
+    return Step(name, "test -f %s" % path, action)
+
+
+def test_satisfied_steps_are_skipped(tmp_path, job):
+    ran = []
+    done = tmp_path / "done"
+    done.write_text("")
+    phase = Phase(Host(job), "stage", [
+        touch_step("satisfied", done, ran),
+        touch_step("missing", tmp_path / "missing", ran),
+    ])
+    assert phase.run() == (True, "")
+    assert ran == ["missing"]
+    # Both are checkpointed, the checks are probed in one ssh call
+    assert job.is_done("satisfied") and job.is_done("missing")
+    assert len(phase.host.probes) == 1
+
+
+def test_failed_check_reruns_the_step(tmp_path, job):
+    ran = []
+    path = tmp_path / "payload"
+    path.write_text("")
+    chmod = Step("chmod", "test -x %s" % path,
+                 lambda: (ran.append("chmod") or True, None))
+    phase = Phase(Host(job), "stage", [touch_step("copy", path, ran), chmod])
+    assert phase.run() == (True, "")
+    assert ran == ["chmod"]
+
+
+def test_step_depending_on_a_rerun_step_runs_again(tmp_path, job):
+    ran = []
+    payload = tmp_path / "payload"
+    chmod = Step("chmod", "true", lambda: (ran.append("chmod") or True, None),
+                 depends_on=("copy",))
+    phase = Phase(Host(job), "stage",
+                  [touch_step("copy", payload, ran), chmod])
+    assert phase.run() == (True, "")
+    assert ran == ["copy", "chmod"]
+
+
+def test_checkpointed_steps_are_not_probed_or_run(tmp_path, store):
+    ran = []
+    job = store.open_job("10.0.0.1", "stage_phoenix", {})
+    first = Phase(Host(job), "stage", [
+        touch_step("copy", tmp_path / "copy", ran),
+        Step("fail", None, lambda: (False, "disk full")),
+    ])
+    assert first.run() == (False, "disk full")
+    assert ran == ["copy"]
+
+    # The resumed job skips the checkpointed step, even though its effect
+    # is gone from the node
+    (tmp_path / "copy").unlink()
+    resumed = store.open_job("10.0.0.1", "stage_phoenix", {})
+    assert resumed.outputs("copy") == {"path": str(tmp_path / "copy")}
+    host = Host(resumed)
+    second = Phase(host, "stage", [
+        touch_step("copy", tmp_path / "copy", ran),
+        Step("fail", None, lambda: (True, None)),
+    ])
+    assert second.probe_script() == ""
+    assert second.run() == (True, "")
+    assert ran == ["copy"]
+    assert host.probes == []
+
+
+def test_step_durations_are_recorded(tmp_path, job, step_history):
+    phase = Phase(Host(job), "stage", [
+        touch_step("copy", tmp_path / "copy", []),
+        Step("fail", None, lambda: (False, "disk full")),
+    ])
+    phase.run()
+    assert len(step_history._load("copy", "NX-3060-G6/uefi", "ok = 1")) == 1
+    assert len(step_history._load("fail", "NX-3060-G6/uefi", "ok = 0")) == 1
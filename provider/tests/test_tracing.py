@@ -0,0 +1,52 @@
+import json
+import time
+
+from hedging import Hedger
+from tracing import Tracer
+import tracing
+
+
+def test_finished_jobs_are_written_out(tmp_path):
+    path = str(tmp_path / "trace.json")
+    tracer = Tracer(enabled=True, path=path, export_interval=0)
+    with tracer.job_span("stage_phoenix", node_ip="10.0.0.1"):
+        with tracer.span("ssh.command"):
+            pass
+    with open(path) as f:
+        names = [e["name"] for e in json.load(f)["traceEvents"]]
+    assert "ssh.command" in names and "stage_phoenix" in names
+
+
+def test_exports_are_rate_limited(tmp_path):
+    path = tmp_path / "trace.otlp"
+    tracer = Tracer(enabled=True, path=str(path), export_interval=3600)
+    with tracer.job_span("first"):
+        pass
+    with tracer.job_span("second"):
+        pass
+    assert len(path.read_text().splitlines()) == 1
+    tracer.flush()
+    assert len(path.read_text().splitlines()) == 2
+
+
+def test_hedged_attempts_nest_under_the_caller(monkeypatch):
+    tracer = Tracer(enabled=True)
+    monkeypatch.setattr(tracing, "TRACER", tracer)
+    hedger = Hedger("test", min_samples=1)
+    hedger.record("key", 0.01)
+    hedger.budget.request()
+    hedger.budget._tokens = 1
+
+    def operation(attempt):
+        with tracer.span("attempt"):
+            if attempt.index == 0:
+                attempt.sleep(5)
+        return attempt.index
+
+    with tracer.job_span("job", node_ip="10.0.0.1") as job:
+        assert hedger.run("key", operation) == 1
+    time.sleep(0.1)
+    attempts = [s for s in tracer.spans() if s.name == "attempt"]
+    assert attempts
+    assert all(s.parent_id == job.span_id for s in attempts)
+    assert all(s.attrs["node_ip"] == "10.0.0.1" for s in attempts)